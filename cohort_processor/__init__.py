@@ -1,15 +1,49 @@
 # cohort_processor/__init__.py
 
 from .cohort_processor import CohortGenerator
+from .datastore import DataStore
 from . import config
 from . import utils
 from . import impl
+from . import cache
+from . import datastore
+from . import encode
+from . import rules
+from . import indexes
+from . import scenarios
+from . import offense_codes
+from . import patterns
+from . import workers
+from . import shared
+from . import chunked
+from . import sql
+from . import incremental
+from . import compare
+from . import idmap
+from . import export
 
 __all__ = [
     "CohortGenerator",
+    "DataStore",
     "config",
     "utils",
     "impl",
+    "cache",
+    "datastore",
+    "encode",
+    "rules",
+    "indexes",
+    "scenarios",
+    "offense_codes",
+    "patterns",
+    "workers",
+    "shared",
+    "chunked",
+    "sql",
+    "incremental",
+    "compare",
+    "idmap",
+    "export",
 ]
 
 __version__ = "0.1.0"
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import pandas as pd
+import utils
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+def is_remote(path):
+    """
+
+    Parameters
+    ----------
+    path : str
+        Location of an input file
+
+    Returns
+    -------
+    bool
+        True if the path points to a web resource rather than a file on the local disk
+
+    """
+    return str(path).startswith(('http://', 'https://', 'ftp://'))
+
+
+def hash_file(path, chunk_size = 1 << 20):
+    """
+
+    Parameters
+    ----------
+    path : str
+        Location of a local file
+    chunk_size : int, optional
+        Number of bytes read at a time so that large extracts are never held in memory. Default is 1 MiB
+
+    Returns
+    -------
+    str
+        BLAKE2b hex digest of the file contents
+
+    """
+    h = hashlib.blake2b(digest_size = 20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_fingerprint(path, known = None):
+    """
+
+    Parameters
+    ----------
+    path : str
+        Location of the input file
+    known : dict, optional
+        A fingerprint computed earlier for the same path. If its size and modification time still match the file, its hash is reused instead of re-reading the file
+        Default is None
+
+    Returns
+    -------
+    dict
+        Size, modification time and content hash of a local file. Remote files cannot be inspected, so they are fingerprinted by URL and today's date, i.e. they are refreshed once a day
+
+    """
+    if is_remote(path):
+        return {'url': path, 'date': utils.get_todays_date(sep = '-')}
+    stat = os.stat(path)
+    fp = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    # Only hash the contents again if the file has been touched since the last fingerprint
+    if known and (known.get('size') == fp['size']) and (known.get('mtime') == fp['mtime']) and known.get('hash'):
+        fp['hash'] = known['hash']
+    else:
+        fp['hash'] = hash_file(path)
+    return fp
+
+
+class ColumnarCache():
+    """
+    Persistent cache of loaded (and optionally column-cleaned) input tables.
+
+    Each table is stored as a Parquet or Feather file whose name is derived from the fingerprint of the source file, so that a rerun or a second process can skip parsing the original CSV or Excel extract.
+    """
+    def __init__(self, cache_dir : str, fmt : str = 'parquet'):
+        self.cache_dir = cache_dir
+        if fmt not in ['parquet', 'feather']:
+            print(f"Cache format {fmt} is not understood, using parquet")
+            fmt = 'parquet'
+        self.fmt = fmt
+        os.makedirs(cache_dir, exist_ok = True)
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_manifest(self):
+        # Merge with entries written by other processes since this cache was opened
+        manifest = self._read_manifest()
+        manifest.update(self.manifest)
+        tmp = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent = 1)
+        os.replace(tmp, self.manifest_path)
+        self.manifest = manifest
+
+    def key(self, path : str, clean_col_names : bool, **kwargs):
+        """
+
+        Parameters
+        ----------
+        path : str
+            Location of the source file
+        clean_col_names : bool
+            Whether the cached table has cleaned column names
+        kwargs : optional
+            Any other loading options that change the cached contents
+
+        Returns
+        -------
+        str
+            Cache key built from the fingerprint of the source file and the loading options
+
+        """
+        fp = file_fingerprint(path, known = self.manifest.get(os.path.abspath(path)) if not is_remote(path) else None)
+        if not is_remote(path):
+            self.manifest[os.path.abspath(path)] = fp
+        spec = dict(fp, clean_col_names = bool(clean_col_names), **kwargs)
+        spec.pop('mtime', None)
+        return hashlib.blake2b(json.dumps(spec, sort_keys = True, default = str).encode(), digest_size = 16).hexdigest()
+
+    def _file(self, key, fmt):
+        ext = {'parquet': '.parquet', 'feather': '.feather', 'pickle': '.pkl'}[fmt]
+        return os.path.join(self.cache_dir, key+ext)
+
+    def load(self, key : str, columns : list = None):
+        """
+
+        Parameters
+        ----------
+        key : str
+            Cache key returned by key()
+        columns : list, optional
+            Names of the cached columns to read. Parquet and Feather files only read these columns from disk. Default is None, i.e. all columns
+
+        Returns
+        -------
+        pandas dataframe or None
+            The cached table, or None if there is no entry for the key or it lacks a requested column
+
+        """
+        for fmt in [self.fmt, 'pickle']:
+            file = self._file(key, fmt)
+            if not os.path.exists(file):
+                continue
+            try:
+                if fmt == 'parquet':
+                    return pd.read_parquet(file, columns = columns)
+                elif fmt == 'feather':
+                    return pd.read_feather(file, columns = columns)
+                else:
+                    data = pd.read_pickle(file)
+                    return data[columns] if columns is not None else data
+            except Exception as e:
+                print(f"Could not read cached table {file}: {e}")
+        return None
+
+    def store(self, key : str, df : pd.DataFrame):
+        """
+
+        Parameters
+        ----------
+        key : str
+            Cache key returned by key()
+        df : pandas dataframe
+            Table to persist
+
+        Returns
+        -------
+        file : str
+            Location of the cached table
+
+        """
+        fmt = self.fmt if pyarrow is not None else 'pickle'
+        file = self._file(key, fmt)
+        tmp = f"{file}.{os.getpid()}.tmp"
+        try:
+            if fmt == 'parquet':
+                df.to_parquet(tmp, index = False)
+            elif fmt == 'feather':
+                df.reset_index(drop = True).to_feather(tmp)
+            else:
+                df.to_pickle(tmp)
+        except Exception as e:
+            # Columns with mixed Python types (common in Excel extracts) cannot be written to Arrow formats
+            print(f"Could not write {fmt} cache ({e}), falling back to pickle")
+            fmt = 'pickle'
+            file = self._file(key, fmt)
+            df.to_pickle(tmp)
+        os.replace(tmp, file)
+        self._write_manifest()
+        return file
+
+
+class RuleResultCache(ColumnarCache):
+    """
+    Persistent cache of the IDs disqualified by each compiled rule.
+
+    Entries are keyed by the fingerprint of the rule (criterion, resolved columns and selection) and of the file it queries, so that editing one criterion of a ruleset only recomputes that criterion. IDs are stored by value, so entries stay valid when other datasets add or remove IDs.
+    """
+    def rule_key(self, rule_fingerprint : str, path : str, **kwargs):
+        """
+
+        Parameters
+        ----------
+        rule_fingerprint : str
+            Fingerprint of the compiled rule, see rules.rule_fingerprint()
+        path : str
+            Location of the file queried by the rule
+        kwargs : optional
+            Any other options that change the result, e.g. the prefix removed from offense codes
+
+        Returns
+        -------
+        str or None
+            Cache key of the result. None if the data does not come from a file that can be fingerprinted
+
+        """
+        if (not is_remote(path)) and (not os.path.isfile(str(path))):
+            return None
+        return self.key(path, False, rule = rule_fingerprint, **kwargs)
+
+    def load_ids(self, key : str):
+        # Disqualified IDs of a cached rule, or None
+        data = self.load(key)
+        return None if data is None else data['id'].to_numpy()
+
+    def store_ids(self, key : str, ids):
+        return self.store(key, pd.DataFrame({'id': ids}))
+
+
+def load_table(path : str, clean_col_names : bool = False, cache_dir : str = None, columns : list = None):
+    """
+
+    Parameters
+    ----------
+    path : str
+        Location of the CSV or Excel input file
+    clean_col_names : bool, optional
+        Whether to clean the column names with utils.clean_var_names. Default is False
+    cache_dir : str, optional
+        Directory of the persistent columnar cache. Default is None, i.e. the file is always parsed
+    columns : list, optional
+        Columns to load, raw or cleaned if clean_col_names is True (see utils.select_columns). Default is None, i.e. all columns
+
+    Returns
+    -------
+    data : pandas dataframe
+        The parsed table, read from the columnar cache when the source file has not changed since it was cached. With columns, only those columns are parsed or read from the cache
+
+    """
+    disk_cache = ColumnarCache(cache_dir) if cache_dir else None
+    data = None
+    usecols, names = None, None
+    if columns is not None:
+        # Projection pushdown: only parse the requested columns
+        usecols = utils.select_columns(utils.read_header(path), columns, clean_col_names = clean_col_names)
+        names = utils.clean_var_names(list(usecols), rem = ["\n"]) if clean_col_names else usecols
+    if disk_cache:
+        # A cached copy of the whole table serves any projection
+        disk_key = disk_cache.key(path, clean_col_names)
+        data = disk_cache.load(disk_key, columns = names)
+        if (data is None) and (usecols is not None):
+            disk_key = disk_cache.key(path, clean_col_names, usecols = usecols)
+            data = disk_cache.load(disk_key)
+        if data is not None:
+            print('Loaded raw data from disk cache for path: ', path)
+            return data
+    data = utils.load_data(path, usecols = usecols)
+    if clean_col_names:
+        data.columns = utils.clean_var_names(list(data.columns), rem = ["\n"])
+    # Store the parsed table so the next run can skip parsing
+    if disk_cache:
+        disk_cache.store(disk_key, data)
+    return data
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import utils
+from indexes import EnhancementIndex, normalize_column
+from offense_codes import selected_values
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+def read_chunks(path, chunksize, clean_col_names = False, columns = None):
+    """
+
+    Parameters
+    ----------
+    path : str
+        Location of a CSV, Excel or Parquet file
+    chunksize : int
+        Maximum number of rows per chunk
+    clean_col_names : bool, optional
+        Whether the column names should be cleaned with utils.clean_var_names. Default is False
+    columns : list, optional
+        Columns to read, raw or cleaned if clean_col_names is True (see utils.select_columns). Default is None, i.e. all columns
+
+    Yields
+    ------
+    pandas dataframe
+        Consecutive chunks of the table. The whole table is never held in memory
+
+    """
+    if '.csv' in path:
+        usecols = utils.select_columns(utils.read_header(path), columns, clean_col_names) if columns is not None else None
+        chunks = pd.read_csv(path, chunksize = chunksize, usecols = usecols)
+    elif '.parquet' in path:
+        if pq is None:
+            raise ImportError("Reading Parquet files in chunks requires pyarrow")
+        pf = pq.ParquetFile(path)
+        usecols = utils.select_columns(pf.schema_arrow.names, columns, clean_col_names) if columns is not None else None
+        chunks = (batch.to_pandas() for batch in pf.iter_batches(batch_size = chunksize, columns = usecols))
+    elif '.xlsx' in path:
+        chunks = read_excel_chunks(path, chunksize)
+        if columns is not None:
+            chunks = (chunk[utils.select_columns(list(chunk.columns), columns, clean_col_names)] for chunk in chunks)
+    else:
+        raise ValueError(f"Input file could not be read in chunks: {path}")
+    for chunk in chunks:
+        if clean_col_names:
+            chunk.columns = utils.clean_var_names(list(chunk.columns), rem = ["\n"])
+        yield chunk
+
+
+def read_excel_chunks(path, chunksize):
+    """
+
+    Parameters
+    ----------
+    path : str
+        Location of an Excel file. The first row of the first sheet holds the column names
+    chunksize : int
+        Maximum number of rows per chunk
+
+    Yields
+    ------
+    pandas dataframe
+        Consecutive chunks of the first sheet, read with openpyxl in read-only mode
+
+    """
+    import openpyxl
+    wb = openpyxl.load_workbook(path, read_only = True, data_only = True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only = True)
+        header = list(next(rows, []))
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == chunksize:
+                yield pd.DataFrame(batch, columns = header).infer_objects()
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns = header).infer_objects()
+    finally:
+        wb.close()
+
+
+class ChunkedRules():
+    """
+    Per-ID aggregate flags of the rules on one dataset, accumulated over chunks of the dataset.
+
+    Offense rules keep whether an ID has any row with a selected offense and any row without one, enhancement rules whether it has any row with more than one and any row with at least one selected enhancement, and sentence rules the minimum and maximum per ID. These flags are all the kernels need, so the results are identical to evaluating the whole table while memory is bounded by the chunk size.
+    """
+    def __init__(self, rules, prefix, n_ids):
+        self.rules = list(rules)
+        self.prefix = prefix
+        self.present = np.zeros(n_ids, dtype = bool)
+        self.flags = {}
+        for i, rule in enumerate(self.rules):
+            if rule.kind == 'sentence':
+                self.flags[i] = [np.full(n_ids, np.nan), np.full(n_ids, np.nan)]
+            else:
+                self.flags[i] = [np.zeros(n_ids, dtype = bool), np.zeros(n_ids, dtype = bool)]
+
+    def update(self, chunk, id_codes):
+        """
+
+        Parameters
+        ----------
+        chunk : pandas dataframe
+            Chunk of the dataset
+        id_codes : numpy array
+            Integer ID code of each row of the chunk, -1 for missing or unknown IDs
+
+        Returns
+        -------
+        None
+            Adds the rows of the chunk to the per-ID flags
+
+        """
+        valid = id_codes >= 0
+        ids = id_codes[valid]
+        self.present[ids] = True
+        for i, rule in enumerate(self.rules):
+            lo, hi = self.flags[i]
+            if rule.kind == 'sentence':
+                values = pd.to_numeric(pd.Series(np.asarray(chunk[rule.columns[0]])), errors = 'coerce').to_numpy(dtype = float)[valid]
+                keep = ~np.isnan(values)
+                np.fmin.at(lo, ids[keep], values[keep])
+                np.fmax.at(hi, ids[keep], values[keep])
+            elif rule.kind == 'offense':
+                values = normalize_column(chunk[rule.columns[0]], prefix = self.prefix)
+                hit = selected_values(rule.selection, values.categories)[values.codes][valid]
+                lo[ids[hit]] = True
+                hi[ids[~hit]] = True
+            elif rule.kind == 'enhancement':
+                index = EnhancementIndex(id_codes = id_codes,
+                                         values = [normalize_column(chunk[c], prefix = self.prefix) for c in rule.columns],
+                                         n_ids = len(self.present),
+                                         nan_value = utils.strip_clean(np.nan))
+                counts = index.selected_per_row(rule.selection)[valid]
+                lo[ids[counts > 1]] = True
+                hi[ids[counts > 0]] = True
+        return
+
+    def disqualified(self, rule):
+        """
+
+        Parameters
+        ----------
+        rule : rules.Rule
+            One of the rules passed when the flags were created
+
+        Returns
+        -------
+        numpy array
+            Boolean mask over the shared ID codes of the IDs disqualified by the rule, as returned by CohortGenerator.evaluate_rule()
+
+        """
+        lo, hi = self.flags[self.rules.index(rule)]
+        out = np.zeros(len(self.present), dtype = bool)
+        if rule.kind == 'sentence':
+            # Bounds that are 0 or None are not applied, NaN bounds never fall outside of a range
+            with np.errstate(invalid = 'ignore'):
+                if rule.max_length:
+                    out |= hi > rule.max_length
+                if rule.min_length:
+                    out |= lo < rule.min_length
+            return out
+        if rule.how == "Exclude":
+            # Offense rules: any selected offense. Enhancement rules: any row with more than one selected enhancement
+            return lo.copy()
+        elif rule.how == "Include":
+            # Offense rules: any offense outside of the selection. Enhancement rules: no row with a selected enhancement
+            return hi.copy() if rule.kind == 'offense' else self.present & ~hi
+        print("Selection logic not understood")
+        return out
@@ -4,41 +4,49 @@ from tqdm import tqdm
 import datetime
 import utils
 from dateutil.relativedelta import relativedelta
-import impl
-import traceback
-import sys
+import rules
+from indexes import OffenseIndex, SentenceIndex, EnhancementIndex, normalize_column
+from offense_codes import ParsedCodes, selected_values
 import os
+from datastore import DataStore
+import encode
+import cache
+import export
+import workers
+import sql
+import incremental
+from chunked import ChunkedRules, read_chunks
+import numpy as np
+import json
 
 class CohortGenerator():
-    def __init__(self, label = "", desc = ""):
+    def __init__(self, label = "", desc = "", store : DataStore = None):
         self.label = label
         self.desc = desc
-        # Add cache for loaded data to improve speed
-        self._data_cache = {}
+        # Loaded data is held in a store that can be shared by several cohorts (a private one by default)
+        self.store = store if store is not None else DataStore()
         
-    def get_raw_data(self, input_data_path : dict, id_var : str, clean_col_names : bool):
+    def get_raw_data(self, input_data_path : dict, id_var : str, clean_col_names : bool, cache_dir : str = None, encode_data : bool = True, stream : list = None, chunksize : int = 100000, usecols : dict = None):
+        # Only the columns in usecols are loaded for the datasets it lists (see get_required_columns). The ID column is always loaded
+        usecols = {cat: [id_var]+list(cols) for cat, cols in (usecols or {}).items()}
+        # Datasets in stream, e.g. the commitment tables, are never loaded. Their rules are evaluated chunk by chunk when the ruleset is applied
+        self.streamed_data_path = {cat: input_data_path[cat] for cat in (stream or []) if cat in input_data_path}
+        self.stream_options = {'chunksize': chunksize, 'clean_col_names': clean_col_names}
+        self.stream_columns = {cat: usecols[cat] for cat in self.streamed_data_path.keys() if cat in usecols}
+        input_data_path = {cat: path for cat, path in input_data_path.items() if cat not in self.streamed_data_path}
+        self.input_data_path = input_data_path
         # Load all data and clean column names if required
         for cat in input_data_path.keys():
-            # Check if data is already cached to avoid reloading
-            cache_key = f"{cat}_{input_data_path[cat]}"
-            
-            if cache_key in self._data_cache:
-                setattr(self, cat+"_raw", self._data_cache[cache_key].copy())
-            else:
-                data = utils.load_data(input_data_path[cat])
-                setattr(self, cat+"_raw", data)
-                self._data_cache[cache_key] = data.copy()  # Cache the data
-                print('Loaded and cached raw data in path: ', input_data_path[cat])
+            # The store only loads each file once and hands out views that share its memory
+            setattr(self, cat+"_raw", self.store.get_table(input_data_path[cat], clean_col_names = clean_col_names, cache_dir = cache_dir, columns = usecols.get(cat)))
+            print('Retrieved raw data in path: ', input_data_path[cat])
                 
         print("\n")
         
-        # Clean col names if requested 
+        # Column names were cleaned when the tables were loaded, see DataStore.get_table()
         if clean_col_names: 
             for cat in input_data_path.keys(): 
-                df = getattr(self, cat+"_raw")
-                df.columns = utils.clean_var_names(list(df.columns), rem = ["\n"])
-                print(f"For dataset {cat}, cleaned columns and set new values: {df.columns}")
-                setattr(self, cat+"_raw", df)
+                print(f"For dataset {cat}, cleaned columns and set new values: {getattr(self, cat+'_raw').columns}")
         print("\n")   
         
         # Clean ID variable 
@@ -56,8 +64,246 @@ class CohortGenerator():
             self.id = id_var
         else: 
             self.id = None
+        
+        # Encode IDs and offense codes as integers shared across all datasets
+        if encode_data and self.id:
+            self.encode_data(input_data_path = input_data_path)
         return 
     
+    def get_sql_data(self, db_path : str, tables : dict, id_var : str, clean_col_names : bool, encode_data : bool = True):
+        # Load tables of a SQLite database instead of files, e.g. to check the SQL backend against the pandas engine. tables maps each data category to its table
+        con = sql.connect(db_path)
+        try:
+            for cat, table in tables.items():
+                setattr(self, cat+"_raw", sql.read_table(con, table))
+                print(f"Retrieved raw data in table {table} of database: {db_path}")
+        finally:
+            con.close()
+        self.input_data_path = {cat: f"{db_path}::{table}" for cat, table in tables.items()}
+        self.streamed_data_path = {}
+        if clean_col_names:
+            for cat in tables.keys():
+                getattr(self, cat+"_raw").columns = utils.clean_var_names(list(getattr(self, cat+"_raw").columns), rem = ["\n"])
+        id_var = utils.clean(id_var, remove = None) if clean_col_names else id_var
+        self.id = id_var if all(id_var in getattr(self, cat+"_raw") for cat in tables.keys()) else None
+        self.id_dictionary = None
+        if encode_data and self.id:
+            self.encode_data(input_data_path = self.input_data_path)
+        return
+    
+    def encode_data(self, input_data_path : dict, categorical_cols : dict = None):
+        # Encoded tables are kept in the store so that cohorts sharing the same extracts also share the encoding
+        key = ('encoded', self.id, tuple((cat, input_data_path[cat], tuple(getattr(self, cat+"_raw").columns)) for cat in input_data_path.keys()), 
+               str(categorical_cols), tuple(getattr(self, 'streamed_data_path', {}).items()))
+        
+        def build():
+            raw = {cat: getattr(self, cat+"_raw") for cat in input_data_path.keys()}
+            # Single integer code space for IDs across all datasets, including the datasets that are streamed
+            dictionary = encode.build_id_dictionary(list(raw.values())+self.get_streamed_ids(), self.id)
+            tables = {}
+            for cat, df in raw.items():
+                df = encode.encode_ids(df, self.id, dictionary)
+                # Offense, enhancement and other repetitive text columns are stored as categoricals
+                if categorical_cols and (cat in categorical_cols):
+                    cols = categorical_cols[cat]
+                else:
+                    cols = encode.find_categorical_cols(df, exclude = [self.id])
+                tables[cat] = encode.encode_categoricals(df, cols)
+            # Original dtypes are kept to decode the qualifying records
+            return {'dictionary': dictionary, 'tables': tables, 'dtypes': {cat: df.dtypes.to_dict() for cat, df in raw.items()}}
+        
+        encoded = self.store.get_derived(key, build)
+        self.id_dictionary = encoded['dictionary']
+        self.raw_dtypes = encoded['dtypes']
+        # No IDs are disqualified until rules are applied
+        self.disqual_mask = np.zeros(len(self.id_dictionary), dtype = bool)
+        for cat in input_data_path.keys():
+            setattr(self, cat+"_raw", self.store.view(encoded['tables'][cat]))
+        print(f"Encoded {len(self.id_dictionary)} IDs shared across datasets: {list(input_data_path.keys())}")
+        return
+    
+    def get_streamed_ids(self):
+        # Distinct IDs of each streamed dataset, read in a first pass over the ID column only, so that streamed records are evaluated over the same ID codes as loaded ones
+        ids = []
+        for cat, path in getattr(self, 'streamed_data_path', {}).items():
+            uniq = set()
+            for chunk in read_chunks(path, columns = [self.id], **self.stream_options):
+                if self.id not in chunk:
+                    print("ID not available in dataset: ", cat)
+                    break
+                uniq.update(pd.unique(chunk[self.id].dropna()))
+            ids.append(pd.DataFrame({self.id: pd.Series(list(uniq), dtype = object)}))
+        return ids
+    
+    def get_id_dictionary(self):
+        # Build the shared ID dictionary from all raw and streamed datasets if the data was not encoded when loaded
+        if getattr(self, 'id_dictionary', None) is None:
+            raw = [v for k, v in vars(self).items() if k.endswith('_raw') and isinstance(v, pd.DataFrame) and (self.id in v)]
+            self.id_dictionary = encode.build_id_dictionary(raw+self.get_streamed_ids(), self.id)
+        return self.id_dictionary
+    
+    def get_id_codes(self, df : pd.DataFrame):
+        # Integer ID codes of each row in the shared code space
+        return encode.id_codes(df, self.id, self.get_id_dictionary())
+    
+    @property
+    def disqual_ids(self):
+        # Disqualified IDs are held as a boolean mask over the shared ID codes and only listed on request
+        return list(self.get_id_dictionary()[np.flatnonzero(self.disqual_mask)])
+    
+    @disqual_ids.setter
+    def disqual_ids(self, ids):
+        dictionary = self.get_id_dictionary()
+        self.disqual_mask = np.zeros(len(dictionary), dtype = bool)
+        codes = dictionary.get_indexer(list(ids))
+        self.disqual_mask[codes[codes >= 0]] = True
+    
+    def get_disqualified_rows(self, df : pd.DataFrame):
+        # Boolean per row: True if the ID of the row has been disqualified. Rows without a known ID are never disqualified
+        codes = self.get_id_codes(df)
+        return np.where(codes >= 0, self.disqual_mask[codes], False)
+    
+    def get_population_mask(self, data : str):
+        # Boolean mask over the shared ID codes of the IDs present in a dataset
+        codes = self.get_id_codes(getattr(self, data))
+        mask = np.zeros(len(self.get_id_dictionary()), dtype = bool)
+        mask[codes[codes >= 0]] = True
+        return mask
+    
+    def get_qualifying_ids(self, data : str):
+        # IDs of a dataset that have not been disqualified by the rules applied thus far
+        return list(self.get_id_dictionary()[np.flatnonzero(self.get_population_mask(data) & ~self.disqual_mask)])
+    
+    def add_disqualified(self, disqual_codes : np.ndarray, pop_ids : str):
+        # Join the new disqualifying ID codes with the existing disqualifying mask
+        self.disqual_mask[disqual_codes] = True
+        pop = self.get_population_mask(pop_ids)
+        n_disqual = np.count_nonzero(pop & self.disqual_mask)
+        print(f"Number of resultant qualifying IDs from all rules applied thus far is {np.count_nonzero(pop)} - {n_disqual} = {np.count_nonzero(pop) - n_disqual}")
+        return self.disqual_mask
+    
+    def get_id_shards(self, n_shards : int):
+        # Shard of each ID code from a stable hash of the ID value, identical across processes and runs
+        ids = np.asarray(self.get_id_dictionary(), dtype = object)
+        return (pd.util.hash_array(ids) % np.uint64(n_shards)).astype(np.int64)
+    
+    def get_shard(self, shard : int, n_shards : int):
+        # Cohort restricted to the IDs of one shard. Rows without a known ID are kept in the first shard only
+        shard_codes = np.flatnonzero(self.get_id_shards(n_shards) == shard)
+        return self.get_subset(shard_codes, label = f"{self.label} (shard {shard} of {n_shards})", keep_missing = (shard == 0))
+    
+    def get_subset(self, subset_codes : np.ndarray, label : str = None, keep_missing : bool = False):
+        # Cohort restricted to some IDs, with its own ID dictionary. Rules only combine rows of the same ID, so any subset of IDs is evaluated independently of the others
+        n_ids = len(self.get_id_dictionary())
+        # Subset code of each shared ID code, -1 for other IDs and for missing IDs
+        remap = np.full(n_ids+1, -1, dtype = np.int64)
+        remap[subset_codes] = np.arange(len(subset_codes))
+        cohort = CohortGenerator(label = label if label is not None else self.label, desc = self.desc)
+        cohort.id = self.id
+        cohort.input_data_path = dict(self.input_data_path)
+        cohort.id_dictionary = self.get_id_dictionary()[subset_codes]
+        cohort.shard_codes = subset_codes
+        cohort.disqual_mask = np.zeros(len(subset_codes), dtype = bool)
+        for attr in ['offense_categories', 'ruleset', 'raw_dtypes']:
+            if hasattr(self, attr):
+                setattr(cohort, attr, getattr(self, attr))
+        for cat in self.input_data_path.keys():
+            df = getattr(self, cat+"_raw")
+            codes = self.get_id_codes(df)
+            rows = np.flatnonzero(np.where(codes >= 0, remap[codes] >= 0, keep_missing))
+            df = df.iloc[rows].copy(deep = False)
+            df[self.id] = pd.Categorical.from_codes(remap[codes[rows]], categories = cohort.id_dictionary)
+            setattr(cohort, cat+"_raw", df)
+        # Streamed datasets are read chunk by chunk and only the rows of the subset are kept, so the whole table is never held in memory
+        for cat, path in getattr(self, 'streamed_data_path', {}).items():
+            parts = []
+            for chunk in read_chunks(path, columns = self.stream_columns.get(cat), **self.stream_options):
+                codes = self.get_id_dictionary().get_indexer(chunk[self.id])
+                rows = np.flatnonzero(np.where(codes >= 0, remap[codes] >= 0, keep_missing))
+                chunk = chunk.iloc[rows].reset_index(drop = True)
+                chunk[self.id] = pd.Categorical.from_codes(remap[codes[rows]], categories = cohort.id_dictionary)
+                parts.append(chunk)
+            setattr(cohort, cat+"_raw", pd.concat(parts, ignore_index = True))
+            cohort.input_data_path[cat] = path
+        return cohort
+    
+    def get_data_key(self, data : str):
+        # Identifies a raw dataset across cohorts sharing the same store: its source and columns
+        df = getattr(self, data)
+        cat = data[:-len("_raw")] if data.endswith("_raw") else data
+        source = getattr(self, 'input_data_path', {}).get(cat, id(df))
+        return (cat, source, tuple(df.columns))
+    
+    def get_id_fingerprint(self):
+        # Content hash of the shared ID dictionary. Derived indexes hold ID codes, so they are only valid for the dictionary they were built with
+        dictionary = self.get_id_dictionary()
+        if getattr(self, '_id_fingerprint', (None, None))[0] is not dictionary:
+            self._id_fingerprint = (dictionary, incremental.frame_hash(dictionary.to_frame(index = False)))
+        return self._id_fingerprint[1]
+    
+    def get_categories_fingerprint(self):
+        # Content hash of the offense categorizations, so that compiled criteria and indexes are never reused for other categorizations
+        return incremental.frame_hash(self.offense_categories)
+    
+    def get_normalized(self, data : str, column : str, prefix : str, remove : list = ['pc', 'rape', '\n', ' ']):
+        # Cleaned values of an offense or enhancement column as a categorical, computed once per dataset, column, prefix and removed values
+        key = ('normalized', self.get_data_key(data), column, prefix, tuple(remove))
+        
+        def build():
+            print(f"Cleaning column {column} in {data}")
+            return normalize_column(getattr(self, data)[column], prefix = prefix, remove = remove)
+        
+        return self.store.get_derived(key, build)
+    
+    def get_parsed_codes(self, data : str, column : str, prefix : str):
+        # Parsed fields (section, attempt flag, degree, modifiers) of the cleaned values of a column, kept next to the dataset
+        key = ('parsed_codes', self.get_data_key(data), column, prefix)
+        
+        def build():
+            print(f"Parsing offense codes of column {column} in {data}")
+            values = self.get_normalized(data = data, column = column, prefix = prefix)
+            return ParsedCodes(values.categories, values.codes)
+        
+        return self.store.get_derived(key, build)
+    
+    def get_offense_index(self, data : str, offense_var : str, prefix : str, implications : str, match : str = 'exact'):
+        # Per-ID offense category bitsets, built once per dataset, ID dictionary, column, prefix, implications, match mode and categorizations
+        key = ('offense_index', self.get_data_key(data), self.get_id_fingerprint(), offense_var, prefix, implications, match, self.get_categories_fingerprint())
+        
+        def build():
+            print(f"Building offense category index for column {offense_var} in {data}")
+            return OffenseIndex(id_codes = self.get_id_codes(getattr(self, data)), 
+                                values = self.get_normalized(data = data, column = offense_var, prefix = prefix), 
+                                n_ids = len(self.get_id_dictionary()), 
+                                type_selections = rules.resolve_type_selections(self.offense_categories, json.loads(implications), match), 
+                                parsed = self.get_parsed_codes(data = data, column = offense_var, prefix = prefix) if match == 'structured' else None)
+        
+        return self.store.get_derived(key, build)
+    
+    def get_sentence_index(self, data : str, sentence_var : str):
+        # Per-ID minimum and maximum of a numeric column, built once per dataset, ID dictionary and column
+        key = ('sentence_index', self.get_data_key(data), self.get_id_fingerprint(), sentence_var)
+        
+        def build():
+            print(f"Building range index for column {sentence_var} in {data}")
+            df = getattr(self, data)
+            return SentenceIndex(id_codes = self.get_id_codes(df), data = df[sentence_var], n_ids = len(self.get_id_dictionary()))
+        
+        return self.store.get_derived(key, build)
+    
+    def get_enhancement_index(self, data : str, enh_var : list, prefix : str):
+        # Long (row, enhancement) table of the enhancement columns, built once per dataset, ID dictionary, columns and prefix
+        key = ('enhancement_index', self.get_data_key(data), self.get_id_fingerprint(), tuple(enh_var), prefix)
+        
+        def build():
+            print(f"Building enhancement index for columns {enh_var} in {data}")
+            return EnhancementIndex(id_codes = self.get_id_codes(getattr(self, data)), 
+                                    values = [self.get_normalized(data = data, column = ev, prefix = prefix) for ev in enh_var], 
+                                    n_ids = len(self.get_id_dictionary()), 
+                                    nan_value = utils.strip_clean(np.nan))
+        
+        return self.store.get_derived(key, build)
+    
     def get_offense_categorizations(self, categories_data_path : str):
         if 'csv' in categories_data_path:
             self.offense_categories = pd.read_csv(categories_data_path)
@@ -67,6 +313,10 @@ class CohortGenerator():
             print('Input offense categories could not be understood')  
         return
     
+    def get_required_columns(self, clean_col_names : bool, off_enh_cols : list = None):
+        # Columns queried by the ruleset for each dataset, to be passed to get_raw_data as usecols
+        return rules.required_columns(self.ruleset, clean_col_names = clean_col_names, off_enh_cols = off_enh_cols)
+    
     def get_ruleset(self, ruleset : dict):
         self.ruleset = ruleset
         return
@@ -75,92 +325,48 @@ class CohortGenerator():
         return list(getattr(self, data)[self.id].unique())
 
     def apply_enhancement_rules(self, data : str, sel_enh : list, how : str, prefix : str, enh_var : list, pop_ids : str):       
-        # Get the appropriate raw dataset
-        df = getattr(self, data)
-        # Rule specific disqualifying IDs
-        disqual_ids = []
+        # Long (row, enhancement) index of the enhancement columns
+        index = self.get_enhancement_index(data = data, enh_var = enh_var, prefix = prefix)
         # Get the qualifying IDs thus far in the rule application process
-        qual_ids = list(set(df[self.id].unique()).difference(set(self.disqual_ids)))
-        df = df[df[self.id].isin(qual_ids)]
-
-        for ev in enh_var:
-            # Remove prefix 
-            df.loc[:, ev] = df[ev].str.replace(prefix, "")
-            # Clean the column data 
-            df.loc[:, ev] = utils.clean_blk(data = df[ev], remove = ['pc', 'rape', '\n', ' '])
+        qual = index.present & ~self.disqual_mask
+        print(f"Processing {np.count_nonzero(qual)} IDs that are present in the dataset")
+        # Rule specific disqualifying ID codes
+        disqual_codes = np.array([], dtype = int)
+        # Only the IDs that still qualify are evaluated
+        disqual = index.disqualified(sel = sel_enh, how = how, ids = np.flatnonzero(qual))
+        if disqual is not None:
+            disqual_codes = np.flatnonzero(disqual & qual)
         
-        # Combine all columns into a single one
-        df['off enh'] = df.apply(lambda row: row[enh_var].dropna().tolist(), axis=1)
-        
-        # Optimize for large datasets - use vectorized operations instead of groupby loop
-        print(f"Processing {len(df)} records for {len(df[self.id].unique())} IDs that are present in the dataset")
-        
-        if len(sel_enh) >= 0:
-            # Get the offense variable in the dataset that best matches the offense indicator 
-            if how == "Exclude":
-                # Vectorized approach: check if any offense in sel_off is present for each ID
-                df_subset = df[[self.id, 'off enh']].copy()
-                df_subset['has_target_enh'] = df_subset.apply(lambda row: list(set(row['off enh']).intersection(set(sel_enh))), axis=1)
-                # Group by ID and check if any offense matches
-                id_has_enh = df_subset.groupby(self.id)['has_target_enh'].apply(lambda x: any(len(v) > 1 for v in x))
-                disqual_ids = id_has_enh[id_has_enh].index.tolist()
-                
-            elif how == "Include":
-                # Vectorized approach: check if all offenses are in sel_off for each ID
-                df_subset = df[[self.id, 'off enh']].copy()
-                df_subset['has_target_enh'] = df_subset.apply(lambda row: list(set(row['off enh']).intersection(set(sel_enh))), axis=1)
-                # Group by ID and check if any offense does NOT match
-                id_has_non_target = df_subset.groupby(self.id)['has_target_enh'].apply(lambda x: all(len(v) == 0 for v in x))
-                disqual_ids = id_has_non_target[id_has_non_target].index.tolist()
-                
-            else: 
-                print("Selection logic not understood")
-        
-        else:
-            print("Enhancement selection cannot be done as list of eligible or ineligible offenses loaded is empty")
-        
-        print(f"Identified {len(disqual_ids)} disqualifying IDs from {len(qual_ids)} IDs")
+        print(f"Identified {len(disqual_codes)} disqualifying IDs from {np.count_nonzero(qual)} IDs")
         # Add to the cohort's disqualifying IDs
-        self.disqual_ids = list(set.union(set(self.disqual_ids), set(disqual_ids)))
-        print(f"Number of resultant qualifying IDs from all rules applied thus far is {len(self.get_population_ids(pop_ids))} - {len(self.disqual_ids)} = {len(self.get_population_ids(pop_ids)) - len(self.disqual_ids)}")
-        
-        return self.disqual_ids
+        return self.add_disqualified(disqual_codes, pop_ids)
     
     def apply_offense_rules(self, data : str, sel_off : list, how : str, prefix : str, offense_var : str, pop_ids : str):       
         # Get the appropriate raw dataset
         df = getattr(self, data)
-        # Rule specific disqualifying IDs
-        disqual_ids = []
+        # Rule specific disqualifying ID codes
+        disqual_codes = np.array([], dtype = int)
         # Get the qualifying IDs thus far in the rule application process
-        qual_ids = list(set(df[self.id].unique()).difference(set(self.disqual_ids)))
-        df = df[df[self.id].isin(qual_ids)]
-
-        # Remove prefix 
-        df.loc[:, offense_var] = df[offense_var].str.replace(prefix, "")
-        
-        # Clean the column data 
-        df.loc[:, offense_var] = utils.clean_blk(data = df[offense_var], remove = ['pc', 'rape', '\n', ' '])
+        codes = self.get_id_codes(df)
+        qual_rows = (codes >= 0) & ~self.disqual_mask[codes]
+        # Integer ID codes of the qualifying rows
+        codes = codes[qual_rows]
         
         # Optimize for large datasets - use vectorized operations instead of groupby loop
-        print(f"Processing {len(df)} records for {len(df[self.id].unique())} IDs that are present in the dataset")
+        print(f"Processing {np.count_nonzero(qual_rows)} records for {len(np.unique(codes))} IDs that are present in the dataset")
         
-        if len(sel_off) >= 0:
+        if sel_off is not None:
+            # Check if each distinct cleaned offense value is selected, using the cached cleaned column
+            values = self.get_normalized(data = data, column = offense_var, prefix = prefix)
+            has_target_offense = selected_values(sel_off, values.categories)[values.codes][qual_rows]
             # Get the offense variable in the dataset that best matches the offense indicator 
             if how == "Exclude":
-                # Vectorized approach: check if any offense in sel_off is present for each ID
-                df_subset = df[[self.id, offense_var]].copy()
-                df_subset['has_target_offense'] = df_subset[offense_var].isin(sel_off)
-                # Group by ID and check if any offense matches
-                id_has_offense = df_subset.groupby(self.id)['has_target_offense'].any()
-                disqual_ids = id_has_offense[id_has_offense].index.tolist()
+                # Disqualify IDs with any offense in sel_off
+                disqual_codes = np.unique(codes[has_target_offense])
                 
             elif how == "Include":
-                # Vectorized approach: check if all offenses are in sel_off for each ID
-                df_subset = df[[self.id, offense_var]].copy()
-                df_subset['has_target_offense'] = df_subset[offense_var].isin(sel_off)
-                # Group by ID and check if any offense does NOT match
-                id_has_non_target = df_subset.groupby(self.id)['has_target_offense'].apply(lambda x: not x.all())
-                disqual_ids = id_has_non_target[id_has_non_target].index.tolist()
+                # Disqualify IDs with any offense NOT in sel_off
+                disqual_codes = np.unique(codes[~has_target_offense])
                 
             else: 
                 print("Selection logic not understood")
@@ -168,242 +374,411 @@ class CohortGenerator():
         else:
             print("Offense selection cannot be done as list of eligible or ineligible offenses loaded is empty")
         
-        print(f"Identified {len(disqual_ids)} disqualifying IDs from {len(qual_ids)} IDs")
+        print(f"Identified {len(disqual_codes)} disqualifying IDs from {len(np.unique(codes))} IDs")
         # Add to the cohort's disqualifying IDs
-        self.disqual_ids = list(set.union(set(self.disqual_ids), set(disqual_ids)))
-        print(f"Number of resultant qualifying IDs from all rules applied thus far is {len(self.get_population_ids(pop_ids))} - {len(self.disqual_ids)} = {len(self.get_population_ids(pop_ids)) - len(self.disqual_ids)}")
+        return self.add_disqualified(disqual_codes, pop_ids)
+    
+    def apply_offense_category_rules(self, data : str, types : list, implications : str, how : str, prefix : str, offense_var : str, pop_ids : str, match : str = 'exact'):
+        # Per-ID offense category bitsets of the dataset
+        index = self.get_offense_index(data = data, offense_var = offense_var, prefix = prefix, implications = implications, match = match)
+        # Get the qualifying IDs thus far in the rule application process
+        qual = index.present & ~self.disqual_mask
+        print(f"Processing {np.count_nonzero(qual)} IDs that are present in the dataset")
+        # Rule specific disqualifying ID codes
+        disqual_codes = np.array([], dtype = int)
+        # Only the IDs that still qualify are evaluated
+        disqual = index.disqualified(types = types, how = how, ids = np.flatnonzero(qual))
+        if disqual is not None:
+            disqual_codes = np.flatnonzero(disqual & qual)
         
-        return self.disqual_ids
+        print(f"Identified {len(disqual_codes)} disqualifying IDs from {np.count_nonzero(qual)} IDs")
+        # Add to the cohort's disqualifying IDs
+        return self.add_disqualified(disqual_codes, pop_ids)
     
     def apply_sentence_length_rules(self, data : str, sentence_var : str, max_length : int, min_length : int, pop_ids : str):
-        # Get the appropriate raw dataset
-        df = getattr(self, data)
+        # Sorted per-ID range index of the column
+        index = self.get_sentence_index(data = data, sentence_var = sentence_var)
         # Get the qualifying IDs thus far in the rule application process
-        qual_ids = list(set(df[self.id].unique()).difference(set(self.disqual_ids)))
-        df = df[df[self.id].isin(qual_ids)]
-        # Rule specific disqualifying IDs
-        disqual_ids = []
-        if not max_length: 
-            max_length = df[sentence_var].max()
-        if not min_length: 
-            min_length = df[sentence_var].min()
-        # Disqualifying IDs - opposite of criteria
+        qual = index.present & ~self.disqual_mask
+        # Disqualifying IDs - opposite of criteria. Bounds that are not set are not applied
         print(f"Finding IDs that are outside of the defined range: {max_length} to {min_length}")
-        disqual_ids = df[(df[sentence_var] > max_length) | (df[sentence_var] < min_length)][self.id].unique()
-        # Add to the cohort's disqualifying IDs
-        print(f"Identified {len(disqual_ids)} disqualifying IDs from {len(qual_ids)} IDs")
-        # Join the new disqualifying IDs with the existing disqualifying list
-        self.disqual_ids = list(set.union(set(self.disqual_ids), set(disqual_ids)))
-        print(f"Number of resultant qualifying IDs from all rules applied thus far is {len(self.get_population_ids(pop_ids))} - {len(self.disqual_ids)} = {len(self.get_population_ids(pop_ids)) - len(self.disqual_ids)}")
-
-        return self.disqual_ids
-        
-    def apply_ruleset(self, prefix : str, clean_col_names : bool, pop_ids : str, use_t_cols : list, off_enh_cols : list):
-        # Initial empty list for disqualifying IDs that will be shared across all rules
-        self.disqual_ids = []
+        disqual_codes = np.flatnonzero(index.disqualified(min_length = min_length, max_length = max_length, ids = np.flatnonzero(qual)) & qual)
+        print(f"Identified {len(disqual_codes)} disqualifying IDs from {np.count_nonzero(qual)} IDs")
+        # Join the new disqualifying IDs with the existing disqualifying mask
+        return self.add_disqualified(disqual_codes, pop_ids)
+    
+    def get_criteria_cache(self):
+        # Compiled criteria are reused across rulesets as long as the offense categorizations are unchanged
+        key = self.get_categories_fingerprint()
+        if getattr(self, '_criteria_cache_key', None) != key:
+            self._criteria_cache = {}
+            self._criteria_cache_key = key
+        return self._criteria_cache
+    
+    def compile_ruleset(self, clean_col_names : bool, off_enh_cols : list = None):
+        # Compile the ruleset into an immutable plan once and reuse it as long as the ruleset and categorizations are unchanged
+        key = (rules.canonical(self.ruleset), self.get_categories_fingerprint(), clean_col_names, tuple(off_enh_cols or []))
+        if getattr(self, '_plan_key', None) != key:
+            self.plan = rules.compile_ruleset(ruleset = self.ruleset, 
+                                              offense_categories = self.offense_categories, 
+                                              clean_col_names = clean_col_names, 
+                                              off_enh_cols = off_enh_cols, 
+                                              cache = self.get_criteria_cache())
+            self._plan_key = key
+        return self.plan
+    
+    def is_streamed(self, data : str):
+        # True if the dataset is read in chunks instead of being loaded
+        cat = data[:-len("_raw")] if data.endswith("_raw") else data
+        return cat in getattr(self, 'streamed_data_path', {})
+    
+    def evaluate_streamed(self, plan : tuple, prefix : str):
+        # Disqualified IDs of each rule on streamed datasets. Each dataset is read once, chunk by chunk, for all of its rules
+        masks = {}
+        for data in dict.fromkeys(rule.data_label for rule in plan):
+            cat = data[:-len("_raw")]
+            data_rules = [rule for rule in plan if rule.data_label == data]
+            flags = ChunkedRules(data_rules, prefix = prefix, n_ids = len(self.get_id_dictionary()))
+            n_rows = 0
+            for chunk in read_chunks(self.streamed_data_path[cat], columns = self.stream_columns.get(cat), **self.stream_options):
+                # The shared ID dictionary holds the IDs of the streamed datasets too, see get_streamed_ids
+                flags.update(chunk, self.get_id_dictionary().get_indexer(chunk[self.id]))
+                n_rows += len(chunk)
+            print(f"Processed {n_rows} records of {cat} in chunks of {self.stream_options['chunksize']} rows for {len(data_rules)} criteria")
+            for rule in data_rules:
+                masks[rule] = flags.disqualified(rule)
+        return [masks[rule] for rule in plan]
+    
+    def execute_plan(self, plan : tuple, prefix : str, pop_ids : str, order : bool = True):
+        # Rules on streamed datasets are evaluated together in a single pass over each dataset
+        streamed = tuple(rule for rule in plan if self.is_streamed(rule.data_label))
+        plan = tuple(rule for rule in plan if not self.is_streamed(rule.data_label))
+        if streamed:
+            try:
+                for rule, mask in zip(streamed, self.evaluate_streamed(streamed, prefix = prefix)):
+                    print(f"Processing criteria type: {rule.name}")
+                    disqual_codes = np.flatnonzero(mask & ~self.disqual_mask)
+                    print(f"Identified {len(disqual_codes)} disqualifying IDs")
+                    self.add_disqualified(disqual_codes, pop_ids)
+                    print(f"Processing complete for criteria {rule.name}\n")
+            except Exception as e:
+                rules.print_error(e)
+        # Run cheap and selective rules first so that later rules only touch surviving IDs
+        if order:
+            plan = rules.order_rules(plan, {rule.data_label: getattr(self, rule.data_label, None) for rule in plan})
+        for rule in plan:
+            print(f"Processing criteria type: {rule.name}")
+            try:
+                kernel = getattr(self, rule.kernel)
+                if rule.kind == 'sentence':
+                    _ = kernel(data = rule.data_label, 
+                               sentence_var = rule.columns[0], 
+                               max_length = rule.max_length, 
+                               min_length = rule.min_length, 
+                               pop_ids = pop_ids)
+                elif rule.kind == 'offense':
+                    _ = kernel(data = rule.data_label, 
+                               types = rule.types, 
+                               implications = rule.implications, 
+                               match = rule.match, 
+                               how = rule.how, 
+                               prefix = prefix, 
+                               offense_var = rule.columns[0], 
+                               pop_ids = pop_ids)
+                elif rule.kind == 'enhancement':
+                    _ = kernel(data = rule.data_label, 
+                               how = rule.how, 
+                               prefix = prefix, 
+                               sel_enh = rule.selection, 
+                               enh_var = list(rule.columns), 
+                               pop_ids = pop_ids)
+            except Exception as e:
+                rules.print_error(e)
+            print(f"Processing complete for criteria {rule.name}\n")
+        return self.disqual_mask
         
-        # Process each criteria at a time
-        for criteria_type in self.ruleset['criteria'].keys():
-            print(f"Processing criteria type: {criteria_type}")
-            # For offense related queries
-            if ((("commit" in criteria_type) or ("offense" in criteria_type)) and ('enhancement' not in criteria_type)):
-                try:
-                    # Get the variable with offenses data
-                    offense_var = list(self.ruleset['criteria'][criteria_type].keys())[0]
-
-                    # Get the raw dataset with offenses to query
-                    data_label = self.ruleset['criteria'][criteria_type][offense_var]['data_label']+"_raw"
-                    print(f"Extracting data from file labeled: {data_label}")
-                    
-                    # Get the selected offenses from the ruleset. "Type" and "Offenses" are columns in the selection criteria
-                    sel_off = list(self.offense_categories[self.offense_categories["Type"].isin(self.ruleset['criteria'][criteria_type][offense_var]['types'])]["Offenses"])
-                    print(f"Found {len(sel_off)} offenses in the selected offense categories")
-                    
-                    # Get inputs: permuations
-                    try:
-                        perm = self.ruleset['criteria'][criteria_type][offense_var]['implications']['perm']
-                    except: 
-                        perm = None 
-                    # Get inputs: positions
-                    try:
-                        fix_pos = self.ruleset['criteria'][criteria_type][offense_var]['implications']['fix positions']
-                    except: 
-                        fix_pos = None
-                    # Get inputs: permuations
-                    try:
-                        placeholder = self.ruleset['criteria'][criteria_type][offense_var]['implications']['placeholder']
-                    except: 
-                        placeholder = None
-
-                    # Implied selections from permutations, etc. 
-                    sel_off = impl.gen_impl_off(offenses = sel_off, 
-                                                impl_rel = self.ruleset['criteria'][criteria_type][offense_var]['implications']['codes'],
-                                                perm = perm, 
-                                                fix_pos = fix_pos, 
-                                                placeholder = placeholder,
-                                                how = 'inclusive',
-                                                sep = '',
-                                                clean = True)
-                                        
-                    if len(sel_off) == 0: 
-                        print("No offense codes could be retrieved from the categorizations list. No offense related rules will be applied.")
-                    
-                    else: 
-                        # Get the logical query: Include, Exclude etc.
-                        how = self.ruleset['criteria'][criteria_type][offense_var]['mode']
-                        print(f"Selected column: {offense_var}; Raw dataset: {data_label}; Logic: {how}")
-                        
-                        # Clean col name from ruleset mapping
-                        if clean_col_names:
-                            offense_var = utils.clean_var_names(offense_var, rem = ["\n"])
-    
-                        # Apply the rules
-                        _ = self.apply_offense_rules(data = data_label, 
-                                                     how = how,
-                                                     prefix = prefix,
-                                                     sel_off = sel_off, 
-                                                     offense_var = offense_var, 
-                                                     pop_ids = pop_ids)     
-                except Exception as e:
-                    print(f"An error occurred: {e}")
-                    
-                    print("Full error description:\n")
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    trace = traceback.format_exception(exc_type, exc_value, exc_traceback)
-                    for line in trace:
-                        print(line, end="")
-                    pass  
-                    
-            # For sentence length related queries
-            elif "sentence" in criteria_type:
+    def execute_plan_parallel(self, plan : tuple, prefix : str, pop_ids : str, n_workers : int = None, shared_memory : bool = None):
+        # Exclusion is commutative, so each rule's disqualified IDs are computed independently in a process pool and unioned at the end
+        print(f"Processing {len(plan)} criteria in parallel")
+        disqual = np.zeros(len(self.disqual_mask), dtype = bool)
+        for rule, mask in zip(plan, workers.evaluate_rules(self, plan, prefix = prefix, n_workers = n_workers, shared_memory = shared_memory)):
+            if mask is not None:
+                print(f"Identified {np.count_nonzero(mask & ~self.disqual_mask)} disqualifying IDs for criteria {rule.name}")
+                disqual |= mask
+        self.add_disqualified(np.flatnonzero(disqual), pop_ids)
+        return self.disqual_mask
+    
+    def execute_plan_cached(self, plan : tuple, prefix : str, pop_ids : str, cache_dir : str, parallel : bool = False, n_workers : int = None, shared_memory : bool = None):
+        # Rules whose criterion, selection and input file are unchanged are read from the result cache. Exclusion is commutative, so the cached and new results are unioned
+        result_cache = cache.RuleResultCache(cache_dir)
+        keys, masks, todo = {}, {}, []
+        for rule in plan:
+            cat = rule.data_label[:-len("_raw")]
+            path = {**getattr(self, 'input_data_path', {}), **getattr(self, 'streamed_data_path', {})}.get(cat, "")
+            keys[rule] = result_cache.rule_key(rules.rule_fingerprint(rule), path, prefix = prefix, id = self.id)
+            ids = result_cache.load_ids(keys[rule]) if keys[rule] else None
+            if ids is not None:
+                codes = self.get_id_dictionary().get_indexer(ids)
+                masks[rule] = np.zeros(len(self.disqual_mask), dtype = bool)
+                masks[rule][codes[codes >= 0]] = True
+            else:
+                todo.append(rule)
+        print(f"Read {len(masks)} criteria from the result cache, processing {len(todo)} criteria")
+        if parallel and todo:
+            new = workers.evaluate_rules(self, tuple(todo), prefix = prefix, n_workers = n_workers, shared_memory = shared_memory)
+        else:
+            new = []
+            for rule in todo:
+                print(f"Processing criteria type: {rule.name}")
                 try:
-                    # Get the variable with sentence length data
-                    sentence_var = list(self.ruleset['criteria'][criteria_type].keys())[0]
-                    
-                    # Get other values
-                    data_label = self.ruleset['criteria'][criteria_type][sentence_var]['data_label']+"_raw"
-                    print(f"Extracting data from file labeled: {data_label}")
-                    max_length = self.ruleset['criteria'][criteria_type][sentence_var]['max']
-                    min_length = self.ruleset['criteria'][criteria_type][sentence_var]['min']
-                    print(f"Selected column: {sentence_var}; Raw dataset: {data_label}; Range: {min_length, max_length}")
-                    
-                    # Clean col name from ruleset mapping
-                    if clean_col_names:
-                        sentence_var = utils.clean_var_names(list(self.ruleset['criteria'][criteria_type].keys())[0], rem = ["\n"])
-                    
-                    # Apply the rules
-                    _ = self.apply_sentence_length_rules(data = data_label,
-                                                         sentence_var = sentence_var, 
-                                                         max_length = max_length,
-                                                         min_length = min_length, 
-                                                         pop_ids = pop_ids)   
+                    new.append(self.evaluate_rule(rule, prefix = prefix))
                 except Exception as e:
-                    print(f"An error occurred: {e}")
-                    print("Full error description:\n")
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    trace = traceback.format_exception(exc_type, exc_value, exc_traceback)
-                    for line in trace:
-                        print(line, end = "")
-                    pass      
-            
-            # For offense enhancements
-            elif 'enhancement' in criteria_type:
-                try:
-                    # Get the variable with offenses data
-                    enh_label = list(self.ruleset['criteria'][criteria_type].keys())[0]
-
-                    # Get the raw dataset with offenses to query
-                    data_label = self.ruleset['criteria'][criteria_type][enh_label]['data_label']+"_raw"
-                    print(f"Extracting data from file labeled: {data_label}")
-                    
-                    # Get the selected offenses from the ruleset. "Type" and "Offenses" are columns in the selection criteria
-                    sel_enh = list(self.offense_categories[self.offense_categories["Type"].isin(self.ruleset['criteria'][criteria_type][enh_label]['types'])]["Offenses"])
-                    print(f"Found {len(sel_enh)} offenses in the selected offense categories")
-                    
-                    # Get inputs: permuations
-                    try:
-                        perm = self.ruleset['criteria'][criteria_type][enh_label]['implications']['perm']
-                    except: 
-                        perm = None 
-                    # Get inputs: positions
-                    try:
-                        fix_pos = self.ruleset['criteria'][criteria_type][enh_label]['implications']['fix positions']
-                    except: 
-                        fix_pos = None
-                    # Get inputs: permuations
-                    try:
-                        placeholder = self.ruleset['criteria'][criteria_type][enh_label]['implications']['placeholder']
-                    except: 
-                        placeholder = None
-
-                    # Implied selections from permutations, etc. 
-                    sel_enh = impl.gen_impl_off(offenses = sel_enh, 
-                                                impl_rel = self.ruleset['criteria'][criteria_type][enh_label]['implications']['codes'],
-                                                perm = perm, 
-                                                fix_pos = fix_pos, 
-                                                placeholder = placeholder,
-                                                how = 'inclusive',
-                                                sep = '',
-                                                clean = True)
-                    
-                    print(f"Selected offenses with implied characters are: {sel_enh}")
-                    
-                    if len(sel_enh) == 0: 
-                        print("No offense codes could be retrieved from the categorizations list. No offense related rules will be applied.")
-                    
-                    else: 
-                        # Get the logical query: Include, Exclude etc.
-                        how = self.ruleset['criteria'][criteria_type][enh_label]['mode']
-                        print(f"Selected column: {enh_label}; Raw dataset: {data_label}; Logic: {how}")
-                        
-                        # Clean col name from ruleset mapping
-                        if clean_col_names:
-                            off_enh_cols = utils.clean_var_names(off_enh_cols, rem = ["\n"])
-    
-                        # Apply the rules
-                        _ = self.apply_enhancement_rules(data = data_label, 
-                                                         how = how,
-                                                         prefix = prefix,
-                                                         sel_enh = sel_enh, 
-                                                         enh_var = off_enh_cols, 
-                                                         pop_ids = pop_ids)     
-                except Exception as e:
-                    print(f"An error occurred: {e}")
-                    
-                    print("Full error description:\n")
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    trace = traceback.format_exception(exc_type, exc_value, exc_traceback)
-                    for line in trace:
-                        print(line, end="")
-                    pass  
-            
-            else: 
-                print("Cannot process criteria type. It is neither offense nor sentence related")
-            
-            print(f"Processing complete for criteria {criteria_type}\n")
+                    rules.print_error(e)
+                    new.append(None)
+        for rule, mask in zip(todo, new):
+            if mask is None:
+                continue
+            masks[rule] = mask
+            if keys[rule]:
+                result_cache.store_ids(keys[rule], list(self.get_id_dictionary()[np.flatnonzero(mask)]))
+        disqual = np.zeros(len(self.disqual_mask), dtype = bool)
+        for rule in plan:
+            if rule in masks:
+                print(f"Identified {np.count_nonzero(masks[rule] & ~self.disqual_mask)} disqualifying IDs for criteria {rule.name}")
+                disqual |= masks[rule]
+        self.add_disqualified(np.flatnonzero(disqual), pop_ids)
+        return self.disqual_mask
+    
+    def apply_ruleset_sharded(self, prefix : str, clean_col_names : bool, pop_ids : str, use_t_cols : list, off_enh_cols : list = None, n_shards : int = None, n_workers : int = None, shared_memory : bool = None):
+        # The population is split into shards by ID hash and the full ruleset is applied to each shard in a worker process
+        # Streamed datasets are never loaded here: each worker reads them and keeps the rows of its shard only (see get_subset)
+        self.disqual_ids = []
+        n_shards = n_shards or workers.n_workers_for(os.cpu_count() or 1, n_workers)
+        print(f"Processing the ruleset in {n_shards} shards")
+        disqual_codes = workers.evaluate_shards(self, 
+                                                n_shards = n_shards, 
+                                                n_workers = n_workers, 
+                                                shared_memory = shared_memory, 
+                                                prefix = prefix, 
+                                                clean_col_names = clean_col_names, 
+                                                pop_ids = pop_ids, 
+                                                use_t_cols = use_t_cols, 
+                                                off_enh_cols = off_enh_cols)
+        self.add_disqualified(disqual_codes, pop_ids)
         return
     
+    def apply_ruleset(self, prefix : str, clean_col_names : bool, pop_ids : str, use_t_cols : list, off_enh_cols : list = None, parallel : bool = False, n_workers : int = None, shared_memory : bool = None, result_cache_dir : str = None):
+        # Initial empty list for disqualifying IDs that will be shared across all rules
+        self.disqual_ids = []
+        # Compile the ruleset and apply the rules
+        plan = self.compile_ruleset(clean_col_names = clean_col_names, off_enh_cols = off_enh_cols)
+        if result_cache_dir:
+            self.execute_plan_cached(plan, prefix = prefix, pop_ids = pop_ids, cache_dir = result_cache_dir, parallel = parallel, n_workers = n_workers, shared_memory = shared_memory)
+        elif parallel:
+            self.execute_plan_parallel(plan, prefix = prefix, pop_ids = pop_ids, n_workers = n_workers, shared_memory = shared_memory)
+        else:
+            self.execute_plan(plan, prefix = prefix, pop_ids = pop_ids)
+        return
+    
+    def get_hashed_ids(self, data : str, id_map):
+        # Hashed ID of each row of a dataset from an idmap.IDMap, e.g. to link the cohort to the public hashed-ID datasets
+        return id_map.map_ids(getattr(self, data)[self.id])
+    
+    def get_row_hashes(self):
+        # Hash of the rows of each ID per dataset, indexed by ID, to find the IDs whose records changed between extracts
+        n_ids = len(self.get_id_dictionary())
+        hashes = {f"hash {cat}": incremental.id_row_hashes(getattr(self, cat+"_raw"), self.get_id_codes(getattr(self, cat+"_raw")), n_ids) for cat in self.input_data_path.keys()}
+        return pd.DataFrame(hashes, index = pd.Index(self.get_id_dictionary(), name = self.id))
+    
+    def apply_ruleset_incremental(self, state_dir : str, prefix : str, clean_col_names : bool, pop_ids : str, use_t_cols : list, off_enh_cols : list = None):
+        # Re-evaluate the ruleset only for IDs whose records were added, changed or removed since the run whose state is kept in state_dir
+        hashes = self.get_row_hashes()
+        tables = list(hashes.columns)
+        fingerprint = incremental.run_fingerprint(ruleset = rules.canonical(self.ruleset), 
+                                                  offense_categories = self.get_categories_fingerprint(), 
+                                                  prefix = prefix, 
+                                                  clean_col_names = clean_col_names, 
+                                                  pop_ids = pop_ids, 
+                                                  off_enh_cols = off_enh_cols)
+        meta, prev = incremental.load_state(state_dir)
+        change = incremental.diff_ids(prev, hashes, tables) if prev is not None else pd.Series('added', index = hashes.index, name = 'change')
+        if getattr(self, 'streamed_data_path', {}):
+            print("Incremental evaluation is not available for streamed datasets, applying the ruleset to all IDs")
+            prev_ok = False
+        else:
+            prev_ok = (prev is not None) and (meta.get('fingerprint') == fingerprint)
+        if not prev_ok:
+            if prev is not None:
+                print("The ruleset or settings changed since the previous run, applying the ruleset to all IDs")
+            self.apply_ruleset(prefix = prefix, clean_col_names = clean_col_names, pop_ids = pop_ids, use_t_cols = use_t_cols, off_enh_cols = off_enh_cols)
+        else:
+            # Unchanged IDs keep their previous result, only the other IDs are evaluated again
+            redo = change.reindex(hashes.index).to_numpy() != 'unchanged'
+            print(f"Found {np.count_nonzero(change == 'added')} added, {np.count_nonzero(change == 'changed')} changed and {np.count_nonzero(change == 'removed')} removed IDs since the previous run")
+            subset = self.get_subset(np.flatnonzero(redo), label = f"{self.label} (incremental)")
+            subset.apply_ruleset(prefix = prefix, clean_col_names = clean_col_names, pop_ids = pop_ids, use_t_cols = use_t_cols, off_enh_cols = off_enh_cols)
+            disqual = prev['disqualified'].reindex(hashes.index, fill_value = False).to_numpy(dtype = bool) & ~redo
+            disqual[subset.shard_codes[subset.disqual_mask]] = True
+            self.disqual_ids = []
+            self.add_disqualified(np.flatnonzero(disqual), pop_ids)
+        # Patch the stored state with the results of this run
+        state = hashes.copy()
+        state['disqualified'] = self.disqual_mask
+        state['qualifying'] = self.get_population_mask(pop_ids) & ~self.disqual_mask
+        self.delta_report = incremental.delta_report(prev, state, change, self.id)
+        incremental.save_state(state_dir, {'fingerprint': fingerprint, 'id': self.id, 'tables': tables, 'date': utils.get_todays_date(sep = '-')}, state)
+        print(f"{np.count_nonzero(self.delta_report['eligibility'] == 'entered')} IDs entered and {np.count_nonzero(self.delta_report['eligibility'] == 'left')} IDs left eligibility since the previous run")
+        return self.delta_report
+    
+    def apply_ruleset_sql(self, db_path : str, tables : dict, id_var : str, prefix : str, clean_col_names : bool, pop_ids : str, off_enh_cols : list = None, create_indexes : bool = False):
+        # Translate the compiled ruleset into a single query and run it in SQLite. Nothing is loaded into pandas except the distinct offense and enhancement codes
+        # The database is opened read-only. With create_indexes, the queried columns are copied into indexed temporary tables for the duration of the query
+        plan = self.compile_ruleset(clean_col_names = clean_col_names, off_enh_cols = off_enh_cols)
+        pop_cat = pop_ids[:-len("_raw")] if pop_ids.endswith("_raw") else pop_ids
+        con = sql.connect(db_path)
+        try:
+            query = sql.SQLRuleset(con, plan, tables = tables, id_var = id_var, pop_table = tables[pop_cat], prefix = prefix, clean_col_names = clean_col_names)
+            if create_indexes:
+                query.create_indexes()
+            self.sql_query = query.sql
+            qual_ids = query.qualifying_ids()
+        finally:
+            con.close()
+        print(f"Number of qualifying IDs from {len(plan)} criteria applied in SQLite is {len(qual_ids)}")
+        return qual_ids
+    
+    def cross_check_sql(self, db_path : str, tables : dict, id_var : str, prefix : str, clean_col_names : bool, pop_ids : str, off_enh_cols : list = None, create_indexes : bool = False):
+        # Apply the ruleset with both the SQL backend and the pandas engine on the same database and compare the qualifying IDs
+        sql_ids = set(self.apply_ruleset_sql(db_path = db_path, tables = tables, id_var = id_var, prefix = prefix, clean_col_names = clean_col_names, pop_ids = pop_ids, off_enh_cols = off_enh_cols, create_indexes = create_indexes))
+        self.get_sql_data(db_path = db_path, tables = tables, id_var = id_var, clean_col_names = clean_col_names)
+        self.apply_ruleset(prefix = prefix, clean_col_names = clean_col_names, pop_ids = pop_ids, use_t_cols = [], off_enh_cols = off_enh_cols)
+        pandas_ids = set(self.get_qualifying_ids(pop_ids))
+        only_sql, only_pandas = sql_ids - pandas_ids, pandas_ids - sql_ids
+        if only_sql or only_pandas:
+            print(f"SQL and pandas results differ: {len(only_sql)} IDs only qualify in SQL, {len(only_pandas)} IDs only qualify in pandas")
+        else:
+            print(f"SQL and pandas results agree on {len(sql_ids)} qualifying IDs")
+        return {'sql': sorted(only_sql, key = str), 'pandas': sorted(only_pandas, key = str)}
+    
+    def evaluate_rule(self, rule : rules.Rule, prefix : str):
+        # Boolean mask over the shared ID codes of the IDs disqualified by a single rule, independent of all other rules
+        if self.is_streamed(rule.data_label):
+            return self.evaluate_streamed((rule, ), prefix = prefix)[0]
+        elif rule.kind == 'sentence':
+            index = self.get_sentence_index(data = rule.data_label, sentence_var = rule.columns[0])
+            return index.disqualified(min_length = rule.min_length, max_length = rule.max_length)
+        elif rule.kind == 'offense':
+            index = self.get_offense_index(data = rule.data_label, offense_var = rule.columns[0], prefix = prefix, implications = rule.implications, match = rule.match)
+            disqual = index.disqualified(types = rule.types, how = rule.how)
+            return (disqual & index.present) if disqual is not None else np.zeros(len(index.present), dtype = bool)
+        elif rule.kind == 'enhancement':
+            index = self.get_enhancement_index(data = rule.data_label, enh_var = list(rule.columns), prefix = prefix)
+            disqual = index.disqualified(sel = rule.selection, how = rule.how)
+            return disqual if disqual is not None else np.zeros(len(index.present), dtype = bool)
+    
+    def evaluate_scenarios(self, scenarios, prefix : str, clean_col_names : bool, pop_ids : str, off_enh_cols : list = None, return_ids : bool = True):
+        # Scenarios can be passed as a list of rulesets or labeled with a dictionary, e.g. from scenarios.expand_grid()
+        if not isinstance(scenarios, dict):
+            scenarios = {f"scenario {i}": r for i, r in enumerate(scenarios)}
+        pop = self.get_population_mask(pop_ids)
+        # Each distinct rule is evaluated once across all scenarios, using the per-ID indexes shared by all of them
+        rule_masks = {}
+        results = []
+        for label, ruleset in scenarios.items():
+            plan = rules.compile_ruleset(ruleset = ruleset, 
+                                         offense_categories = self.offense_categories, 
+                                         clean_col_names = clean_col_names, 
+                                         off_enh_cols = off_enh_cols, 
+                                         cache = self.get_criteria_cache())
+            disqual = np.zeros(len(pop), dtype = bool)
+            for rule in plan:
+                key = rule._replace(name = None, spec = None)
+                if key not in rule_masks:
+                    try:
+                        rule_masks[key] = self.evaluate_rule(rule, prefix = prefix)
+                    except Exception as e:
+                        rules.print_error(e)
+                        rule_masks[key] = np.zeros(len(pop), dtype = bool)
+                disqual |= rule_masks[key]
+            qual = pop & ~disqual
+            result = {'scenario': label, 
+                      'size': np.count_nonzero(qual), 
+                      'disqualified': np.count_nonzero(pop & disqual)}
+            if return_ids:
+                result['ids'] = self.get_id_dictionary()[np.flatnonzero(qual)].to_numpy()
+            results.append(result)
+        print(f"Evaluated {len(scenarios)} scenarios with {len(rule_masks)} distinct rules")
+        self.scenario_results = pd.DataFrame(results)
+        return self.scenario_results
+    
+    def get_range_curve(self, criteria_type : str, thresholds : list, bound : str, prefix : str, clean_col_names : bool, pop_ids : str, off_enh_cols : list = None):
+        # Qualifying cohort size of the ruleset for every threshold of one bound of a sentence rule, e.g. numpy.arange(0, 601) for the minimum aggregate sentence
+        plan = self.compile_ruleset(clean_col_names = clean_col_names, off_enh_cols = off_enh_cols)
+        target = [rule for rule in plan if (rule.name == criteria_type) and (rule.kind == 'sentence')]
+        if not target:
+            print(f"No sentence rule found for criteria type: {criteria_type}")
+            return None
+        target = target[0]
+        # IDs qualifying under all other rules
+        base = self.get_population_mask(pop_ids)
+        for rule in plan:
+            if rule is not target:
+                base &= ~self.evaluate_rule(rule, prefix = prefix)
+        index = self.get_sentence_index(data = target.data_label, sentence_var = target.columns[0])
+        # IDs missing from the rule's dataset are never disqualified by it
+        outside = base & ~index.present
+        sizes = index.curve(thresholds = thresholds, 
+                            bound = bound, 
+                            min_length = target.min_length, 
+                            max_length = target.max_length, 
+                            base = base & index.present)
+        if sizes is None:
+            return None
+        return pd.DataFrame({'threshold': thresholds, 'size': sizes+np.count_nonzero(outside)})
+    
+    def iter_responsive_data(self, cat : str):
+        # Qualifying records of a streamed dataset, one chunk at a time
+        for chunk in read_chunks(self.streamed_data_path[cat], columns = self.stream_columns.get(cat), **self.stream_options):
+            # Same selection as get_responsive_data: every ID of the chunk is in the shared ID dictionary and was evaluated
+            yield encode.decode_categoricals(chunk[~self.get_disqualified_rows(chunk)])
+    
     def get_responsive_data(self, input_data_path : dict):
         for cat in input_data_path.keys():
+            if self.is_streamed(cat):
+                print(f"Dataset {cat} is read in chunks. Use iter_responsive_data to retrieve its qualifying records")
+                continue
             print(f"Retrieving qualifying records for: {cat}")
             raw_df = getattr(self, cat+"_raw")
-            # Find qualifying records
-            resp_df = raw_df[~raw_df[self.id].isin(self.disqual_ids)]
-            print(f"Found {len(resp_df)} records in {cat} dataset for {len(resp_df[self.id].unique())} IDs out of {len(self.disqual_ids)} IDs")
+            # Find qualifying records, with the encoded columns decoded to their original dtypes
+            resp_df = encode.decode_categoricals(raw_df[~self.get_disqualified_rows(raw_df)], getattr(self, 'raw_dtypes', {}).get(cat))
+            print(f"Found {len(resp_df)} records in {cat} dataset for {resp_df[self.id].nunique()} IDs out of {np.count_nonzero(self.disqual_mask)} IDs")
             # Set the data tables and assign them to the respective categories
             setattr(self, cat, resp_df)
         return
     
-    def write_responsive_data(self, input_data_path : dict, output_data_path : dict, file_format : str):
-        for file_name in output_data_path.keys():
-            if file_format == 'xlsx':
-                for cat in input_data_path.keys():
-                    pd.to_excel(output_data_path[file_name])
-                    print(f"Wrote output for {cat} to {file_name}{file_format}")
-            elif file_format == ".csv":
-                for cat in input_data_path.keys():
-                    pd.to_csv(output_data_path[file_name])
-                    print(f"Wrote output for {cat} to {file_name}{file_format}")
+    def write_responsive_data(self, input_data_path : dict, output_data_path : dict, file_format : str, chunksize : int = 100000, n_workers : int = None, index : bool = False):
+        # Qualifying records of each dataset, written to the path of its category in output_data_path. Categories with the same Excel path become sheets of one workbook
+        file_format = file_format.lstrip('.')
+        if file_format not in export.FORMATS:
+            print(f"Output format {file_format} not understood. Please pass one of {list(export.FORMATS.keys())}")
+            return
+        files = {}
+        for cat in input_data_path.keys():
+            if cat not in output_data_path:
+                print(f"No output path for {cat}")
+                continue
+            if self.is_streamed(cat):
+                # Streamed datasets are filtered and written chunk by chunk
+                data = self.iter_responsive_data(cat)
+            else:
+                if not isinstance(getattr(self, cat, None), pd.DataFrame):
+                    self.get_responsive_data({cat: input_data_path[cat]})
+                data = getattr(self, cat)
+            files.setdefault(output_data_path[cat], {})[cat] = data
+        written = export.write_files(files, file_format, chunksize = chunksize, n_workers = n_workers, index = index)
+        for path, n_rows in written.items():
+            print(f"Wrote {n_rows} records of {list(files[path].keys())} to {path}")
+        return written
     
     def generate_ruleset_summary(self):
         summary_parts = []
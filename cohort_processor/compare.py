@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+
+
+def ids_of(cohort, id_col = None):
+    """
+
+    Parameters
+    ----------
+    cohort : pandas dataframe, pandas series, set, list or array
+        Records of a cohort or its IDs
+    id_col : str, optional
+        ID column of dataframes. Default is None
+
+    Returns
+    -------
+    numpy array
+        IDs of the cohort, possibly repeated
+
+    """
+    if isinstance(cohort, pd.DataFrame):
+        if id_col is None:
+            raise ValueError("Pass id_col to compare dataframes")
+        return cohort[id_col].to_numpy()
+    if isinstance(cohort, (set, frozenset)):
+        return np.array(list(cohort), dtype = object)
+    return np.asarray(cohort)
+
+
+def is_member(values, ids):
+    """
+
+    Parameters
+    ----------
+    values : array-like
+        Values to look up, e.g. the ID column of a cohort
+    ids : array-like
+        IDs of another cohort
+
+    Returns
+    -------
+    numpy array
+        Boolean per value: True if it is one of the IDs. IDs are hashed once, so the cost is linear in the number of values and IDs
+
+    """
+    return pd.Index(pd.unique(np.asarray(ids))).get_indexer(np.asarray(values)) >= 0
+
+
+def membership(cohorts, labels = None, id_col = None):
+    """
+
+    Parameters
+    ----------
+    cohorts : list or dict
+        Cohorts as dataframes or sets of IDs, see ids_of(). A dictionary is labeled with its keys
+    labels : list, optional
+        Label of each cohort in a list. Default is None, i.e. 'cohort 0', 'cohort 1', ...
+    id_col : str, optional
+        ID column of dataframes. Default is None
+
+    Returns
+    -------
+    pandas dataframe
+        One row per distinct ID across all cohorts, in order of first appearance, and one boolean column per cohort that is True if the ID is in it
+
+    """
+    if isinstance(cohorts, dict):
+        labels, cohorts = list(cohorts.keys()), list(cohorts.values())
+    labels = labels if labels is not None else [f"cohort {i}" for i in range(len(cohorts))]
+    ids = [ids_of(c, id_col) for c in cohorts]
+    sizes = [len(i) for i in ids]
+    # A single hash pass over all IDs gives each distinct ID one code
+    codes, uniques = pd.factorize(np.concatenate(ids) if ids else np.array([], dtype = object), use_na_sentinel = False)
+    matrix = np.zeros((len(uniques), len(ids)), dtype = bool)
+    for i, part in enumerate(np.split(codes, np.cumsum(sizes)[:-1])):
+        matrix[part, i] = True
+    out = pd.DataFrame(matrix, columns = labels)
+    out.insert(0, id_col if id_col is not None else 'id', np.asarray(uniques, dtype = object) if len(uniques) else [])
+    return out
+
+
+def overlaps(cohorts, labels = None, id_col = None):
+    """
+
+    Parameters
+    ----------
+    cohorts : list or dict
+        Cohorts as dataframes or sets of IDs, see membership()
+    labels : list, optional
+        Label of each cohort in a list. Default is None
+    id_col : str, optional
+        ID column of dataframes. Default is None
+
+    Returns
+    -------
+    pandas dataframe
+        Number of IDs shared by each pair of cohorts. The diagonal holds the size of each cohort
+
+    """
+    m = membership(cohorts, labels = labels, id_col = id_col)
+    matrix = m.iloc[:, 1:].to_numpy(dtype = np.int64)
+    return pd.DataFrame(matrix.T @ matrix, index = m.columns[1:], columns = m.columns[1:])
+
+
+def difference(a, b, id_col = None):
+    """
+
+    Parameters
+    ----------
+    a : pandas dataframe or set of IDs
+        Cohort whose records are returned
+    b : pandas dataframe or set of IDs
+        Cohort to compare with
+    id_col : str, optional
+        ID column of dataframes. Default is None
+
+    Returns
+    -------
+    pandas dataframe or numpy array
+        Records of a whose ID is not in b, or the distinct IDs if a is not a dataframe
+
+    """
+    keep = ~is_member(ids_of(a, id_col), ids_of(b, id_col))
+    if isinstance(a, pd.DataFrame):
+        return a[keep]
+    return pd.unique(ids_of(a, id_col)[keep])
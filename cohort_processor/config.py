@@ -1,3 +1,5 @@
+import os
+
 DEFAULT_DATA_URL = "https://raw.githubusercontent.com/redoio/offenses_data/main/data/demographics.csv"
 PRIOR_COMMITMENTS_URL = "https://raw.githubusercontent.com/redoio/offenses_data/main/data/prior_commitments.csv"
 CURRENT_COMMITMENTS_URL = "https://raw.githubusercontent.com/redoio/offenses_data/main/data/current_commitments.csv"
@@ -11,5 +13,7 @@ NNN_PRIOR_COMMITMENTS_URL = "https://raw.githubusercontent.com/redoio/scenarios/
 NNN_CURRENT_COMMITMENTS_URL = "https://raw.githubusercontent.com/redoio/scenarios/main/data/output/currentcommits.xlsx"
 
 HASH_OBJ_MAP = "C:/Users/aparn/hash_object/hash_dict_ids.json"
+# Binary ID map built from HASH_OBJ_MAP (see idmap.IDMap.save), next to it unless set in the environment
+HASH_ID_MAP = os.environ.get("HASH_ID_MAP", os.path.join(os.path.dirname(HASH_OBJ_MAP), "id_map"))
 
 OFFENSE_CODES_URL = "https://raw.githubusercontent.com/redoio/resentencing_data_initiative/main/eligibility_model/code/offense_classification/county/los_angeles/selection_criteria.xlsx"
\ No newline at end of file
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import sys
+import numpy as np
+import pandas as pd
+import cache
+import utils
+
+
+def nbytes(obj):
+    """
+
+    Parameters
+    ----------
+    obj : pandas dataframe, pandas series, numpy array, dict, list, tuple or other object
+        Object held in memory
+
+    Returns
+    -------
+    int
+        Approximate number of bytes used by the object, including the contents of string columns
+
+    """
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index = True, deep = True).sum())
+    elif isinstance(obj, (pd.Series, pd.Index)):
+        return int(obj.memory_usage(deep = True))
+    elif isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    elif isinstance(obj, dict):
+        return sum(nbytes(v) for v in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    # Objects that know their own size, e.g. the indexes built by the rule kernels
+    elif hasattr(obj, 'nbytes'):
+        return int(obj.nbytes)
+    else:
+        return sys.getsizeof(obj)
+
+
+def copy_on_write_active():
+    """
+
+    Returns
+    -------
+    bool
+        True if pandas copy-on-write mode is active in this process, i.e. shallow views of a shared table can be handed out safely
+
+    """
+    if int(pd.__version__.split('.')[0]) >= 3:
+        # pandas 3 always copies on write
+        return True
+    try:
+        return pd.get_option("mode.copy_on_write") is True
+    except Exception:
+        return False
+
+
+def enable_copy_on_write():
+    """
+
+    Returns
+    -------
+    bool
+        True if pandas copy-on-write mode is active. The option is set for the whole process, so it also changes the behavior of chained assignments in code outside of this package
+
+    """
+    try:
+        pd.set_option("mode.copy_on_write", True)
+    except Exception:
+        pass
+    return copy_on_write_active()
+
+
+def freeze(df):
+    """
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Table held by the store
+
+    Returns
+    -------
+    df : pandas dataframe
+        The same table with its column buffers marked read-only, so that an in-place write into a view raises instead of changing the table of every generator that shares it
+
+    """
+    for blk in df._mgr.blocks:
+        # Categorical columns are backed by their codes
+        arr = getattr(blk.values, '_ndarray', blk.values)
+        if isinstance(arr, np.ndarray):
+            arr.flags.writeable = False
+    return df
+
+
+class DataStore():
+    """
+    Shared, read-only store of loaded input tables that several CohortGenerator objects can reference.
+
+    Each extract is held once, and the encoded tables built from a set of extracts are held once as well. Generators receive shallow views that share the column buffers of these resident tables, so N generators cost one copy of the data instead of N. The shared buffers are read-only: replacing a column of a view (df[col] = values) only changes that view, while writing into a column in place (df.loc[rows, col] = value) raises. If pandas copy-on-write mode is active, e.g. with copy_on_write = True, which sets the option for the whole process, such writes copy the column instead. Tables derived from the extracts (normalized columns, indexes, etc.) are kept in an LRU cache that is trimmed to the configured memory budget.
+    """
+    def __init__(self, memory_budget : int = None, cache_dir : str = None, copy_on_write : bool = False):
+        # Maximum number of bytes for derived tables. None means unlimited
+        self.memory_budget = memory_budget
+        # Directory of the persistent columnar cache used when loading extracts
+        self.cache_dir = cache_dir
+        # Loaded extracts are pinned and never evicted
+        self._tables = {}
+        # Derived tables in least to most recently used order
+        self._derived = OrderedDict()
+        self._derived_bytes = {}
+        # Copy-on-write is only switched on for the whole process on request
+        self.cow = enable_copy_on_write() if copy_on_write else copy_on_write_active()
+        if copy_on_write and not self.cow:
+            print("Copy-on-write is not available, in-place writes into views of shared tables will raise")
+
+    def view(self, df):
+        """
+
+        Parameters
+        ----------
+        df : pandas dataframe
+            A table held by the store
+
+        Returns
+        -------
+        pandas dataframe
+            Shallow copy sharing the read-only column data of the stored table
+
+        """
+        return freeze(df).copy(deep = False)
+
+    def get_table(self, path : str, clean_col_names : bool = False, cache_dir : str = None, columns : list = None):
+        """
+
+        Parameters
+        ----------
+        path : str
+            Location of the CSV or Excel input file
+        clean_col_names : bool, optional
+            Whether the column names should be cleaned with utils.clean_var_names. Default is False
+        cache_dir : str, optional
+            Directory of the persistent columnar cache. Default is None, i.e. the directory the store was created with
+        columns : list, optional
+            Columns to load, see cache.load_table. Default is None, i.e. all columns
+
+        Returns
+        -------
+        pandas dataframe
+            View of the shared table. The file is only loaded the first time it is requested
+
+        """
+        key = (path, bool(clean_col_names), tuple(columns) if columns is not None else None)
+        if key not in self._tables:
+            full = (path, bool(clean_col_names), None)
+            if (columns is not None) and (full in self._tables):
+                # The whole table is already loaded, select the columns from it
+                df = self._tables[full]
+                self._tables[key] = df[utils.select_columns(list(df.columns), columns, clean_col_names = clean_col_names)]
+            else:
+                self._tables[key] = cache.load_table(path, clean_col_names = clean_col_names, cache_dir = cache_dir or self.cache_dir, columns = columns)
+                print('Loaded raw data into the shared store from path: ', path)
+        return self.view(self._tables[key])
+
+    def release(self, path : str):
+        """
+
+        Parameters
+        ----------
+        path : str
+            Location of an input file loaded with get_table()
+
+        Returns
+        -------
+        None
+            Drops the shared table for the path. Views that were handed out stay valid
+
+        """
+        for key in [k for k in self._tables.keys() if k[0] == path]:
+            del self._tables[key]
+        return
+
+    def get_derived(self, key, builder = None):
+        """
+
+        Parameters
+        ----------
+        key : hashable
+            Identifies the derived table, e.g. a tuple of dataset label, column and options
+        builder : callable, optional
+            Function without arguments that builds the table when it is not in the store. Default is None
+
+        Returns
+        -------
+        object or None
+            The derived table, built and stored if necessary. None if it is not stored and no builder is passed
+
+        """
+        if key in self._derived:
+            self._derived.move_to_end(key)
+            return self._derived[key]
+        if builder is None:
+            return None
+        obj = builder()
+        self.put_derived(key, obj)
+        return obj
+
+    def put_derived(self, key, obj):
+        """
+
+        Parameters
+        ----------
+        key : hashable
+            Identifies the derived table
+        obj : object
+            The derived table
+
+        Returns
+        -------
+        None
+            Stores the table as the most recently used entry and evicts the least recently used ones beyond the memory budget
+
+        """
+        if key in self._derived:
+            del self._derived[key]
+        self._derived[key] = obj
+        self._derived_bytes[key] = nbytes(obj)
+        self._evict()
+        return
+
+    def _evict(self):
+        if self.memory_budget is None:
+            return
+        # Always keep the most recent entry, even if it alone exceeds the budget
+        while (len(self._derived) > 1) and (self.derived_bytes > self.memory_budget):
+            key, _ = self._derived.popitem(last = False)
+            del self._derived_bytes[key]
+        return
+
+    def invalidate(self, match = None):
+        """
+
+        Parameters
+        ----------
+        match : callable, optional
+            Predicate on derived table keys. Default is None, i.e. all derived tables are dropped
+
+        Returns
+        -------
+        None
+
+        """
+        for key in [k for k in self._derived.keys() if (match is None) or match(k)]:
+            del self._derived[key]
+            del self._derived_bytes[key]
+        return
+
+    @property
+    def derived_bytes(self):
+        return sum(self._derived_bytes.values())
+
+    @property
+    def table_bytes(self):
+        return sum(nbytes(df) for df in self._tables.values())
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+
+
+def build_id_dictionary(dfs, id_var):
+    """
+
+    Parameters
+    ----------
+    dfs : list of pandas dataframes
+        Tables that share the same ID variable, e.g. demographics, current and prior commitments
+    id_var : str
+        Name of the ID column
+
+    Returns
+    -------
+    pandas index
+        Sorted unique IDs across all tables. The position of an ID in the index is its integer code, shared by all tables
+
+    """
+    vals = pd.concat([pd.Series(pd.unique(df[id_var].dropna()), dtype = object) for df in dfs], ignore_index = True)
+    uniq = pd.unique(vals)
+    try:
+        uniq = np.sort(uniq)
+    except TypeError:
+        # IDs of mixed types cannot be sorted, keep the order of appearance
+        pass
+    return pd.Index(uniq, dtype = object)
+
+
+def encode_ids(df, id_var, dictionary):
+    """
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Table with the ID column
+    id_var : str
+        Name of the ID column
+    dictionary : pandas index
+        Shared ID dictionary from build_id_dictionary()
+
+    Returns
+    -------
+    df : pandas dataframe
+        Table whose ID column is categorical over the shared dictionary, i.e. it holds integer codes and still displays the original IDs
+
+    """
+    df = df.copy(deep = False)
+    df[id_var] = pd.Categorical(df[id_var], dtype = pd.CategoricalDtype(categories = dictionary))
+    return df
+
+
+def find_categorical_cols(df, exclude = None, max_ratio = 0.5):
+    """
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Input table
+    exclude : list, optional
+        Column names to leave unchanged, e.g. the ID column. Default is None
+    max_ratio : float, optional
+        Maximum ratio of distinct values to rows for a text column to be stored as a categorical. Default is 0.5
+
+    Returns
+    -------
+    cols : list
+        Text columns with few distinct values relative to the number of rows, e.g. offense and enhancement codes
+
+    """
+    cols = []
+    exclude = exclude or []
+    for col in df.columns:
+        if (col in exclude) or (df[col].dtype != object):
+            continue
+        if df[col].nunique(dropna = True) <= max_ratio*max(len(df), 1):
+            cols.append(col)
+    return cols
+
+
+def encode_categoricals(df, cols):
+    """
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Input table
+    cols : list
+        Column names to store as categoricals
+
+    Returns
+    -------
+    df : pandas dataframe
+        Table with the selected columns converted to categoricals. Values are unchanged
+
+    """
+    df = df.copy(deep = False)
+    for col in cols:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+
+def decode_categoricals(df, dtypes = None):
+    """
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Table with categorical columns, e.g. encoded with encode_ids() and encode_categoricals()
+    dtypes : dict, optional
+        Original dtype of each column. Default is None, i.e. the dtype of the categories
+
+    Returns
+    -------
+    df : pandas dataframe
+        Table whose categorical columns hold plain values again, so that the categories of other rows (e.g. disqualified IDs) are not carried along and any value can be assigned
+
+    """
+    cols = [col for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)]
+    if not cols:
+        return df
+    dtypes = dtypes or {}
+    df = df.copy(deep = False)
+    for col in cols:
+        try:
+            df[col] = df[col].astype(dtypes.get(col, df[col].cat.categories.dtype))
+        except (TypeError, ValueError):
+            # e.g. integer categories with missing values
+            df[col] = df[col].astype(object)
+    return df
+
+
+def id_codes(df, id_var, dictionary):
+    """
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Table with the ID column
+    id_var : str
+        Name of the ID column
+    dictionary : pandas index
+        Shared ID dictionary from build_id_dictionary()
+
+    Returns
+    -------
+    numpy array
+        Integer code of the ID in each row, -1 for missing or unknown IDs
+
+    """
+    col = df[id_var]
+    # Columns encoded against the dictionary hold it as their categories, so identity is checked before comparing values
+    if isinstance(col.dtype, pd.CategoricalDtype) and ((col.cat.categories is dictionary) or col.cat.categories.equals(dictionary)):
+        return col.cat.codes.to_numpy()
+    return dictionary.get_indexer(col)
+
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import encode
+import workers
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa, pq = None, None
+
+# Output formats and the extension of their files
+FORMATS = {'parquet': '.parquet', 'csv': '.csv', 'xlsx': '.xlsx'}
+
+# Maximum number of rows of an Excel sheet
+EXCEL_MAX_ROWS = 1048576
+
+# Tables of the export jobs of a worker process, set once when the worker starts
+_jobs = {}
+
+
+def iter_chunks(data, chunksize):
+    """
+
+    Parameters
+    ----------
+    data : pandas dataframe or iterable of pandas dataframes
+        Table to write, or its consecutive chunks, e.g. from CohortGenerator.iter_responsive_data()
+    chunksize : int
+        Maximum number of rows per chunk of a dataframe
+
+    Yields
+    ------
+    pandas dataframe
+        Consecutive chunks of the table. Chunks of a dataframe are views, so only one chunk is converted at a time
+
+    """
+    if isinstance(data, pd.DataFrame):
+        if len(data) == 0:
+            yield data
+        for start in range(0, len(data), chunksize):
+            yield data.iloc[start:start+chunksize]
+    else:
+        yield from data
+
+
+def value_type(col):
+    # Arrow type of the values of a column from its first values that are not missing, text if it has none
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        col = pd.Series(col.cat.categories)
+    values = col.dropna()
+    return pa.array(values.iloc[:1000], from_pandas = True).type if len(values) else pa.string()
+
+
+def write_parquet(data, path, chunksize = 100000, index = False):
+    """
+
+    Parameters
+    ----------
+    data : pandas dataframe or iterable of pandas dataframes
+        Table to write
+    path : str
+        Location of the Parquet file
+    chunksize : int, optional
+        Maximum number of rows per row group. Default is 100000
+    index : bool, optional
+        Whether the index is written. Default is False
+
+    Returns
+    -------
+    int
+        Number of rows written. Each chunk is written as a row group with the schema of the first chunk. Categorical columns are written as plain values
+
+    """
+    if pq is None:
+        raise ImportError("Writing Parquet files requires pyarrow")
+    writer, n_rows = None, 0
+    try:
+        for chunk in iter_chunks(data, chunksize):
+            # Categorical columns would be written with all of their categories, e.g. the IDs of other rows, so they are written as plain values
+            plain = encode.decode_categoricals(chunk)
+            if writer is None:
+                table = pa.Table.from_pandas(plain, preserve_index = index)
+                # Columns without any value in the first chunk take the type of the values of the whole table
+                source = data if isinstance(data, pd.DataFrame) else chunk
+                schema = table.schema
+                for i, field in enumerate(schema):
+                    if pa.types.is_null(field.type) and (field.name in source):
+                        schema = schema.set(i, field.with_type(value_type(source[field.name])))
+                table = table.cast(schema)
+                writer = pq.ParquetWriter(path, schema)
+            else:
+                table = pa.Table.from_pandas(plain, schema = writer.schema, preserve_index = index)
+            writer.write_table(table)
+            n_rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_rows
+
+
+def write_csv(data, path, chunksize = 100000, index = False):
+    """
+
+    Parameters
+    ----------
+    data : pandas dataframe or iterable of pandas dataframes
+        Table to write
+    path : str
+        Location of the CSV file
+    chunksize : int, optional
+        Maximum number of rows formatted at a time. Default is 100000
+    index : bool, optional
+        Whether the index is written. Default is False
+
+    Returns
+    -------
+    int
+        Number of rows written. The header is written with the first chunk
+
+    """
+    n_rows = 0
+    with open(path, 'w', newline = '', encoding = 'utf-8') as f:
+        for chunk in iter_chunks(data, chunksize):
+            chunk.to_csv(f, header = (n_rows == 0), index = index)
+            n_rows += len(chunk)
+    return n_rows
+
+
+def excel_rows(chunk, index = False):
+    # Rows of a chunk as tuples of Python values that openpyxl can write. Missing values become empty cells
+    if index:
+        chunk = chunk.reset_index()
+    values = chunk.astype(object).to_numpy()
+    values[pd.isna(values)] = None
+    return map(tuple, values)
+
+
+def write_excel(sheets, path, chunksize = 100000, startrow = 0, index = False):
+    """
+
+    Parameters
+    ----------
+    sheets : dict
+        Table to write (pandas dataframe or iterable of dataframes) for each sheet name
+    path : str
+        Location of the Excel file
+    chunksize : int, optional
+        Maximum number of rows converted at a time. Default is 100000
+    startrow : int, optional
+        Number of empty rows above the header of each sheet, as in pandas.DataFrame.to_excel. Default is 0
+    index : bool, optional
+        Whether the index is written as the first column. Default is False
+
+    Returns
+    -------
+    int
+        Number of rows written. The workbook is written with openpyxl in write-only mode, which streams rows to disk instead of keeping every cell in memory. Tables longer than an Excel sheet continue on sheets named e.g. 'Demographics (2)'
+
+    """
+    import openpyxl
+    wb = openpyxl.Workbook(write_only = True)
+    n_rows = 0
+    for sheet_name, data in sheets.items():
+        ws, part, sheet_rows, header = None, 1, 0, None
+        for chunk in iter_chunks(data, chunksize):
+            if header is None:
+                header = ([chunk.index.name or ''] if index else [])+[str(c) for c in chunk.columns]
+            for row in excel_rows(chunk, index = index):
+                if (ws is None) or (sheet_rows == EXCEL_MAX_ROWS):
+                    ws = wb.create_sheet(title = sheet_name if part == 1 else f"{sheet_name[:26]} ({part})")
+                    part += 1
+                    for _ in range(startrow):
+                        ws.append([])
+                    ws.append(header)
+                    sheet_rows = startrow+1
+                ws.append(row)
+                sheet_rows += 1
+                n_rows += 1
+        if ws is None:
+            # Empty tables still get a sheet with their header
+            ws = wb.create_sheet(title = sheet_name)
+            for _ in range(startrow):
+                ws.append([])
+            ws.append(header or [])
+    wb.save(path)
+    return n_rows
+
+
+def write_file(path, sheets, file_format, chunksize = 100000, **kwargs):
+    """
+
+    Parameters
+    ----------
+    path : str
+        Location of the output file
+    sheets : dict
+        Table to write for each sheet name. Parquet and CSV files hold a single table
+    file_format : str
+        'parquet', 'csv' or 'xlsx'
+    chunksize : int, optional
+        Maximum number of rows written at a time. Default is 100000
+    **kwargs
+        Options of write_parquet(), write_csv() or write_excel()
+
+    Returns
+    -------
+    int
+        Number of rows written
+
+    """
+    file_format = file_format.lstrip('.')
+    if file_format == 'xlsx':
+        return write_excel(sheets, path, chunksize = chunksize, **kwargs)
+    if len(sheets) != 1:
+        raise ValueError(f"A {file_format} file holds a single table, got {len(sheets)} for {path}")
+    data = list(sheets.values())[0]
+    if file_format == 'parquet':
+        return write_parquet(data, path, chunksize = chunksize, **kwargs)
+    elif file_format == 'csv':
+        return write_csv(data, path, chunksize = chunksize, **kwargs)
+    raise ValueError(f"Output format {file_format} not understood. Please pass one of {list(FORMATS.keys())}")
+
+
+def init_export_worker(jobs):
+    _jobs.update(jobs)
+
+
+def run_export(path, file_format, chunksize, kwargs):
+    return write_file(path, _jobs[path], file_format, chunksize = chunksize, **kwargs)
+
+
+def write_files(files, file_format, chunksize = 100000, n_workers = None, **kwargs):
+    """
+
+    Parameters
+    ----------
+    files : dict
+        For each output path, the table to write for each sheet name
+    file_format : str
+        'parquet', 'csv' or 'xlsx'
+    chunksize : int, optional
+        Maximum number of rows written at a time. Default is 100000
+    n_workers : int, optional
+        Number of worker processes. Default is None, i.e. the number of CPUs. Pass 1 to write all files in this process
+    **kwargs
+        Options of write_parquet(), write_csv() or write_excel()
+
+    Returns
+    -------
+    dict
+        Number of rows written to each path. Files are independent, so files of loaded dataframes are written in parallel by worker processes that inherit the tables when forked. Files with chunk iterators, e.g. of streamed datasets, are written in this process
+
+    """
+    loaded = {path: sheets for path, sheets in files.items() if all(isinstance(d, pd.DataFrame) for d in sheets.values())}
+    if workers.n_workers_for(len(loaded), n_workers) < 2:
+        loaded = {}
+    out = {}
+    futures = {}
+    pool = None
+    try:
+        if loaded:
+            pool = ProcessPoolExecutor(max_workers = workers.n_workers_for(len(loaded), n_workers),
+                                       mp_context = workers.get_context(),
+                                       initializer = init_export_worker,
+                                       initargs = (loaded, ))
+            futures = {path: pool.submit(run_export, path, file_format, chunksize, kwargs) for path in loaded.keys()}
+        for path, sheets in files.items():
+            if path not in futures:
+                out[path] = write_file(path, sheets, file_format, chunksize = chunksize, **kwargs)
+        for path, future in futures.items():
+            out[path] = future.result()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return {path: out[path] for path in files.keys()}
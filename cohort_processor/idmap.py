@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Files of a stored ID map: raw IDs and hashed IDs, each sorted and aligned with its counterpart
+MAP_FILES = ['raw_sorted', 'hashed_by_raw', 'hashed_sorted', 'raw_by_hashed']
+
+
+def hash_ids(ids, key, digest_size = 16):
+    """
+
+    Parameters
+    ----------
+    ids : array-like
+        Raw IDs, e.g. the CDCNo column of a dataset
+    key : str or bytes
+        Secret key of the keyed BLAKE2b hash, at most 64 bytes
+    digest_size : int, optional
+        Number of bytes of each hash. Default is 16, i.e. 32 hex characters
+
+    Returns
+    -------
+    numpy array
+        Hex digest of each ID. Each distinct ID is hashed once
+
+    """
+    key = key.encode() if isinstance(key, str) else key
+    codes, uniques = pd.factorize(pd.Series(ids).astype(str), use_na_sentinel = False)
+    hashed = np.array([hashlib.blake2b(str(v).encode(), key = key, digest_size = digest_size).hexdigest() for v in uniques], dtype = object)
+    return hashed[codes]
+
+
+def to_bytes(values):
+    """
+
+    Parameters
+    ----------
+    values : array-like
+        IDs of any type. They are compared as strings
+
+    Returns
+    -------
+    numpy array
+        UTF-8 encoded IDs as a fixed-width bytes array
+
+    """
+    strs = pd.Series(values, dtype = object).astype(str)
+    try:
+        # ASCII IDs, e.g. CDC numbers and hex digests, are converted without a Python loop
+        return strs.to_numpy(dtype = str).astype(bytes)
+    except UnicodeEncodeError:
+        return np.asarray(strs.str.encode('utf-8').to_numpy(), dtype = bytes)
+
+
+def from_bytes(values):
+    # Inverse of to_bytes()
+    values = np.asarray(values)
+    try:
+        return values.astype(str)
+    except UnicodeDecodeError:
+        return np.char.decode(values, 'utf-8')
+
+
+class IDMap():
+    """
+    Map between raw and hashed (pseudonymized) IDs, held as sorted fixed-width byte arrays.
+
+    Lookups are vectorized binary searches instead of a Python dictionary. The arrays are saved as .npy files and memory-mapped when loaded, so every process that links raw and hashed IDs shares the same pages instead of building its own dictionary.
+    """
+    def __init__(self, raw, hashed):
+        raw = to_bytes(raw)
+        hashed = to_bytes(hashed)
+        # Deduplicate raw IDs, keeping the first hashed ID of each
+        raw, first = np.unique(raw, return_index = True)
+        hashed = hashed[first]
+        order = np.argsort(hashed, kind = 'stable')
+        self.arrays = {'raw_sorted': raw,
+                       'hashed_by_raw': hashed,
+                       'hashed_sorted': hashed[order],
+                       'raw_by_hashed': raw[order]}
+
+    @classmethod
+    def build(cls, ids, key, digest_size = 16):
+        # Map of the distinct raw IDs to their keyed BLAKE2b hashes
+        ids = pd.unique(pd.Series(ids).dropna().astype(str))
+        return cls(ids, hash_ids(ids, key = key, digest_size = digest_size))
+
+    @classmethod
+    def from_json(cls, path):
+        # Map from a JSON dictionary of raw to hashed IDs, e.g. config.HASH_OBJ_MAP
+        with open(path, 'r') as f:
+            pairs = json.load(f)
+        return cls(list(pairs.keys()), list(pairs.values()))
+
+    @classmethod
+    def load(cls, path, mmap = True):
+        """
+
+        Parameters
+        ----------
+        path : str
+            Directory of a map written by save()
+        mmap : bool, optional
+            Whether the arrays are memory-mapped instead of read into memory. Default is True
+
+        Returns
+        -------
+        IDMap
+            The stored map
+
+        """
+        out = cls.__new__(cls)
+        out.arrays = {name: np.load(os.path.join(path, name+".npy"), mmap_mode = 'r' if mmap else None) for name in MAP_FILES}
+        return out
+
+    def save(self, path):
+        os.makedirs(path, exist_ok = True)
+        for name in MAP_FILES:
+            np.save(os.path.join(path, name+".npy"), np.asarray(self.arrays[name]))
+        return path
+
+    def __len__(self):
+        return len(self.arrays['raw_sorted'])
+
+    def _lookup(self, values, keys, targets):
+        index = values.index if isinstance(values, pd.Series) else None
+        if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype):
+            # Encoded ID columns are looked up once per distinct ID
+            values = pd.Series(values)
+            mapped = np.append(self._lookup(values.cat.categories, keys, targets).to_numpy(), None)
+            return pd.Series(mapped[values.cat.codes.to_numpy()], index = index, dtype = object)
+        query = to_bytes(values)
+        out = np.full(len(query), None, dtype = object)
+        if len(keys) == 0:
+            return pd.Series(out, index = index, dtype = object)
+        # Binary search in the sorted keys. Queries are compared in full, so IDs longer than the stored width never match
+        pos = np.minimum(np.searchsorted(keys, query), len(keys)-1)
+        found = np.asarray(keys[pos]) == query
+        out[found] = from_bytes(targets[pos[found]])
+        return pd.Series(out, index = index, dtype = object)
+
+    def map_ids(self, values):
+        """
+
+        Parameters
+        ----------
+        values : pandas series or array-like
+            Raw IDs
+
+        Returns
+        -------
+        pandas series
+            Hashed ID of each raw ID, aligned with the input. None for IDs that are not in the map
+
+        """
+        return self._lookup(values, self.arrays['raw_sorted'], self.arrays['hashed_by_raw'])
+
+    def reverse(self, values):
+        """
+
+        Parameters
+        ----------
+        values : pandas series or array-like
+            Hashed IDs
+
+        Returns
+        -------
+        pandas series
+            Raw ID of each hashed ID, aligned with the input. None for hashes that are not in the map
+
+        """
+        return self._lookup(values, self.arrays['hashed_sorted'], self.arrays['raw_by_hashed'])
@@ -1,104 +1,352 @@
 # -*- coding: utf-8 -*-
 from itertools import permutations, product
+from collections import OrderedDict
 import pandas as pd
 import copy
+import json
+from math import perm as n_perm
 import utils
 
-def gen_impl_off(offenses, 
-                 impl_rel, 
-                 perm, 
-                 fix_pos = None, 
+# Implied values are materialized for membership tests only up to this many per implication
+MAX_MATERIALIZED = 50000
+# Expanded sets of offenses memoized per implication engine
+MAX_EXPANSIONS = 64
+
+
+def gen_impl_off(offenses,
+                 impl_rel,
+                 perm,
+                 fix_pos = None,
                  placeholder = None,
                  how = 'inclusive',
                  sep = '',
                  clean = True):
-    
+
     # Clean the offense data if specified
     if clean:
         offenses = utils.clean_blk(data = offenses)
-    
-    # Remove exceptions from the list of offenses
-    offenses_woe = offenses[:]
-    for rel in impl_rel.keys():
-        if (rel != 'all'):
-            for off in offenses:
-                if rel in off:
-                    offenses_woe.remove(rel)
-    
-    if how == 'inclusive':
-        # Initialize list of implied offenses - add the baseline offenses
-        impl_off = offenses[:]
-    else:
-        impl_off = []
-        
-    # Add the implied offenses
-    for rel in impl_rel.keys():
-        # Generate list of implied values
-        impl_val = gen_impl_val(impl = impl_rel[rel],  
-                                sep = sep, 
-                                perm = perm,
-                                fix_pos = fix_pos, 
-                                placeholder = placeholder)
-                
-        # If offense is NOT an exception
-        if rel == 'all':
-            # Adding implications to all offenses that do NOT have an exception
-            for owe in offenses_woe:
-                for iv in impl_val:
-                    impl_off.append(owe+iv)
-        
-        # If offense is an exception
-        elif (rel != 'all') and (rel in offenses):
-            # Adding implications to the exception offense (always called out individually)
-            for iv in impl_val:
-                impl_off.append(rel+iv)
-    
-    return list(set(impl_off))
-            
-            
-    
+
+    # Implications are expanded by an engine shared by all calls with the same implications
+    engine = get_engine(impl_rel = impl_rel, perm = perm, fix_pos = fix_pos, placeholder = placeholder, sep = sep)
+    return list(engine.expand(offenses, how = how))
+
+
+
 def gen_impl_val(impl, sep, perm, fix_pos, placeholder):
-    
-    # Initialize list of permutations of implied values
-    sel = []
+
+    # Combine the tuples of each permutation into a single string and apply placeholders (see iter_impl_val)
+    return list(set(iter_impl_val(impl = impl, sep = sep, perm = perm, fix_pos = fix_pos, placeholder = placeholder)))
+
+
+def fixed_pos_ok(s, fix_pos):
+    """
+
+    Parameters
+    ----------
+    s : tuple
+        A permutation of implied values
+    fix_pos : dict
+        Keys are implied values that must be at the position given by the value, e.g. {'2nd': -1}
+
+    Returns
+    -------
+    bool
+        False if the permutation has any of the fixed values but none of them at its specified position
+
+    """
+    if not fix_pos:
+        return True
+    # Only select permutations that have at least one of the specified fixed values at the given position
+    if (any(f in s for f in fix_pos.keys())):
+        # Not ALL of the fixed values will be at the specified position. Check if ANY of the fixed values are at the specified position.
+        return any(s[fix_pos[f]] == f for f in fix_pos.keys())
+    return True
+
+
+def iter_impl_val(impl, sep, perm, fix_pos, placeholder):
+    """
+
+    Parameters
+    ----------
+    impl : list
+        Implied values, e.g. ["/att", "(664)", "2nd"]
+    sep : str
+        Separator between the implied values of a permutation
+    perm : int
+        Maximum number of implied values combined in a permutation
+    fix_pos : dict or None
+        Implied values that must be at a fixed position in the permutation
+    placeholder : dict or None
+        Keys are placeholders in the implied values and values are lists of replacements
+
+    Yields
+    ------
+    str
+        Implied suffixes, generated lazily one permutation at a time. Duplicates are possible
+
+    """
     for i in range(1, perm+1):
         # Add permutations for each count
-        sel.extend(list(permutations(impl, i)))
-    
-    # If some values should have fixed positions
-    if fix_pos:
-        # Initialize list of values that do not meet the fixed position condition
-        rem = []
-        # Remove implied values that do not have ANY of the fixed values in the speciied positions
-        for s in sel:
-            # Only select permutations that have at least one of the specified fixed values at the given position
-            if (any(f in s for f in fix_pos.keys())):
-                # Not ALL of the fixed values will be at the specified position. Check if ANY of the fixed values are at the specified position.
-                if (any(s[fix_pos[f]] == f for f in fix_pos.keys())):
-                    pass
-                # Remove permutations that do not have any of the fixed values at the specified positions
-                else:
-                    rem.append(s)
-        
-        # Update the selection 
-        sel = [s for s in sel if s not in rem]
-        
-    # Combine the tuples into a single string (necessary step since no manipulations can be made on tuple values)
-    sel = [sep.join(s) for s in sel]
-
-    # If implied value is a placeholder for other values
-    if placeholder: 
-        # Replace placeholder values with actual ones 
-        new = []
-        for p in placeholder.keys():
-            # Perform replacement for each value
-            for repl in placeholder[p]:
-                for s in sel:
-                    new.append(s.replace(p, repl))
-        # If placeholders were requested
-        return list(set(new))
-    
-    # If there are no placeholders return the original list of strings
-    return list(set(sel))
-        
-        
\ No newline at end of file
+        for s in permutations(impl, i):
+            # Remove permutations that do not have any of the fixed values at the specified positions
+            if not fixed_pos_ok(s, fix_pos):
+                continue
+            s = sep.join(s)
+            # If implied value is a placeholder for other values
+            if placeholder:
+                for p in placeholder.keys():
+                    for repl in placeholder[p]:
+                        yield s.replace(p, repl)
+            else:
+                yield s
+
+
+def count_impl_val(impl, perm, placeholder):
+    """
+
+    Parameters
+    ----------
+    impl : list
+        Implied values
+    perm : int
+        Maximum number of implied values combined in a permutation
+    placeholder : dict or None
+        Keys are placeholders in the implied values and values are lists of replacements
+
+    Returns
+    -------
+    int
+        Upper bound of the number of implied suffixes generated by iter_impl_val
+
+    """
+    n = sum(n_perm(len(impl), i) for i in range(1, min(perm, len(impl))+1))
+    if placeholder:
+        n = n*sum(len(v) for v in placeholder.values())
+    return n
+
+
+class ImplicationEngine():
+    """
+    Memoized expansion of offense codes with implied suffixes such as "/att", "(664)" or "2nd".
+
+    Implied suffixes of each implication are generated lazily and only materialized when there are few of them. Whether a code is an implied form of a selected offense is answered by splitting the code into an offense and a suffix and parsing the suffix, without building the list of implied offenses.
+    """
+    def __init__(self, impl_rel, perm, fix_pos = None, placeholder = None, sep = ''):
+        self.impl_rel = impl_rel
+        self.perm = perm
+        self.fix_pos = fix_pos
+        self.placeholder = placeholder
+        self.sep = sep
+        # Offenses that have their own implications (exceptions)
+        self.exceptions = frozenset(rel for rel in impl_rel.keys() if rel != 'all')
+        self._values = {}
+        # Expansions of the most recently used sets of offenses, see expand()
+        self._expanded = OrderedDict()
+
+    def values(self, rel):
+        """
+
+        Parameters
+        ----------
+        rel : str
+            Key of the implication: 'all' or an exception offense
+
+        Returns
+        -------
+        frozenset
+            Implied suffixes of the implication, generated once
+
+        """
+        if rel not in self._values:
+            self._values[rel] = frozenset(iter_impl_val(impl = self.impl_rel[rel],
+                                                        sep = self.sep,
+                                                        perm = self.perm,
+                                                        fix_pos = self.fix_pos,
+                                                        placeholder = self.placeholder))
+        return self._values[rel]
+
+    def _parse(self, s, items, used):
+        # Split s into distinct items joined by the separator, yielding each valid split as a tuple of item positions
+        if len(used) > 0:
+            if s == '':
+                yield used
+            if not s.startswith(self.sep):
+                return
+            s = s[len(self.sep):]
+        if len(used) == self.perm:
+            return
+        for j, item in enumerate(items):
+            if (j not in used) and s.startswith(item):
+                yield from self._parse(s[len(item):], items, used+(j, ))
+
+    def is_value(self, rel, s):
+        """
+
+        Parameters
+        ----------
+        rel : str
+            Key of the implication: 'all' or an exception offense
+        s : str
+            Candidate suffix
+
+        Returns
+        -------
+        bool
+            True if s is an implied suffix of the implication
+
+        """
+        impl = self.impl_rel[rel]
+        if (rel in self._values) or (count_impl_val(impl, self.perm, self.placeholder) <= MAX_MATERIALIZED):
+            return s in self.values(rel)
+        # Too many suffixes to materialize: parse the candidate into implied values instead
+        variants = [(None, None)]
+        if self.placeholder:
+            variants = [(p, repl) for p in self.placeholder.keys() for repl in self.placeholder[p]]
+        for p, repl in variants:
+            items = [i.replace(p, repl) for i in impl] if p is not None else list(impl)
+            for used in self._parse(s, items, ()):
+                t = tuple(impl[j] for j in used)
+                joined = self.sep.join(t)
+                if fixed_pos_ok(t, self.fix_pos) and ((joined.replace(p, repl) if p is not None else joined) == s):
+                    return True
+        return False
+
+    def expand(self, offenses, how = 'inclusive'):
+        """
+
+        Parameters
+        ----------
+        offenses : list
+            Cleaned offense codes
+        how : str, optional
+            'inclusive' to include the offenses themselves in the result. Default is 'inclusive'
+
+        Returns
+        -------
+        frozenset
+            Offense codes with all implied suffixes, memoized by the set of offenses for the MAX_EXPANSIONS most recently used sets
+
+        """
+        key = (frozenset(offenses), how)
+        if key in self._expanded:
+            self._expanded.move_to_end(key)
+        else:
+            # Initialize list of implied offenses - add the baseline offenses
+            impl_off = set(offenses) if how == 'inclusive' else set()
+            # Remove exceptions from the list of offenses
+            offenses_woe = key[0].difference(self.exceptions)
+            for rel in self.impl_rel.keys():
+                # Adding implications to all offenses that do NOT have an exception
+                if rel == 'all':
+                    impl_off.update(owe+iv for owe in offenses_woe for iv in self.values(rel))
+                # Adding implications to the exception offense (always called out individually)
+                elif rel in key[0]:
+                    impl_off.update(rel+iv for iv in self.values(rel))
+            self._expanded[key] = frozenset(impl_off)
+            if len(self._expanded) > MAX_EXPANSIONS:
+                self._expanded.popitem(last = False)
+        return self._expanded[key]
+
+    def is_implied(self, code, offenses, how = 'inclusive'):
+        """
+
+        Parameters
+        ----------
+        code : str
+            Cleaned offense code to test, e.g. '459/att'
+        offenses : set or frozenset
+            Cleaned selected offense codes
+        how : str, optional
+            'inclusive' if the offenses themselves are selected. Default is 'inclusive'
+
+        Returns
+        -------
+        bool
+            True if code is in expand(offenses), computed without expanding the offenses
+
+        """
+        if not isinstance(code, str):
+            return False
+        if (how == 'inclusive') and (code in offenses):
+            return True
+        for rel in self.impl_rel.keys():
+            if rel == 'all':
+                # Any split of the code into an offense without an exception and an implied suffix
+                for i in range(len(code)+1):
+                    base = code[:i]
+                    if (base in offenses) and (base not in self.exceptions) and self.is_value(rel, code[i:]):
+                        return True
+            elif (rel in offenses) and code.startswith(rel) and self.is_value(rel, code[len(rel):]):
+                return True
+        return False
+
+
+# Engines shared by all criteria with the same implications. The least recently used engines are dropped beyond MAX_ENGINES
+MAX_ENGINES = 32
+_engines = OrderedDict()
+
+
+def get_engine(impl_rel, perm, fix_pos = None, placeholder = None, sep = ''):
+    """
+
+    Parameters
+    ----------
+    impl_rel : dict
+        Keys are 'all' or exception offenses and values are lists of implied values
+    perm : int
+        Maximum number of implied values combined in a permutation
+    fix_pos : dict, optional
+        Implied values that must be at a fixed position. Default is None
+    placeholder : dict, optional
+        Keys are placeholders in the implied values and values are lists of replacements. Default is None
+    sep : str, optional
+        Separator between implied values. Default is an empty string
+
+    Returns
+    -------
+    ImplicationEngine
+        Engine for the implications, created once and reused while it is among the MAX_ENGINES most recently used engines, so that its memoized results are shared
+
+    """
+    key = json.dumps([impl_rel, perm, fix_pos, placeholder, sep], sort_keys = True, default = str)
+    if key in _engines:
+        _engines.move_to_end(key)
+    else:
+        _engines[key] = ImplicationEngine(impl_rel = impl_rel, perm = perm, fix_pos = fix_pos, placeholder = placeholder, sep = sep)
+        if len(_engines) > MAX_ENGINES:
+            _engines.popitem(last = False)
+    return _engines[key]
+
+
+class ImpliedSelection():
+    """
+    Set-like selection of offense codes and their implied forms.
+
+    Membership tests use ImplicationEngine.is_implied() and never expand the offenses. Iterating over the selection expands it once through the engine.
+    """
+    def __init__(self, offenses, engine, how = 'inclusive'):
+        self.offenses = frozenset(offenses)
+        self.engine = engine
+        self.how = how
+
+    def __contains__(self, code):
+        return self.engine.is_implied(code, self.offenses, how = self.how)
+
+    def __iter__(self):
+        return iter(self.engine.expand(self.offenses, how = self.how))
+
+    def __len__(self):
+        return len(self.engine.expand(self.offenses, how = self.how))
+
+    def __bool__(self):
+        if self.how == 'inclusive':
+            return len(self.offenses) > 0
+        return len(self) > 0
+
+    def __eq__(self, other):
+        if isinstance(other, ImpliedSelection):
+            return (self.offenses, self.engine, self.how) == (other.offenses, other.engine, other.how)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self.offenses, id(self.engine), self.how))
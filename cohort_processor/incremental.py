@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# Eligibility of an ID before and after a run, as reported in the delta report
+ELIGIBILITY = {(False, True): 'entered', (True, False): 'left'}
+
+
+def id_row_hashes(df, id_codes, n_ids):
+    """
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Dataset of a cohort
+    id_codes : numpy array
+        Integer ID code of each row, -1 for missing IDs
+    n_ids : int
+        Number of IDs in the shared ID dictionary
+
+    Returns
+    -------
+    numpy array
+        Unsigned 64-bit hash of the rows of each ID, independent of the order of the rows and columns. 0 for IDs without rows
+
+    """
+    # Columns are hashed in name order so that a reordered extract hashes the same
+    rows = pd.util.hash_pandas_object(df[sorted(df.columns, key = str)], index = False).to_numpy(dtype = np.uint64)
+    valid = id_codes >= 0
+    out = np.zeros(n_ids, dtype = np.uint64)
+    # The sum of the row hashes wraps around and does not depend on the order of the rows
+    np.add.at(out, id_codes[valid], rows[valid])
+    # Keep IDs with rows apart from IDs without rows
+    out[(out == 0) & (np.bincount(id_codes[valid], minlength = n_ids) > 0)] = 1
+    return out
+
+
+def run_fingerprint(**kwargs):
+    """
+
+    Parameters
+    ----------
+    **kwargs
+        Everything that changes the result of a run besides the data, e.g. the canonical ruleset and the offense categorizations
+
+    Returns
+    -------
+    str
+        Hex digest that is identical for identical settings
+
+    """
+    return hashlib.blake2b(json.dumps(kwargs, sort_keys = True, default = str).encode(), digest_size = 16).hexdigest()
+
+
+def frame_hash(df):
+    """
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Any table, e.g. the offense categorizations
+
+    Returns
+    -------
+    str
+        Hex digest of the contents of the table
+
+    """
+    h = hashlib.blake2b(digest_size = 16)
+    h.update(json.dumps([str(c) for c in df.columns]).encode())
+    h.update(pd.util.hash_pandas_object(df, index = False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def load_state(state_dir):
+    """
+
+    Parameters
+    ----------
+    state_dir : str
+        Directory with the state of the previous run
+
+    Returns
+    -------
+    meta : dict or None
+        Settings and fingerprint of the previous run. None if there is no readable state
+    ids : pandas dataframe or None
+        Row hashes per dataset, disqualification and eligibility of each ID of the previous run, indexed by ID
+
+    """
+    try:
+        with open(os.path.join(state_dir, 'state.json'), 'r') as f:
+            meta = json.load(f)
+        file = os.path.join(state_dir, meta['file'])
+        ids = pd.read_parquet(file) if file.endswith('.parquet') else pd.read_pickle(file)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"No previous state could be read from {state_dir}: {e}")
+        return None, None
+    return meta, ids
+
+
+def save_state(state_dir, meta, ids):
+    """
+
+    Parameters
+    ----------
+    state_dir : str
+        Directory for the state of this run
+    meta : dict
+        Settings and fingerprint of the run
+    ids : pandas dataframe
+        Row hashes per dataset, disqualification and eligibility of each ID, indexed by ID
+
+    Returns
+    -------
+    None
+        Writes the ID table as Parquet (pickle if pyarrow is not installed or the IDs cannot be written to Parquet) and then the metadata, so that a failed write leaves the previous state readable
+
+    """
+    os.makedirs(state_dir, exist_ok = True)
+    file = None
+    if pyarrow is not None:
+        try:
+            file = 'ids.parquet'
+            ids.to_parquet(os.path.join(state_dir, file+".tmp"))
+        except Exception as e:
+            print(f"Could not write the state as parquet ({e}), falling back to pickle")
+            file = None
+    if file is None:
+        file = 'ids.pkl'
+        ids.to_pickle(os.path.join(state_dir, file+".tmp"))
+    os.replace(os.path.join(state_dir, file+".tmp"), os.path.join(state_dir, file))
+    tmp = os.path.join(state_dir, f"state.json.{os.getpid()}.tmp")
+    with open(tmp, 'w') as f:
+        json.dump(dict(meta, file = file), f, indent = 1, default = str)
+    os.replace(tmp, os.path.join(state_dir, 'state.json'))
+    return
+
+
+def diff_ids(prev, new, tables):
+    """
+
+    Parameters
+    ----------
+    prev : pandas dataframe
+        ID table of the previous run, see load_state()
+    new : pandas dataframe
+        Row hashes of this run, indexed by ID
+    tables : list
+        Hash columns, one per dataset
+
+    Returns
+    -------
+    pandas series
+        Change of each ID: 'added', 'changed', 'removed' or 'unchanged'. IDs whose rows changed in any dataset, or that appear in or disappear from a dataset, are 'changed'
+
+    """
+    ids = prev.index.union(new.index, sort = False)
+    # Datasets that are new or dropped since the previous run hash to 0 for every ID
+    before = prev.reindex(index = ids, columns = tables, fill_value = 0).to_numpy(dtype = np.uint64)
+    after = new.reindex(index = ids, columns = tables, fill_value = 0).to_numpy(dtype = np.uint64)
+    change = np.full(len(ids), 'unchanged', dtype = object)
+    change[(before != after).any(axis = 1)] = 'changed'
+    change[~ids.isin(prev.index)] = 'added'
+    change[~ids.isin(new.index)] = 'removed'
+    return pd.Series(change, index = ids, name = 'change')
+
+
+def delta_report(prev, new, change, id_var):
+    """
+
+    Parameters
+    ----------
+    prev : pandas dataframe or None
+        ID table of the previous run with the column 'qualifying'. None for the first run
+    new : pandas dataframe
+        ID table of this run with the column 'qualifying'
+    change : pandas series
+        Change of each ID, see diff_ids()
+    id_var : str
+        Name of the ID column of the report
+
+    Returns
+    -------
+    pandas dataframe
+        IDs that entered or left eligibility since the previous run, with their change in the data
+
+    """
+    ids = change.index
+    before = prev['qualifying'].reindex(ids, fill_value = False).to_numpy(dtype = bool) if prev is not None else np.zeros(len(ids), dtype = bool)
+    after = new['qualifying'].reindex(ids, fill_value = False).to_numpy(dtype = bool)
+    moved = before != after
+    return pd.DataFrame({id_var: ids[moved],
+                         'eligibility': [ELIGIBILITY[(b, a)] for b, a in zip(before[moved], after[moved])],
+                         'change': change.to_numpy()[moved]})
@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import utils
+from offense_codes import selected_values
+
+
+def normalize_column(data, prefix = "", remove = ['pc', 'rape', '\n', ' ']):
+    """
+
+    Parameters
+    ----------
+    data : pandas series
+        Column with raw offense or enhancement values
+    prefix : str, optional
+        Prefix to remove from each value, e.g. 'PC'. Default is an empty string
+    remove : list, optional
+        List of values to be removed from each value. Default is ['pc', 'rape', '\n', ' ']
+
+    Returns
+    -------
+    pandas categorical
+        Cleaned value of each row, identical to utils.strip_clean() applied on each row. Each distinct raw value is only cleaned once (see utils.clean_unique)
+
+    """
+    raw_codes, raw_uniques = pd.factorize(data, use_na_sentinel = True)
+    nan_value = utils.strip_clean(np.nan, remove = remove)
+    # Values that are not strings are cleaned to 'nan', as with pandas .str.replace()
+    is_str = np.array([isinstance(v, str) for v in raw_uniques], dtype = bool)
+    cleaned = np.full(len(raw_uniques)+1, nan_value, dtype = object)
+    cleaned[:-1][is_str] = utils.clean_unique([v.replace(prefix, "") if prefix else v for v in raw_uniques[is_str]], remove = remove)
+    # Missing values have the code -1 and pick up the last entry
+    clean_codes, uniques = pd.factorize(cleaned)
+    return pd.Categorical.from_codes(clean_codes[raw_codes], categories = pd.Index(uniques, dtype = object))
+
+
+def pairs_to_matrix(id_codes, col_codes, n_ids, n_cols):
+    """
+
+    Parameters
+    ----------
+    id_codes : numpy array
+        Integer ID code of each row, -1 for missing IDs
+    col_codes : numpy array
+        Column of the matrix set by each row
+    n_ids : int
+        Number of IDs in the shared ID dictionary
+    n_cols : int
+        Number of columns of the matrix
+
+    Returns
+    -------
+    numpy array
+        Boolean matrix of shape (n_ids, n_cols) that is True where any row of the ID has the column code
+
+    """
+    mat = np.zeros((n_ids, n_cols), dtype = bool)
+    valid = id_codes >= 0
+    mat[id_codes[valid], col_codes[valid]] = True
+    return mat
+
+
+def ranges(ptr, keys):
+    """
+
+    Parameters
+    ----------
+    ptr : numpy array
+        Offsets of the entries of each key in a grouped array, i.e. the entries of key k are ptr[k]:ptr[k+1]
+    keys : numpy array
+        Keys to gather
+
+    Returns
+    -------
+    numpy array
+        Positions of the entries of the keys in the grouped array, key by key
+
+    """
+    starts = ptr[keys]
+    lens = ptr[keys+1]-starts
+    return np.repeat(starts-(np.cumsum(lens)-lens), lens)+np.arange(lens.sum())
+
+
+class OffenseIndex():
+    """
+    Per-ID offense category bitsets of one offense column.
+
+    Every distinct cleaned offense value is assigned a signature, i.e. the set of offense categories that contain it. Each ID then holds two bitsets: the categories present in any of its rows, and the signatures present in any of its rows. Exclude rules become a bitwise AND test on the first and Include rules a subset test on the second, so that changing the selected categories never rescans the rows.
+    """
+    def __init__(self, id_codes, values, n_ids, type_selections, parsed = None):
+        # Offense categories in bit order
+        self.types = np.asarray(list(type_selections.keys()), dtype = object)
+        # Cleaned offense values of the rows, see normalize_column()
+        val_codes, uniques = values.codes, np.asarray(values.categories, dtype = object)
+        # Category membership of each distinct cleaned value
+        member = np.zeros((len(uniques), len(self.types)), dtype = bool)
+        for j, t in enumerate(self.types):
+            member[:, j] = selected_values(type_selections[t], uniques, parsed)
+        # Distinct combinations of categories (signatures), e.g. an offense that is both serious and violent
+        self.signatures, sig_of_value = np.unique(member, axis = 0, return_inverse = True)
+        row_sig = sig_of_value.reshape(-1)[val_codes]
+        # IDs present in the dataset
+        self.present = np.zeros(n_ids, dtype = bool)
+        self.present[id_codes[id_codes >= 0]] = True
+        # Per-ID bitsets of signatures and of categories present in any row
+        id_sig = pairs_to_matrix(id_codes, row_sig, n_ids, len(self.signatures))
+        self.id_signatures = np.packbits(id_sig, axis = 1)
+        self.id_types = np.packbits(id_sig.astype(np.uint8) @ self.signatures.astype(np.uint8) > 0, axis = 1)
+
+    @property
+    def nbytes(self):
+        return self.id_signatures.nbytes+self.id_types.nbytes+self.present.nbytes+self.signatures.nbytes
+
+    def type_mask(self, types):
+        """
+
+        Parameters
+        ----------
+        types : list
+            Selected offense categories
+
+        Returns
+        -------
+        numpy array
+            Boolean per category in bit order: True if the category is selected
+
+        """
+        return np.isin(self.types, list(types))
+
+    def disqualified(self, types, how, ids = None):
+        """
+
+        Parameters
+        ----------
+        types : list
+            Selected offense categories
+        how : str
+            'Exclude' disqualifies IDs with any offense in the selected categories. 'Include' disqualifies IDs with any offense outside of them
+        ids : numpy array, optional
+            Codes of the IDs to evaluate, e.g. the IDs that still qualify. Default is None, i.e. all IDs
+
+        Returns
+        -------
+        numpy array or None
+            Boolean mask over the shared ID codes of disqualified IDs, False for IDs that are not evaluated. None if the selection logic is not understood
+
+        """
+        sel = self.type_mask(types)
+        ids = slice(None) if ids is None else ids
+        out = np.zeros(len(self.present), dtype = bool)
+        if how == "Exclude":
+            # Any selected category present
+            out[ids] = (self.id_types[ids] & np.packbits(sel)).any(axis = 1)
+            return out
+        elif how == "Include":
+            # Any signature without a selected category present
+            outside = ~self.signatures[:, sel].any(axis = 1)
+            out[ids] = (self.id_signatures[ids] & np.packbits(outside)).any(axis = 1)
+            return out
+        print("Selection logic not understood")
+        return None
+
+
+class SentenceIndex():
+    """
+    Sorted per-ID minimum and maximum of a numeric column, e.g. the aggregate sentence in months.
+
+    An ID has a row outside of a range if and only if its minimum or maximum is outside of the range. Both are kept sorted, so the IDs outside of any range are found with a binary search, and cohort sizes for a whole range of thresholds are computed in one vectorized pass.
+    """
+    def __init__(self, id_codes, data, n_ids):
+        values = pd.to_numeric(pd.Series(np.asarray(data)), errors = 'coerce').to_numpy(dtype = float)
+        valid = (id_codes >= 0) & ~np.isnan(values)
+        agg = pd.DataFrame({'id': id_codes[valid], 'val': values[valid]}).groupby('id')['val'].agg(['min', 'max'])
+        # IDs without a value have NaN bounds and never fall outside of a range
+        self.id_min = np.full(n_ids, np.nan)
+        self.id_max = np.full(n_ids, np.nan)
+        self.id_min[agg.index.to_numpy()] = agg['min'].to_numpy()
+        self.id_max[agg.index.to_numpy()] = agg['max'].to_numpy()
+        # ID codes ordered by their minimum and maximum, and the sorted values
+        self.order_min = agg.index.to_numpy()[np.argsort(agg['min'].to_numpy(), kind = 'stable')]
+        self.order_max = agg.index.to_numpy()[np.argsort(agg['max'].to_numpy(), kind = 'stable')]
+        self.sorted_min = self.id_min[self.order_min]
+        self.sorted_max = self.id_max[self.order_max]
+        # IDs present in the dataset
+        self.present = np.zeros(n_ids, dtype = bool)
+        self.present[id_codes[id_codes >= 0]] = True
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in [self.id_min, self.id_max, self.order_min, self.order_max, self.sorted_min, self.sorted_max, self.present])
+
+    def below(self, min_length):
+        """
+
+        Parameters
+        ----------
+        min_length : float
+            Lower bound of the range
+
+        Returns
+        -------
+        numpy array
+            Codes of the IDs with any value below the bound
+
+        """
+        return self.order_min[:np.searchsorted(self.sorted_min, min_length, side = 'left')]
+
+    def above(self, max_length):
+        """
+
+        Parameters
+        ----------
+        max_length : float
+            Upper bound of the range
+
+        Returns
+        -------
+        numpy array
+            Codes of the IDs with any value above the bound
+
+        """
+        return self.order_max[np.searchsorted(self.sorted_max, max_length, side = 'right'):]
+
+    def disqualified(self, min_length = None, max_length = None, ids = None):
+        """
+
+        Parameters
+        ----------
+        min_length : float, optional
+            Lower bound of the range. Default is None, i.e. no lower bound
+        max_length : float, optional
+            Upper bound of the range. Default is None, i.e. no upper bound
+        ids : numpy array, optional
+            Codes of the IDs to evaluate, e.g. the IDs that still qualify. Default is None, i.e. all IDs
+
+        Returns
+        -------
+        numpy array
+            Boolean mask over the shared ID codes of IDs with any value outside of the range, False for IDs that are not evaluated. As in apply_sentence_length_rules, bounds that are 0 or None are not applied
+
+        """
+        out = np.zeros(len(self.present), dtype = bool)
+        if ids is not None:
+            # Compare the bounds of the evaluated IDs only. IDs without a value compare False
+            hit = np.zeros(len(ids), dtype = bool)
+            if max_length:
+                hit |= self.id_max[ids] > max_length
+            if min_length:
+                hit |= self.id_min[ids] < min_length
+            out[ids[hit]] = True
+            return out
+        if max_length:
+            out[self.above(max_length)] = True
+        if min_length:
+            out[self.below(min_length)] = True
+        return out
+
+    def curve(self, thresholds, bound = 'min', min_length = None, max_length = None, base = None):
+        """
+
+        Parameters
+        ----------
+        thresholds : list or numpy array
+            Values of the bound to evaluate, e.g. numpy.arange(0, 601)
+        bound : str, optional
+            Bound that takes the threshold values: 'min' or 'max'. Default is 'min'
+        min_length : float, optional
+            Fixed lower bound when bound = 'max'. Default is None
+        max_length : float, optional
+            Fixed upper bound when bound = 'min'. Default is None
+        base : numpy array, optional
+            Boolean mask over the shared ID codes of the IDs that qualify before this rule, e.g. the population minus IDs disqualified by other rules
+            Default is None, i.e. all IDs present in the dataset
+
+        Returns
+        -------
+        numpy array
+            Number of qualifying IDs for each threshold
+
+        """
+        thresholds = np.asarray(thresholds, dtype = float)
+        base = self.present.copy() if base is None else base.copy()
+        if bound == 'min':
+            # Apply the fixed bound, then count the remaining IDs below each threshold
+            if max_length:
+                base[self.above(max_length)] = False
+            vals = np.sort(self.id_min[base & ~np.isnan(self.id_min)])
+            out = np.searchsorted(vals, thresholds, side = 'left')
+        elif bound == 'max':
+            if min_length:
+                base[self.below(min_length)] = False
+            vals = np.sort(self.id_max[base & ~np.isnan(self.id_max)])
+            out = len(vals)-np.searchsorted(vals, thresholds, side = 'right')
+        else:
+            print("Bound not understood. Please pass either 'min' or 'max'")
+            return None
+        # Bounds that are 0 do not apply, as in apply_sentence_length_rules
+        out = np.where(thresholds == 0, 0, out)
+        return np.count_nonzero(base)-out
+
+
+class EnhancementIndex():
+    """
+    Long, deduplicated (row, enhancement) table of the offense enhancement columns.
+
+    The cleaned enhancement columns are melted once into pairs of row and enhancement code. Include and Exclude rules are then counts of selected codes per row and per ID instead of row-wise Python loops.
+    """
+    def __init__(self, id_codes, values, n_ids, nan_value = 'nan'):
+        # Cleaned values of each enhancement column (see normalize_column) mapped to a shared code space
+        n_rows = len(id_codes)
+        self.values = pd.Index(pd.unique(np.concatenate([np.asarray(v.categories, dtype = object) for v in values]+[np.array([nan_value], dtype = object)])), dtype = object)
+        codes = np.concatenate([self.values.get_indexer(v.categories)[v.codes] for v in values]) if values else np.array([], dtype = np.int64)
+        rows = np.tile(np.arange(n_rows), len(values))
+        # Missing values are cleaned to 'nan'. They are only flagged per row instead of being stored
+        self.nan_value = nan_value
+        missing = codes == self.values.get_loc(nan_value)
+        self.row_missing = missing.reshape(len(values), n_rows).any(axis = 0) if values else np.zeros(n_rows, dtype = bool)
+        # Deduplicate values within each row
+        pairs = np.unique(rows[~missing].astype(np.int64)*len(self.values)+codes[~missing])
+        self.rows = (pairs // len(self.values)).astype(np.int64)
+        self.codes = (pairs % len(self.values)).astype(np.int32)
+        self.row_ids = np.asarray(id_codes)
+        # Offsets of the pairs of each row (pairs are sorted by row), and the rows of each ID grouped by ID
+        self.row_ptr = np.searchsorted(self.rows, np.arange(n_rows+1))
+        self.id_rows = np.argsort(self.row_ids, kind = 'stable')
+        self.id_ptr = np.searchsorted(self.row_ids[self.id_rows], np.arange(n_ids+1))
+        # IDs present in the dataset
+        self.present = np.zeros(n_ids, dtype = bool)
+        self.present[self.row_ids[self.row_ids >= 0]] = True
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in [self.rows, self.codes, self.row_ids, self.row_missing, self.present, self.row_ptr, self.id_rows, self.id_ptr])
+
+    def selected_per_row(self, sel, rows = None):
+        """
+
+        Parameters
+        ----------
+        sel : set-like
+            Selected cleaned enhancement codes, see offense_codes.selected_values()
+        rows : numpy array, optional
+            Rows to count. Default is None, i.e. all rows
+
+        Returns
+        -------
+        numpy array
+            Number of distinct selected codes in each row, or in each of the given rows
+
+        """
+        hit = selected_values(sel, self.values)
+        if rows is None:
+            counts = np.bincount(self.rows[hit[self.codes]], minlength = len(self.row_ids))
+            missing = self.row_missing
+        else:
+            # Only the pairs of the given rows are gathered
+            pos = ranges(self.row_ptr, rows)
+            pair_rows = np.repeat(np.arange(len(rows)), self.row_ptr[rows+1]-self.row_ptr[rows])
+            counts = np.bincount(pair_rows[hit[self.codes[pos]]], minlength = len(rows))
+            missing = self.row_missing[rows]
+        # Missing values count as the cleaned value 'nan', once per row
+        if self.nan_value in sel:
+            counts = counts+missing
+        return counts
+
+    def disqualified(self, sel, how, ids = None):
+        """
+
+        Parameters
+        ----------
+        sel : list or set
+            Selected cleaned enhancement codes
+        how : str
+            'Exclude' disqualifies IDs with a row that has more than one of the selected codes. 'Include' disqualifies IDs without any row that has a selected code
+        ids : numpy array, optional
+            Codes of the IDs to evaluate, e.g. the IDs that still qualify. Default is None, i.e. all IDs
+
+        Returns
+        -------
+        numpy array or None
+            Boolean mask over the shared ID codes of disqualified IDs, False for IDs that are not evaluated. None if the selection logic is not understood
+
+        """
+        if ids is None:
+            rows, evaluated = None, self.present
+        else:
+            # Rows of the evaluated IDs
+            rows = self.id_rows[ranges(self.id_ptr, ids)]
+            evaluated = np.zeros(len(self.present), dtype = bool)
+            evaluated[ids] = self.present[ids]
+        counts = self.selected_per_row(sel, rows)
+        row_ids = self.row_ids if rows is None else self.row_ids[rows]
+        valid = row_ids >= 0
+        out = np.zeros(len(self.present), dtype = bool)
+        if how == "Exclude":
+            out[row_ids[valid & (counts > 1)]] = True
+            return out
+        elif how == "Include":
+            out[row_ids[valid & (counts > 0)]] = True
+            return evaluated & ~out
+        print("Selection logic not understood")
+        return None
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 from cohort_processor import CohortGenerator
 import config
-import json
+import compare
+import idmap
+import os
 import pandas as pd
 
 ruleset = {'criteria': {'controlling_offense': {'Controlling Offense': {'types': ['Serious felonies', 'Super strike offenses', 'Violent felonies', 'Registrable sex offenses'],
@@ -49,15 +51,13 @@ cohort.demographics
 cohort.current_commitments
 cohort.prior_commitments
 
-# Get ID map 
-with open(config.HASH_OBJ_MAP, 'r') as file: 
-    map_ids = json.load(file)
+# Get ID map, memory-mapped from its binary form. It is converted from the JSON dictionary once
+if not os.path.isdir(config.HASH_ID_MAP):
+    idmap.IDMap.from_json(config.HASH_OBJ_MAP).save(config.HASH_ID_MAP)
+id_map = idmap.IDMap.load(config.HASH_ID_MAP)
     
-# Get IDs in cohort not in another cohort 
-diff_ids = []
+# Get records of IDs in cohort not in another cohort 
 demographics_nnn = pd.read_excel(config.NNN_DATA_URL)
-for id_val in cohort.demographics['cdcno']:
-    if map_ids[id_val] not in list(demographics_nnn['cdcno']):
-        diff_ids.append(id_val)
+in_nnn = compare.is_member(id_map.map_ids(cohort.demographics['cdcno']), demographics_nnn['cdcno'])
         
-cohort.demographics[cohort.demographics.isin(diff_ids)].to_excel('test.xlsx')
+cohort.demographics[~in_nnn].to_excel('test.xlsx')
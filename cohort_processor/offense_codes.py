@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+import json
+import re
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+# Leading code section, e.g. '459', '12022.53' or 'hs11352'
+BASE = re.compile(r"[a-z]*\d+(?:\.\d+)*")
+# Parenthesized groups, slash modifiers and plain runs of the remainder of a code
+TOKEN = re.compile(r"\([^()]*\)|/[a-z]+|[^(/]+|/")
+# Degree of an offense, e.g. '2nd'
+DEGREE = re.compile(r"\d(?:st|nd|rd|th)")
+# Notations of an attempted offense
+ATTEMPT = ('/att', '(664)')
+
+# Parsed codes are cached by code. The least recently used codes are dropped beyond PARSE_MEMO_SIZE
+PARSE_MEMO_SIZE = 100000
+_parse_memo = OrderedDict()
+
+
+def classify(token):
+    """
+
+    Parameters
+    ----------
+    token : str
+        A single implied value, e.g. '/att', '(664)' or '2nd'
+
+    Returns
+    -------
+    str
+        'attempt', 'degree' or the token itself for any other modifier
+
+    """
+    if token in ATTEMPT:
+        return 'attempt'
+    if DEGREE.fullmatch(token):
+        return 'degree'
+    return token
+
+
+def parse_code(code):
+    """
+
+    Parameters
+    ----------
+    code : str
+        Cleaned offense code, e.g. '459/att(664)2nd' or '245(a)(1)'
+
+    Returns
+    -------
+    tuple
+        Base section, subsection chain, implied values in order, attempt flag and degree
+        For example, '288(a)2nd' returns ('288', ('(a)', ), ('2nd', ), False, '2nd'). Codes without a leading section are returned whole as the base
+
+    """
+    try:
+        parsed = _parse_memo[code]
+        _parse_memo.move_to_end(code)
+        return parsed
+    except (KeyError, TypeError):
+        pass
+    m = BASE.match(code) if isinstance(code, str) else None
+    if m is None:
+        parsed = (code, (), (), False, '')
+    else:
+        base, rest = m.group(0), code[m.end():]
+        # Spaces are removed when cleaning, so '459 2nd' becomes '4592nd'
+        if (rest[:2] in ('st', 'nd', 'rd', 'th')) and DEGREE.fullmatch(base[-1]+rest[:2]) and (len(base) > 1):
+            base, rest = base[:-1], base[-1]+rest
+        subsections, implied = [], []
+        for token in TOKEN.findall(rest):
+            # Degrees may follow other text in the same plain run, e.g. '/att2nd'
+            for t in ([token] if token.startswith(('(', '/')) else re.split(r"(\d(?:st|nd|rd|th))", token)):
+                if t == '':
+                    continue
+                # Parenthesized groups directly after the section form the subsection chain
+                if (len(implied) == 0) and t.startswith('(') and (classify(t) == t):
+                    subsections.append(t)
+                else:
+                    implied.append(t)
+        degrees = [t for t in implied if classify(t) == 'degree']
+        parsed = (base, tuple(subsections), tuple(implied), any(t in ATTEMPT for t in implied), degrees[0] if degrees else '')
+    try:
+        _parse_memo[code] = parsed
+    except TypeError:
+        return parsed
+    if len(_parse_memo) > PARSE_MEMO_SIZE:
+        _parse_memo.popitem(last = False)
+    return parsed
+
+
+class ParsedCodes():
+    """
+    Columnar fields of the parsed distinct codes of one cleaned column.
+
+    Each distinct cleaned code is parsed once. The fields are arrays over the distinct codes and the code of each row is kept, so that row-level fields are a single gather.
+    """
+    def __init__(self, categories, codes = None):
+        # Distinct cleaned values and the code of each row, see indexes.normalize_column()
+        self.values = np.asarray(categories, dtype = object)
+        self.codes = np.asarray(codes if codes is not None else np.arange(len(self.values)))
+        parsed = [parse_code(v) for v in self.values]
+        self.base = np.array([p[0] for p in parsed], dtype = object)
+        self.subsections = np.array([''.join(p[1]) for p in parsed], dtype = object)
+        self.section = self.base+self.subsections
+        self.implied = np.empty(len(parsed), dtype = object)
+        self.implied[:] = [p[2] for p in parsed]
+        self.n_implied = np.array([len(p[2]) for p in parsed], dtype = int)
+        self.distinct = np.array([len(set(p[2])) == len(p[2]) for p in parsed], dtype = bool)
+        self.attempt = np.array([p[3] for p in parsed], dtype = bool)
+        self.degree = np.array([p[4] for p in parsed], dtype = object)
+        self.n_degrees = np.array([sum(classify(t) == 'degree' for t in p[2]) for p in parsed], dtype = int)
+        # Implied values other than attempt and degree notations
+        self.n_modifiers = np.array([sum(classify(t) not in ('attempt', 'degree') for t in p[2]) for p in parsed], dtype = int)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes+self.n_implied.nbytes+self.distinct.nbytes+self.attempt.nbytes+self.n_degrees.nbytes+self.n_modifiers.nbytes
+
+    def row(self, field):
+        """
+
+        Parameters
+        ----------
+        field : str
+            Name of a parsed field, e.g. 'section', 'attempt' or 'degree'
+
+        Returns
+        -------
+        numpy array
+            Field value of each row
+
+        """
+        return getattr(self, field)[self.codes]
+
+    def to_frame(self):
+        """
+
+        Returns
+        -------
+        pandas dataframe
+            Parsed fields of each row, aligned with the rows of the column
+
+        """
+        return pd.DataFrame({'base': self.row('base'),
+                             'subsections': self.row('subsections'),
+                             'attempt': self.row('attempt'),
+                             'degree': self.row('degree'),
+                             'modifiers': [''.join(i) for i in self.row('implied')]})
+
+
+class StructuredSelection():
+    """
+    Set-like selection of offense codes matched on parsed fields instead of enumerated implied codes.
+
+    A code is selected if it is one of the offenses, or if its section (base and subsection chain) is the section of a selected offense and its implied values are allowed by the implications of that offense. Attempt notations ('/att', '(664)') are interchangeable and degrees match on their value. Permutation limits apply to the number of implied values and their order is ignored, so 'fix positions' is not used.
+    """
+    def __init__(self, offenses, implications = None):
+        self.offenses = frozenset(offenses)
+        implications = implications or {}
+        self.spec = json.dumps(implications, sort_keys = True, default = str)
+        self.perm = implications.get('perm') or 1
+        impl_rel = implications.get('codes') or {}
+        placeholder = implications.get('placeholder') or {}
+        # Allowed implied values of each section: attempt flag, degrees and other modifiers
+        self.allowed = {}
+        for off in self.offenses:
+            base, subsections, implied, _, _ = parse_code(off)
+            # Offenses that carry implied values themselves are only matched exactly
+            if implied:
+                continue
+            vals = impl_rel[off] if off in impl_rel else impl_rel.get('all')
+            if vals is None:
+                continue
+            # Placeholders are replaced by each of their values
+            if placeholder:
+                vals = [v.replace(p, repl) for v in vals for p in placeholder.keys() for repl in placeholder[p]]
+            kinds = [classify(v) for v in vals]
+            self.allowed[base+''.join(subsections)] = ('attempt' in kinds,
+                                                       frozenset(v for v, k in zip(vals, kinds) if k == 'degree'),
+                                                       frozenset(v for v, k in zip(vals, kinds) if k not in ('attempt', 'degree')))
+        self.bases = frozenset(parse_code(s)[0] for s in self.allowed.keys())
+
+    def _allows(self, section, implied):
+        if (section not in self.allowed) or (len(implied) == 0) or (len(implied) > self.perm) or (len(set(implied)) != len(implied)):
+            return False
+        attempt, degrees, others = self.allowed[section]
+        for t in implied:
+            kind = classify(t)
+            if ((kind == 'attempt') and not attempt) or ((kind == 'degree') and (t not in degrees)) or ((kind not in ('attempt', 'degree')) and (t not in others)):
+                return False
+        return True
+
+    def _matches(self, code):
+        base, subsections, implied, _, _ = parse_code(code)
+        if base not in self.bases:
+            return False
+        # The longest subsection chain that is a selected section, the rest of the chain counts as implied values
+        for k in range(len(subsections), -1, -1):
+            section = base+''.join(subsections[:k])
+            if section in self.allowed:
+                return self._allows(section, subsections[k:]+implied)
+        return False
+
+    def __contains__(self, code):
+        return (code in self.offenses) or (isinstance(code, str) and self._matches(code))
+
+    def match(self, parsed):
+        """
+
+        Parameters
+        ----------
+        parsed : ParsedCodes
+            Parsed distinct codes of a column
+
+        Returns
+        -------
+        numpy array
+            Boolean mask over the distinct codes of the selected ones
+
+        """
+        out = np.isin(parsed.values, list(self.offenses))
+        n_ok = (parsed.n_implied > 0) & (parsed.n_implied <= self.perm) & parsed.distinct
+        full = np.isin(parsed.section, list(self.allowed.keys()))
+        for section, (attempt, degrees, others) in self.allowed.items():
+            rows = full & n_ok & (parsed.section == section)
+            if not attempt:
+                rows &= ~parsed.attempt
+            rows &= (parsed.degree == '') | np.isin(parsed.degree, list(degrees))
+            # Other modifiers and codes with several degrees are rare and checked one code at a time
+            check = np.flatnonzero(rows & ((parsed.n_modifiers > 0) | (parsed.n_degrees > 1)))
+            rows[check] = [self._allows(section, parsed.implied[i]) for i in check]
+            out |= rows
+        # Codes whose subsection chain extends a selected section
+        partial = np.flatnonzero(~full & ~out & np.isin(parsed.base, list(self.bases)))
+        out[partial] = [self._matches(parsed.values[i]) for i in partial]
+        return out
+
+    def __iter__(self):
+        return iter(self.offenses)
+
+    def __len__(self):
+        return len(self.offenses)
+
+    def __eq__(self, other):
+        if isinstance(other, StructuredSelection):
+            return (self.offenses, self.spec) == (other.offenses, other.spec)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self.offenses, self.spec))
+
+
+def selected_values(sel, categories, parsed = None):
+    """
+
+    Parameters
+    ----------
+    sel : set-like
+        Selected cleaned codes, e.g. a frozenset, impl.ImpliedSelection, StructuredSelection or patterns.PatternSelection
+    categories : array-like
+        Distinct cleaned codes of a column
+    parsed : ParsedCodes, optional
+        Parsed fields of the same distinct codes. Default is None, i.e. they are parsed when needed
+
+    Returns
+    -------
+    numpy array
+        Boolean mask over the distinct codes of the selected ones
+
+    """
+    if isinstance(sel, StructuredSelection):
+        return sel.match(parsed if parsed is not None else ParsedCodes(categories))
+    # Selections that match all distinct codes in one pass
+    if hasattr(sel, 'match_values'):
+        return sel.match_values(categories)
+    # Set-like selections answer membership tests without being expanded
+    if isinstance(sel, (list, tuple)):
+        sel = set(sel)
+    return np.array([v in sel for v in categories], dtype = bool)
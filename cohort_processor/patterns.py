@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+import numpy as np
+
+
+class AhoCorasick():
+    """
+    Aho-Corasick automaton over a set of patterns.
+
+    The automaton is built once per set of patterns. Searching a text then takes time linear in the length of the text plus the number of matches, whatever the number of patterns. The trie of the automaton also answers prefix queries.
+    """
+    def __init__(self, patterns):
+        # Empty patterns would match every text and are left out
+        self.patterns = list(dict.fromkeys(p for p in patterns if p))
+        # Trie transitions, failure links, patterns found at each node and nodes where a pattern ends
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        self.ends = [False]
+        for i, p in enumerate(self.patterns):
+            node = 0
+            for ch in p:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.ends.append(False)
+                    self.goto[node][ch] = nxt
+                node = nxt
+            self.out[node].append(i)
+            self.ends[node] = True
+        # Failure links in breadth-first order, so that the link of a node's parent is always known
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and (ch not in self.goto[f]):
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt]+self.out[self.fail[nxt]]
+
+    def _step(self, node, ch):
+        while node and (ch not in self.goto[node]):
+            node = self.fail[node]
+        return self.goto[node].get(ch, 0)
+
+    def find(self, text):
+        """
+
+        Parameters
+        ----------
+        text : str
+            Text to search
+
+        Returns
+        -------
+        set
+            Patterns contained in the text
+
+        """
+        found, node = set(), 0
+        for ch in text:
+            node = self._step(node, ch)
+            for i in self.out[node]:
+                found.add(self.patterns[i])
+        return found
+
+    def contains(self, text):
+        """
+
+        Parameters
+        ----------
+        text : str
+            Text to search
+
+        Returns
+        -------
+        bool
+            True if any pattern is contained in the text. Stops at the first match
+
+        """
+        node = 0
+        for ch in text:
+            node = self._step(node, ch)
+            if self.out[node]:
+                return True
+        return False
+
+    def startswith(self, text):
+        """
+
+        Parameters
+        ----------
+        text : str
+            Text to search
+
+        Returns
+        -------
+        bool
+            True if the text starts with any pattern. Only the trie is walked, from its root
+
+        """
+        node = 0
+        for ch in text:
+            node = self.goto[node].get(ch)
+            if node is None:
+                return False
+            if self.ends[node]:
+                return True
+        return False
+
+
+class PatternSelection():
+    """
+    Set-like selection of codes that contain, or start with, any of the selected offenses.
+
+    The automaton is built once per selection and run over the distinct values of a column instead of comparing every value with every selected offense.
+    """
+    def __init__(self, patterns, how = 'contains'):
+        self.patterns = frozenset(p for p in patterns if isinstance(p, str))
+        self.how = how
+        self._automaton = None
+
+    @property
+    def automaton(self):
+        if self._automaton is None:
+            self._automaton = AhoCorasick(sorted(self.patterns))
+        return self._automaton
+
+    def __contains__(self, code):
+        if not isinstance(code, str):
+            return False
+        if self.how == 'prefix':
+            return self.automaton.startswith(code)
+        return self.automaton.contains(code)
+
+    def match_values(self, categories):
+        """
+
+        Parameters
+        ----------
+        categories : array-like
+            Distinct cleaned codes of a column
+
+        Returns
+        -------
+        numpy array
+            Boolean mask over the distinct codes of the selected ones
+
+        """
+        return np.array([v in self for v in categories], dtype = bool)
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __eq__(self, other):
+        if isinstance(other, PatternSelection):
+            return (self.patterns, self.how) == (other.patterns, other.how)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self.patterns, self.how))
@@ -2,7 +2,7 @@
 from tqdm import tqdm
 from cohort_processor import CohortGenerator
 import config
-from pandas import ExcelWriter
+import export
 
 
 ruleset = {'criteria': {'controlling_offense': {'Controlling Offense': {'types': ['Serious felonies', 'Super strike offenses', 'Violent felonies', 'Registrable sex offenses'],
@@ -55,11 +55,11 @@ qual_cohort_current_commits_enh = cohort.current_commitments_raw[cohort.current_
 qual_cohort_prior_commits_enh = cohort.prior_commitments_raw[cohort.prior_commitments_raw[cohort.id].isin(enh_qual_ids)]
 qual_cohort_demographics_enh = cohort.demographics_raw[cohort.demographics_raw[cohort.id].isin(enh_qual_ids)]
     
-# Write output
-with ExcelWriter("output.xlsx") as writer:
-    qual_cohort_current_commits.to_excel(writer, sheet_name='Current Commits', startrow = 6)
-    qual_cohort_prior_commits.to_excel(writer, sheet_name='Prior Commits', startrow = 6)
-    qual_cohort_demographics.to_excel(writer, sheet_name='Demographics', startrow = 6)
-    qual_cohort_current_commits_enh.to_excel(writer, sheet_name='Current Commits (Enh)', startrow = 6)
-    qual_cohort_prior_commits_enh.to_excel(writer, sheet_name='Prior Commits (Enh)', startrow = 6)
-    qual_cohort_demographics_enh.to_excel(writer, sheet_name='Demographics (Enh)', startrow = 6)
+# Write output, streaming rows with openpyxl in write-only mode
+export.write_excel({'Current Commits': qual_cohort_current_commits, 
+                    'Prior Commits': qual_cohort_prior_commits, 
+                    'Demographics': qual_cohort_demographics, 
+                    'Current Commits (Enh)': qual_cohort_current_commits_enh, 
+                    'Prior Commits (Enh)': qual_cohort_prior_commits_enh, 
+                    'Demographics (Enh)': qual_cohort_demographics_enh}, 
+                   "output.xlsx", startrow = 6, index = True)
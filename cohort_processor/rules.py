@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+import json
+import sys
+import traceback
+import numpy as np
+import pandas as pd
+import impl
+import offense_codes
+import patterns
+import utils
+
+# A single compiled criterion of a ruleset. All fields are resolved when the ruleset is compiled so that executing the plan does not read the ruleset dictionary again
+Rule = namedtuple('Rule', ['name',          # Criteria type in the ruleset, e.g. 'prior_commitments'
+                           'kind',          # 'offense', 'sentence' or 'enhancement'
+                           'kernel',        # Name of the CohortGenerator method that applies the rule
+                           'data_label',    # Attribute with the dataset to query, e.g. 'demographics_raw'
+                           'columns',       # Resolved column names queried by the rule
+                           'how',           # 'Include' or 'Exclude' for offense and enhancement rules
+                           'selection',     # Set-like selection of cleaned codes, including implied codes
+                           'types',         # Tuple of selected offense categories
+                           'implications',  # Canonical JSON of the implications used to expand the selection
+                           'match',         # How selected offenses match the data: 'exact', 'structured', 'contains' or 'prefix'
+                           'min_length',    # Lower bound of sentence rules
+                           'max_length',    # Upper bound of sentence rules
+                           'spec'])         # Canonical JSON of the criterion in the ruleset
+
+# Kernel applying each kind of rule
+KERNELS = {'offense': 'apply_offense_category_rules',
+           'sentence': 'apply_sentence_length_rules',
+           'enhancement': 'apply_enhancement_rules'}
+
+# Ways of matching selected offenses with the data
+MATCH_MODES = ('exact', 'structured', 'contains', 'prefix')
+
+# Relative cost of evaluating a rule on a single row
+ROW_COST = {'sentence': 1, 'offense': 5, 'enhancement': 25}
+
+
+def print_error(e):
+    """
+
+    Parameters
+    ----------
+    e : Exception
+        Exception raised while processing a criterion
+
+    Returns
+    -------
+    None
+        Prints the error and the full traceback without stopping the rule application process
+
+    """
+    print(f"An error occurred: {e}")
+    print("Full error description:\n")
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    trace = traceback.format_exception(exc_type, exc_value, exc_traceback)
+    for line in trace:
+        print(line, end = "")
+    return
+
+
+def criteria_kind(criteria_type):
+    """
+
+    Parameters
+    ----------
+    criteria_type : str
+        Criteria type in the ruleset, e.g. 'current_commitments', 'sentence_length' or 'offense_enhancements'
+
+    Returns
+    -------
+    str or None
+        Kind of rule: 'offense', 'sentence' or 'enhancement'. None if the criteria type is not understood
+
+    """
+    if ((("commit" in criteria_type) or ("offense" in criteria_type)) and ('enhancement' not in criteria_type)):
+        return 'offense'
+    elif "sentence" in criteria_type:
+        return 'sentence'
+    elif 'enhancement' in criteria_type:
+        return 'enhancement'
+    return None
+
+
+def canonical(spec):
+    """
+
+    Parameters
+    ----------
+    spec : dict
+        Any part of a ruleset
+
+    Returns
+    -------
+    str
+        JSON with sorted keys that is identical for equal specifications
+
+    """
+    return json.dumps(spec, sort_keys = True, default = str)
+
+
+def expand_selection(offenses, implications = None, match = 'exact'):
+    """
+
+    Parameters
+    ----------
+    offenses : list
+        Offense codes as listed in the offense categorizations
+    implications : dict, optional
+        Implications of the criterion with the keys 'codes', 'perm', 'fix positions' and 'placeholder'. Default is None
+    match : str, optional
+        'exact' to match the implied codes, 'structured' to match the parsed fields of the codes (see offense_codes.StructuredSelection), 'contains' to match codes containing any offense or 'prefix' to match codes starting with any offense. Implications are not used by 'contains' and 'prefix'. Default is 'exact'
+
+    Returns
+    -------
+    set-like
+        Cleaned offense codes and their implied forms. With implications, a set-like selection whose membership tests do not expand the offenses
+
+    """
+    offenses = utils.clean_blk(data = list(offenses))
+    if match == 'structured':
+        return offense_codes.StructuredSelection(offenses, implications)
+    elif match in ('contains', 'prefix'):
+        return patterns.PatternSelection(offenses, how = match)
+    if not implications:
+        return frozenset(offenses)
+    # Implied selections from permutations, etc. Engines are shared by all criteria with the same implications
+    engine = impl.get_engine(impl_rel = implications['codes'],
+                             perm = implications.get('perm') or 1,
+                             fix_pos = implications.get('fix positions'),
+                             placeholder = implications.get('placeholder'),
+                             sep = '')
+    return impl.ImpliedSelection(offenses, engine, how = 'inclusive')
+
+
+def resolve_selection(offense_categories, types, implications = None, match = 'exact'):
+    """
+
+    Parameters
+    ----------
+    offense_categories : pandas dataframe
+        Offense categorizations with the columns "Type" and "Offenses"
+    types : list
+        Selected offense categories
+    implications : dict, optional
+        Implications of the criterion with the keys 'codes', 'perm', 'fix positions' and 'placeholder'. Default is None
+    match : str, optional
+        'exact', 'structured', 'contains' or 'prefix', see expand_selection(). Default is 'exact'
+
+    Returns
+    -------
+    set-like
+        Cleaned offense codes in the selected categories and their implied forms
+
+    """
+    sel = list(offense_categories[offense_categories["Type"].isin(types)]["Offenses"])
+    print(f"Found {len(sel)} offenses in the selected offense categories")
+    return expand_selection(sel, implications, match)
+
+
+def resolve_type_selections(offense_categories, implications = None, match = 'exact'):
+    """
+
+    Parameters
+    ----------
+    offense_categories : pandas dataframe
+        Offense categorizations with the columns "Type" and "Offenses"
+    implications : dict, optional
+        Implications applied to the offenses of every category. Default is None
+    match : str, optional
+        'exact', 'structured', 'contains' or 'prefix', see expand_selection(). Default is 'exact'
+
+    Returns
+    -------
+    dict
+        Cleaned offense codes and their implied forms for each category. The union over any list of categories equals resolve_selection() for that list
+
+    """
+    return {t: expand_selection(gp["Offenses"], implications, match) for t, gp in offense_categories.groupby("Type", sort = False)}
+
+
+def selection_fingerprint(selection):
+    """
+
+    Parameters
+    ----------
+    selection : set-like or None
+        Resolved selection of a compiled rule, see expand_selection()
+
+    Returns
+    -------
+    str or None
+        Canonical JSON of the selected offenses and the kind of selection. Implied codes are not expanded, the implications are part of the rule
+
+    """
+    if selection is None:
+        return None
+    offenses = getattr(selection, 'offenses', getattr(selection, 'patterns', selection))
+    return canonical({'kind': type(selection).__name__, 
+                      'offenses': sorted(str(o) for o in offenses), 
+                      'how': getattr(selection, 'how', None)})
+
+
+def rule_fingerprint(rule):
+    """
+
+    Parameters
+    ----------
+    rule : Rule
+        Compiled rule
+
+    Returns
+    -------
+    str
+        Canonical JSON of everything that determines the result of the rule besides its dataset: the criterion, the resolved columns and the resolved selection
+
+    """
+    return canonical({'spec': rule.spec, 
+                      'kind': rule.kind, 
+                      'data_label': rule.data_label, 
+                      'columns': list(rule.columns), 
+                      'how': rule.how, 
+                      'selection': selection_fingerprint(rule.selection), 
+                      'match': rule.match, 
+                      'min_length': rule.min_length, 
+                      'max_length': rule.max_length})
+
+
+def compile_criterion(criteria_type, criterion, offense_categories, clean_col_names, off_enh_cols):
+    """
+
+    Parameters
+    ----------
+    criteria_type : str
+        Criteria type in the ruleset
+    criterion : dict
+        Single-key dictionary of the queried variable and its specification
+    offense_categories : pandas dataframe
+        Offense categorizations with the columns "Type" and "Offenses"
+    clean_col_names : bool
+        Whether the column names of the datasets were cleaned
+    off_enh_cols : list
+        Columns with offense enhancements
+
+    Returns
+    -------
+    Rule or None
+        Compiled rule. None if the criterion selects nothing and should not be applied
+
+    """
+    kind = criteria_kind(criteria_type)
+    if kind is None:
+        print("Cannot process criteria type. It is neither offense nor sentence related")
+        return None
+    # Get the variable with the data and its specification
+    var = list(criterion.keys())[0]
+    spec = criterion[var]
+    data_label = spec['data_label']+"_raw"
+    print(f"Extracting data from file labeled: {data_label}")
+
+    if kind == 'sentence':
+        columns = (var, )
+        print(f"Selected column: {var}; Raw dataset: {data_label}; Range: {spec['min'], spec['max']}")
+        selection, how, types, implications, match = None, None, None, None, None
+        min_length, max_length = spec['min'], spec['max']
+    else:
+        match = spec.get('match', 'exact')
+        if match not in MATCH_MODES:
+            print(f"Match mode {match} not understood. Please pass one of {MATCH_MODES}")
+            return None
+        # Get the selected offenses from the ruleset. "Type" and "Offenses" are columns in the selection criteria
+        selection = resolve_selection(offense_categories, spec['types'], spec.get('implications'), match)
+        if not selection:
+            print("No offense codes could be retrieved from the categorizations list. No offense related rules will be applied.")
+            return None
+        how = spec['mode']
+        types = tuple(spec['types'])
+        implications = canonical(spec.get('implications'))
+        print(f"Selected column: {var}; Raw dataset: {data_label}; Logic: {how}")
+        columns = tuple(off_enh_cols or ()) if kind == 'enhancement' else (var, )
+        # Without enhancement columns an Include rule would disqualify every ID
+        if not columns:
+            print(f"No offense enhancement columns were passed for {criteria_type}. Please pass off_enh_cols. No enhancement related rules will be applied.")
+            return None
+        min_length, max_length = None, None
+
+    # Clean col name from ruleset mapping
+    if clean_col_names:
+        columns = tuple(utils.clean_var_names(list(columns), rem = ["\n"]))
+
+    return Rule(name = criteria_type,
+                kind = kind,
+                kernel = KERNELS[kind],
+                data_label = data_label,
+                columns = columns,
+                how = how,
+                selection = selection,
+                types = types,
+                implications = implications,
+                match = match,
+                min_length = min_length,
+                max_length = max_length,
+                spec = canonical({criteria_type: criterion}))
+
+
+def compile_ruleset(ruleset, offense_categories, clean_col_names, off_enh_cols = None, cache = None):
+    """
+
+    Parameters
+    ----------
+    ruleset : dict
+        Ruleset with the key 'criteria'
+    offense_categories : pandas dataframe
+        Offense categorizations with the columns "Type" and "Offenses"
+    clean_col_names : bool
+        Whether the column names of the datasets were cleaned
+    off_enh_cols : list, optional
+        Columns with offense enhancements. Default is None
+    cache : dict, optional
+        Compiled criteria from earlier calls with the same offense categorizations. Criteria found in it are not compiled again and new ones are added to it
+        Default is None
+
+    Returns
+    -------
+    plan : tuple of Rule
+        Immutable execution plan with one rule per criterion in the ruleset, in the order of the ruleset. Criteria that cannot be compiled are reported and left out
+
+    """
+    plan = []
+    for criteria_type in ruleset['criteria'].keys():
+        key = (canonical({criteria_type: ruleset['criteria'][criteria_type]}), clean_col_names, tuple(off_enh_cols or []))
+        if (cache is not None) and (key in cache):
+            rule = cache[key]
+        else:
+            print(f"Compiling criteria type: {criteria_type}")
+            try:
+                rule = compile_criterion(criteria_type = criteria_type,
+                                         criterion = ruleset['criteria'][criteria_type],
+                                         offense_categories = offense_categories,
+                                         clean_col_names = clean_col_names,
+                                         off_enh_cols = off_enh_cols or [])
+            except Exception as e:
+                print_error(e)
+                continue
+            if cache is not None:
+                cache[key] = rule
+        if rule is not None:
+            plan.append(rule)
+    return tuple(plan)
+
+
+def required_columns(ruleset, clean_col_names, off_enh_cols = None, id_var = None):
+    """
+
+    Parameters
+    ----------
+    ruleset : dict
+        Ruleset with the key 'criteria'
+    clean_col_names : bool
+        Whether the column names of the datasets are cleaned
+    off_enh_cols : list, optional
+        Columns with offense enhancements. Default is None
+    id_var : str, optional
+        Name of the ID column, added to every dataset. Default is None
+
+    Returns
+    -------
+    dict
+        Columns queried by the ruleset for each dataset label, e.g. {'demographics': ['cdcno', 'aggregate sentence in months']}. Names are cleaned as in compile_criterion() if clean_col_names is True
+
+    """
+    cols = {}
+    for criteria_type, criterion in ruleset['criteria'].items():
+        kind = criteria_kind(criteria_type)
+        for var, spec in criterion.items():
+            if (kind is None) or (not isinstance(spec, dict)) or ('data_label' not in spec):
+                continue
+            columns = list(off_enh_cols or []) if kind == 'enhancement' else [var]
+            cols.setdefault(spec['data_label'], [])
+            cols[spec['data_label']].extend(columns)
+    for label in cols.keys():
+        if id_var is not None:
+            cols[label].insert(0, id_var)
+        if clean_col_names:
+            cols[label] = utils.clean_var_names(cols[label], rem = ["\n"])
+        cols[label] = list(dict.fromkeys(cols[label]))
+    return cols
+
+
+def estimate_cost(rule, df):
+    """
+
+    Parameters
+    ----------
+    rule : Rule
+        Compiled rule
+    df : pandas dataframe
+        Dataset queried by the rule
+
+    Returns
+    -------
+    float
+        Estimated cost of evaluating the rule, i.e. rows scanned weighted by the cost per row of its kind and number of columns
+
+    """
+    return len(df)*ROW_COST[rule.kind]*len(rule.columns)
+
+
+def estimate_selectivity(rule, df):
+    """
+
+    Parameters
+    ----------
+    rule : Rule
+        Compiled rule
+    df : pandas dataframe
+        Dataset queried by the rule
+
+    Returns
+    -------
+    float
+        Estimated share of rows that the rule disqualifies. Range rules are measured directly on the column since that is cheap; other rules are assumed to remove half of the rows
+
+    """
+    if (rule.kind == 'sentence') and (len(df) > 0) and (rule.columns[0] in df):
+        # Values that are not numeric, e.g. 'LIFE', are ignored as in SentenceIndex
+        col = numeric_values(df[rule.columns[0]])
+        out = np.zeros(len(col), dtype = bool)
+        if rule.max_length:
+            out |= col > rule.max_length
+        if rule.min_length:
+            out |= col < rule.min_length
+        return float(out.mean())
+    return 0.5
+
+
+def numeric_values(col):
+    # Float values of a column, NaN where a value is not numeric. Categorical columns are converted once per category
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        cats = pd.to_numeric(pd.Series(np.asarray(col.cat.categories, dtype = object)), errors = 'coerce').to_numpy(dtype = float)
+        return np.append(cats, np.nan)[col.cat.codes.to_numpy()]
+    return pd.to_numeric(pd.Series(np.asarray(col)), errors = 'coerce').to_numpy(dtype = float)
+
+
+def order_rules(plan, datasets):
+    """
+
+    Parameters
+    ----------
+    plan : tuple of Rule
+        Compiled rules
+    datasets : dict
+        Datasets queried by the rules, keyed by their data label. None for datasets that are not loaded
+
+    Returns
+    -------
+    tuple of Rule
+        Rules ordered by estimated cost per disqualified row, so that cheap and selective rules run first and later rules only scan the IDs that survive them. The order of the plan is kept if the cost cannot be estimated
+
+    """
+    def rank(rule):
+        df = datasets.get(rule.data_label)
+        # Rules whose dataset is missing are left to the end, where their kernel reports the error
+        if df is None:
+            return np.inf
+        # Rules that remove nothing are pushed to the end among rules of equal cost
+        return estimate_cost(rule, df)/max(estimate_selectivity(rule, df), 1e-3)
+    try:
+        return tuple(sorted(plan, key = rank))
+    except Exception as e:
+        print(f"Rules could not be ordered by estimated cost, keeping the order of the ruleset: {e}")
+        return tuple(plan)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import copy
+import itertools
+
+
+def set_value(ruleset, path, value):
+    """
+
+    Parameters
+    ----------
+    ruleset : dict
+        Ruleset with the key 'criteria'
+    path : tuple
+        Keys leading to the value below 'criteria'. Example: ('sentence_length', 'Aggregate Sentence in Months', 'min')
+    value : object
+        New value
+
+    Returns
+    -------
+    ruleset : dict
+        Copy of the input ruleset with the value replaced
+
+    """
+    ruleset = copy.deepcopy(ruleset)
+    node = ruleset['criteria']
+    for key in path[:-1]:
+        node = node[key]
+    node[path[-1]] = copy.deepcopy(value)
+    return ruleset
+
+
+def expand_grid(base_ruleset, grid):
+    """
+
+    Parameters
+    ----------
+    base_ruleset : dict
+        Ruleset with the key 'criteria' that all scenarios are derived from
+    grid : dict
+        Keys are paths below 'criteria' (see set_value) and values are lists of values to try for that path.
+        Example: {('sentence_length', 'Aggregate Sentence in Months', 'min'): [240, 300]}
+
+    Returns
+    -------
+    scenarios : dict
+        One ruleset for every combination of the values in the grid. Keys are labels such as 'sentence_length.Aggregate Sentence in Months.min=240'
+
+    """
+    paths = list(grid.keys())
+    scenarios = {}
+    for values in itertools.product(*[grid[p] for p in paths]):
+        ruleset = base_ruleset
+        labels = []
+        for p, v in zip(paths, values):
+            ruleset = set_value(ruleset, p, v)
+            labels.append(f"{'.'.join(p)}={v}")
+        scenarios['; '.join(labels) if labels else 'base'] = ruleset
+    return scenarios
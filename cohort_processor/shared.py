@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+# Attributes of a cohort that workers need besides its raw datasets and its ID dictionary
+COHORT_ATTRS = ['label', 'desc', 'id', 'input_data_path', 'streamed_data_path', 'stream_options', 'stream_columns', 'offense_categories', 'ruleset']
+
+
+def to_shared(arr, segments):
+    """
+
+    Parameters
+    ----------
+    arr : numpy array
+        One-dimensional array with a fixed-size dtype
+    segments : list
+        Shared memory segments created so far. The new segment is appended to it
+
+    Returns
+    -------
+    tuple
+        Name of the shared memory segment, dtype and length of the array
+
+    """
+    arr = np.ascontiguousarray(arr)
+    # Segments cannot be empty
+    shm = shared_memory.SharedMemory(create = True, size = max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype = arr.dtype, buffer = shm.buf)[:] = arr
+    segments.append(shm)
+    return (shm.name, arr.dtype.str, len(arr))
+
+
+def from_shared(ref, segments):
+    """
+
+    Parameters
+    ----------
+    ref : tuple
+        Name of the shared memory segment, dtype and length of the array, see to_shared()
+    segments : list
+        Shared memory segments attached so far. The segment is appended to it and must stay referenced while the array is used
+
+    Returns
+    -------
+    numpy array
+        Read-only array backed by the shared memory segment, without copying
+
+    """
+    name, dtype, n = ref
+    shm = shared_memory.SharedMemory(name = name)
+    segments.append(shm)
+    arr = np.ndarray((n, ), dtype = np.dtype(dtype), buffer = shm.buf)
+    arr.flags.writeable = False
+    return arr
+
+
+def share_values(values, segments, refs):
+    """
+
+    Parameters
+    ----------
+    values : pandas index or numpy array
+        Distinct values, e.g. the categories of a column or the shared ID dictionary
+    segments : list
+        Shared memory segments created so far. New segments are appended to it
+    refs : dict
+        Values shared so far and their references, keyed by object id, so that values used by several columns are shared once. The values are kept so that their ids are not reused
+
+    Returns
+    -------
+    tuple
+        ('shared', reference of a fixed-width string array in shared memory) if all values are strings, otherwise ('pickled', values), i.e. the values travel with the handle
+
+    """
+    if id(values) in refs:
+        return refs[id(values)][1]
+    arr = np.asarray(values, dtype = object)
+    # Fixed-width strings drop trailing null characters, such values are pickled
+    if (len(arr) > 0) and all(isinstance(v, str) and not v.endswith('\x00') for v in arr):
+        ref = ('shared', to_shared(arr.astype(str), segments))
+    else:
+        ref = ('pickled', values)
+    refs[id(values)] = (values, ref)
+    return ref
+
+
+def attach_values(ref, segments, attached):
+    """
+
+    Parameters
+    ----------
+    ref : tuple
+        Reference from share_values()
+    segments : list
+        Shared memory segments attached so far. New segments are appended to it
+    attached : dict
+        Values attached so far, keyed by segment name, so that columns sharing their values in the parent also share them in the worker
+
+    Returns
+    -------
+    pandas index
+        Distinct values
+
+    """
+    kind, value = ref
+    if kind == 'pickled':
+        return pd.Index(value, dtype = object) if not isinstance(value, pd.Index) else value
+    if value[0] not in attached:
+        attached[value[0]] = pd.Index(from_shared(value, segments), dtype = object)
+    return attached[value[0]]
+
+
+def share_frame(df, segments, refs = None):
+    """
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Table to expose to worker processes
+    segments : list
+        Shared memory segments created so far. New segments are appended to it
+    refs : dict, optional
+        References of the distinct values shared so far, see share_values(). Default is None
+
+    Returns
+    -------
+    dict
+        Small, picklable handle of the table. Numeric, boolean and datetime columns and the codes of categorical columns are placed in shared memory. Other columns are factorized and only their codes are shared. Distinct values are shared as strings where possible (see share_values)
+
+    """
+    refs = {} if refs is None else refs
+    cols = []
+    for col in df.columns:
+        s = df[col]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            cols.append((col, 'categorical', to_shared(s.cat.codes.to_numpy(), segments), (share_values(s.cat.categories, segments, refs), s.cat.ordered)))
+        elif isinstance(s.dtype, np.dtype) and (s.dtype.kind in 'biufcmM'):
+            cols.append((col, 'array', to_shared(s.to_numpy(), segments), None))
+        else:
+            codes, uniques = pd.factorize(s, use_na_sentinel = True)
+            cols.append((col, 'factorized', to_shared(codes, segments), (share_values(uniques, segments, refs), s.dtype)))
+    if isinstance(df.index, pd.RangeIndex):
+        index = df.index
+    else:
+        index = df.index.to_numpy()
+    return {'columns': cols, 'index': index}
+
+
+def attach_frame(handle, segments, attached = None):
+    """
+
+    Parameters
+    ----------
+    handle : dict
+        Handle of a table from share_frame()
+    segments : list
+        Shared memory segments attached so far. New segments are appended to it
+    attached : dict, optional
+        Distinct values attached so far, see attach_values(). Default is None
+
+    Returns
+    -------
+    pandas dataframe
+        Table whose numeric and categorical columns are views of the shared memory. Factorized text columns are kept as categoricals over their codes instead of being rebuilt row by row
+
+    """
+    attached = {} if attached is None else attached
+    data = {}
+    for col, kind, ref, extra in handle['columns']:
+        arr = from_shared(ref, segments)
+        if kind == 'categorical':
+            categories, ordered = extra
+            data[col] = pd.Categorical.from_codes(arr, dtype = pd.CategoricalDtype(categories = attach_values(categories, segments, attached), ordered = ordered))
+        elif kind == 'array':
+            data[col] = arr
+        else:
+            uniques, dtype = extra
+            uniques = attach_values(uniques, segments, attached)
+            if dtype == object:
+                # Missing values have the code -1
+                data[col] = pd.Categorical.from_codes(arr, dtype = pd.CategoricalDtype(categories = uniques))
+            else:
+                vals = np.full(len(arr), np.nan, dtype = object)
+                vals[arr >= 0] = np.asarray(uniques, dtype = object)[arr[arr >= 0]]
+                data[col] = pd.array(vals, dtype = dtype)
+    return pd.DataFrame(data, index = handle['index'], columns = [c[0] for c in handle['columns']], copy = False)
+
+
+class SharedCohort():
+    """
+    Datasets of a cohort placed in shared memory once, for worker processes to attach without copying.
+
+    The handle is small and cheap to pickle, so it can be passed to any number of workers. The segments are released when the object is closed, e.g. at the end of a with block.
+    """
+    def __init__(self, cohort):
+        self.segments = []
+        self.attrs = {attr: getattr(cohort, attr) for attr in COHORT_ATTRS if hasattr(cohort, attr)}
+        self.tables = {}
+        # Distinct values shared so far, so that the ID dictionary and the categories of the encoded ID columns are shared once
+        refs = {}
+        try:
+            self.id_dictionary = share_values(cohort.get_id_dictionary(), self.segments, refs)
+            for cat in cohort.input_data_path.keys():
+                self.tables[cat+"_raw"] = share_frame(getattr(cohort, cat+"_raw"), self.segments, refs)
+        except Exception:
+            self.close()
+            raise
+        print(f"Placed {len(self.tables)} datasets in {self.nbytes} bytes of shared memory")
+
+    @property
+    def nbytes(self):
+        return sum(shm.size for shm in self.segments)
+
+    @property
+    def handle(self):
+        return {'attrs': self.attrs, 'id_dictionary': self.id_dictionary, 'tables': self.tables}
+
+    def close(self):
+        for shm in self.segments:
+            shm.close()
+            shm.unlink()
+        self.segments = []
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+
+def attach_cohort(handle, cohort_class, segments):
+    """
+
+    Parameters
+    ----------
+    handle : dict
+        Handle from SharedCohort.handle
+    cohort_class : class
+        CohortGenerator class used to rebuild the cohort
+    segments : list
+        Shared memory segments attached so far. New segments are appended to it
+
+    Returns
+    -------
+    CohortGenerator
+        Cohort with the shared datasets attached and its own store. No IDs are disqualified
+
+    """
+    cohort = cohort_class()
+    for attr, value in handle['attrs'].items():
+        setattr(cohort, attr, value)
+    attached = {}
+    cohort.id_dictionary = attach_values(handle['id_dictionary'], segments, attached)
+    for label, table in handle['tables'].items():
+        setattr(cohort, label, attach_frame(table, segments, attached))
+    cohort.disqual_mask = np.zeros(len(cohort.get_id_dictionary()), dtype = bool)
+    return cohort
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import numpy as np
+import pandas as pd
+import utils
+from indexes import normalize_column
+from offense_codes import selected_values
+
+
+def quote(name):
+    """
+
+    Parameters
+    ----------
+    name : str
+        Name of a table or column
+
+    Returns
+    -------
+    str
+        Quoted SQL identifier, e.g. '"off enh1"'
+
+    """
+    return '"'+str(name).replace('"', '""')+'"'
+
+
+def table_columns(con, table):
+    """
+
+    Parameters
+    ----------
+    con : sqlite3 connection
+        Connection to the database
+    table : str
+        Name of a table
+
+    Returns
+    -------
+    list
+        Column names of the table as stored in the database
+
+    """
+    return [row[1] for row in con.execute(f"PRAGMA table_info({quote(table)})")]
+
+
+def resolve_column(con, table, column, clean_col_names):
+    """
+
+    Parameters
+    ----------
+    con : sqlite3 connection
+        Connection to the database
+    table : str
+        Name of a table
+    column : str
+        Column name as referenced by a compiled rule, cleaned if clean_col_names is True
+    clean_col_names : bool
+        Whether the column names of the rules were cleaned (see utils.select_columns)
+
+    Returns
+    -------
+    str
+        Column name as stored in the database
+
+    """
+    found = utils.select_columns(table_columns(con, table), [column], clean_col_names)
+    if not found:
+        raise KeyError(f"Column {column} not found in table {table}")
+    return found[0]
+
+
+def selected_codes(con, table, columns, selection, prefix):
+    """
+
+    Parameters
+    ----------
+    con : sqlite3 connection
+        Connection to the database
+    table : str
+        Name of a table
+    columns : list
+        Columns with offense or enhancement values, as stored in the database
+    selection : set-like
+        Selected cleaned codes of a compiled rule
+    prefix : str
+        Prefix removed from the values, e.g. 'PC'
+
+    Returns
+    -------
+    rows : list
+        Distinct raw text values of the columns that are selected, with their cleaned value
+    nan_selected : bool
+        Whether values that are not text, including NULL, are selected. As with the pandas engine, they are cleaned to 'nan'
+
+    """
+    union = " UNION ".join(f"SELECT DISTINCT {quote(c)} FROM {quote(table)} WHERE typeof({quote(c)}) = 'text'" for c in columns)
+    raw = pd.Series([row[0] for row in con.execute(union)], dtype = object)
+    # Each distinct raw value is cleaned and matched once, as with the cached cleaned columns of the pandas engine
+    values = normalize_column(raw, prefix = prefix)
+    hit = selected_values(selection, values.categories)[values.codes] if len(raw) else np.array([], dtype = bool)
+    cleaned = np.asarray(values.categories, dtype = object)[values.codes]
+    rows = list(zip(raw[hit], cleaned[hit]))
+    nan_selected = utils.strip_clean(np.nan) in selection
+    return rows, nan_selected
+
+
+class SQLRuleset():
+    """
+    Compiled rules translated into a single SQL query over a SQLite database.
+
+    Offense rules become correlated NOT EXISTS subqueries, sentence rules BETWEEN comparisons and enhancement rules an unnested (row, enhancement) union of the enhancement columns. Offense codes are cleaned and matched in Python on the distinct values of each column only, and the selected raw values are placed in temporary tables, so that the query compares raw values and can use an index on (ID, column). The source database is only read, indexes are created on temporary copies (see create_indexes).
+    """
+    def __init__(self, con, plan, tables, id_var, pop_table, prefix, clean_col_names):
+        self.con = con
+        self.tables = tables
+        self.pop_table = pop_table
+        self.prefix = prefix
+        self.clean_col_names = clean_col_names
+        # ID column of each table as stored in the database
+        self.ids = {table: resolve_column(con, table, id_var, clean_col_names) for table in set(tables.values()) | {pop_table}}
+        # Indexes that serve the subqueries, and the columns queried in each table
+        self.indexes = set()
+        self.columns = {}
+        self.conditions = []
+        self.params = []
+        for i, rule in enumerate(plan):
+            self.conditions.append(self.translate(i, rule))
+
+    def table(self, rule):
+        cat = rule.data_label[:-len("_raw")] if rule.data_label.endswith("_raw") else rule.data_label
+        return self.tables[cat]
+
+    def selection_table(self, i, rows):
+        # Temporary table of the selected raw values of a rule and their cleaned value
+        name = f"sel_{i}"
+        self.con.execute(f"DROP TABLE IF EXISTS temp.{name}")
+        self.con.execute(f"CREATE TEMP TABLE {name} (value PRIMARY KEY, code)")
+        self.con.executemany(f"INSERT INTO temp.{name} VALUES (?, ?)", rows)
+        return f"temp.{name}"
+
+    def translate(self, i, rule):
+        """
+
+        Parameters
+        ----------
+        i : int
+            Position of the rule in the plan, used to name its temporary table
+        rule : rules.Rule
+            Compiled rule
+
+        Returns
+        -------
+        str
+            Condition on the population row p that holds if the ID of p is not disqualified by the rule
+
+        """
+        table = self.table(rule)
+        t, id_col = quote(table), quote(self.ids[table])
+        pid = f"p.{quote(self.ids[self.pop_table])}"
+        columns = [resolve_column(self.con, table, c, self.clean_col_names) for c in rule.columns]
+        self.columns.setdefault(table, {self.ids[table]}).update(columns)
+        if rule.kind == 'sentence':
+            col = quote(columns[0])
+            self.indexes.add((table, self.ids[table], columns[0]))
+            # Only numeric values are compared, other values are ignored as with pd.to_numeric(errors = 'coerce'). Bounds that are 0 or None are not applied
+            if rule.min_length and rule.max_length:
+                outside, params = f"{col} NOT BETWEEN ? AND ?", [rule.min_length, rule.max_length]
+            elif rule.max_length:
+                outside, params = f"{col} > ?", [rule.max_length]
+            elif rule.min_length:
+                outside, params = f"{col} < ?", [rule.min_length]
+            else:
+                return "1"
+            self.params.extend(params)
+            return f"NOT EXISTS (SELECT 1 FROM {t} AS r WHERE r.{id_col} = {pid} AND typeof(r.{col}) IN ('integer', 'real') AND r.{outside})"
+        rows, nan_selected = selected_codes(self.con, table, columns, rule.selection, self.prefix)
+        sel = self.selection_table(i, rows)
+        if rule.kind == 'offense':
+            col = quote(columns[0])
+            self.indexes.add((table, self.ids[table], columns[0]))
+            # NULL offenses are never compared with the selection so that NOT also holds for them
+            selected = f"(CASE WHEN typeof(r.{col}) = 'text' THEN r.{col} IN (SELECT value FROM {sel}) ELSE {int(nan_selected)} END)"
+            if rule.how == "Exclude":
+                # Disqualify IDs with any offense in the selection
+                return f"NOT EXISTS (SELECT 1 FROM {t} AS r WHERE r.{id_col} = {pid} AND {selected})"
+            elif rule.how == "Include":
+                # Disqualify IDs with any offense outside of the selection
+                return f"NOT EXISTS (SELECT 1 FROM {t} AS r WHERE r.{id_col} = {pid} AND NOT {selected})"
+        elif rule.kind == 'enhancement':
+            self.indexes.add((table, self.ids[table]))
+            # One (row, ID, value) entry per enhancement column
+            unnest = " UNION ALL ".join(f"SELECT rowid AS r, {id_col} AS id, {quote(c)} AS value FROM {t}" for c in columns)
+            # Distinct selected cleaned codes per row. Values that are not text count as the cleaned value 'nan'
+            hits = (f"SELECT e.r, e.id, COUNT(DISTINCT COALESCE(s.code, ?)) AS n FROM ({unnest}) AS e LEFT JOIN {sel} AS s ON e.value = s.value "
+                    f"WHERE s.code IS NOT NULL OR (typeof(e.value) != 'text' AND {int(nan_selected)}) GROUP BY e.r")
+            self.params.append(utils.strip_clean(np.nan))
+            if rule.how == "Exclude":
+                # Disqualify IDs with a row that has more than one selected enhancement
+                return f"{pid} NOT IN (SELECT id FROM ({hits}) WHERE n > 1 AND id IS NOT NULL)"
+            elif rule.how == "Include":
+                # Disqualify IDs present in the table without any row that has a selected enhancement
+                return (f"(NOT EXISTS (SELECT 1 FROM {t} AS r WHERE r.{id_col} = {pid}) "
+                        f"OR {pid} IN (SELECT id FROM ({hits}) WHERE id IS NOT NULL))")
+        print("Selection logic not understood")
+        return "1"
+
+    def create_indexes(self):
+        # Indexes on (ID, column) let SQLite answer each subquery with an index lookup per ID
+        # The source tables are never changed: their queried columns are copied into temporary tables of the same name, which take precedence over the source tables in the query, and the indexes are created on the copies
+        for table in sorted({key[0] for key in self.indexes}):
+            cols = ", ".join(quote(c) for c in sorted(self.columns[table]))
+            self.con.execute(f"DROP TABLE IF EXISTS temp.{quote(table)}")
+            self.con.execute(f"CREATE TEMP TABLE {quote(table)} AS SELECT {cols} FROM main.{quote(table)}")
+        for key in sorted(self.indexes):
+            table, cols = key[0], key[1:]
+            name = quote("idx_"+"_".join(utils.clean_var_names(list(key), rem = ["\n"])).replace(" ", "_"))
+            self.con.execute(f"CREATE INDEX IF NOT EXISTS temp.{name} ON {quote(table)} ({', '.join(quote(c) for c in cols)})")
+        return
+
+    @property
+    def sql(self):
+        pid = quote(self.ids[self.pop_table])
+        where = " AND ".join([f"p.{pid} IS NOT NULL"]+self.conditions)
+        return f"SELECT DISTINCT p.{pid} FROM {quote(self.pop_table)} AS p WHERE {where}"
+
+    def qualifying_ids(self):
+        """
+
+        Returns
+        -------
+        list
+            IDs of the population table that are not disqualified by any rule
+
+        """
+        return [row[0] for row in self.con.execute(self.sql, self.params)]
+
+
+def read_table(con, table, columns = None):
+    """
+
+    Parameters
+    ----------
+    con : sqlite3 connection
+        Connection to the database
+    table : str
+        Name of a table
+    columns : list, optional
+        Columns to read, as stored in the database. Default is None, i.e. all columns
+
+    Returns
+    -------
+    pandas dataframe
+        The table, e.g. to load it into a CohortGenerator
+
+    """
+    cols = ", ".join(quote(c) for c in columns) if columns else "*"
+    return pd.read_sql_query(f"SELECT {cols} FROM {quote(table)}", con)
+
+
+def connect(db_path):
+    """
+
+    Parameters
+    ----------
+    db_path : str
+        Location of a SQLite database file
+
+    Returns
+    -------
+    sqlite3 connection
+        Read-only connection to the existing database. A missing file is an error instead of a new, empty database. Temporary tables can still be created
+
+    """
+    return sqlite3.connect(f"file:{db_path}?mode=ro", uri = True)
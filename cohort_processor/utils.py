@@ -6,16 +6,65 @@ from dateutil.relativedelta import relativedelta
 from tqdm import tqdm
 import copy
 import os
+from collections import OrderedDict
+import patterns
+import compare
 
-def load_data(url):
+def load_data(url, usecols = None):
     if '.csv' in url:
-        return pd.read_csv(url)
+        return pd.read_csv(url, usecols = usecols)
     elif '.xlsx' in url:
-        return pd.read_excel(url)
+        return pd.read_excel(url, usecols = usecols)
     else: 
         print("URL is neither CSV nor Excel file and cannot be read")
         return
 
+def read_header(url):
+    """
+
+    Parameters
+    ----------
+    url : str
+        Location of a CSV or Excel file
+
+    Returns
+    -------
+    list
+        Column names of the file, read without parsing any rows
+
+    """
+    if '.csv' in url:
+        return list(pd.read_csv(url, nrows = 0).columns)
+    elif '.xlsx' in url:
+        return list(pd.read_excel(url, nrows = 0).columns)
+    else:
+        print("URL is neither CSV nor Excel file and cannot be read")
+        return []
+
+def select_columns(header, columns, clean_col_names = False):
+    """
+
+    Parameters
+    ----------
+    header : list
+        Column names of a table as stored in the file
+    columns : list
+        Requested column names, e.g. as referenced by a ruleset
+    clean_col_names : bool, optional
+        Whether names are compared after cleaning with clean_var_names, i.e. requested names can be raw or cleaned. Default is False
+
+    Returns
+    -------
+    list
+        Names in header that match any requested name, in the order of the header
+
+    """
+    if clean_col_names:
+        wanted = set(clean_var_names(list(columns), rem = ["\n"]))
+        return [h for h, c in zip(header, clean_var_names(list(header), rem = ["\n"])) if c in wanted]
+    wanted = set(columns)
+    return [h for h in header if h in wanted]
+
 def month_to_year(x, round_val = 1):
     try:
         return round(x/12, round_val)
@@ -144,10 +193,137 @@ def clean(data, remove = ['pc', 'rape', '\n', ' ']):
     return data
 
 
+def strip_clean(data, prefix = "", remove = ['pc', 'rape', '\n', ' ']):
+    """
+
+    Parameters
+    ----------
+    data : str or other value
+        A single raw value from an offense or enhancement column. Example: 'PC459/att'
+    prefix : str, optional
+        Prefix to remove from the value before cleaning, e.g. 'PC'. Default is an empty string
+    remove : list, optional
+        List of values to be removed from the input string. Default is ['pc', 'rape', '\n', ' ']
+
+    Returns
+    -------
+    str
+        Cleaned value, identical to removing the prefix with pandas .str.replace() and applying clean(), i.e. values that are not strings become 'nan'
+
+    """
+    if not isinstance(data, str):
+        return clean(np.nan, remove = remove)
+    if prefix:
+        data = data.replace(prefix, "")
+    return clean(data, remove = remove)
+
+
+# Cleaned values memoized across calls, keyed by the list of removed values and the value. The least recently used entries are dropped beyond CLEAN_MEMO_SIZE
+CLEAN_MEMO_SIZE = 100000
+_clean_memo = OrderedDict()
+
+
+def clean_unique(values, remove = ['pc', 'rape', '\n', ' ']):
+    """
+
+    Parameters
+    ----------
+    values : list, numpy array or other iterable
+        Distinct values to be cleaned. Example: the unique offenses of a column
+    remove : list, optional
+        List of values to be removed from each string. Default is ['pc', 'rape', '\n', ' ']
+
+    Returns
+    -------
+    list
+        clean() applied on each value. Results are memoized, so each distinct value is only cleaned once across calls as long as it is among the CLEAN_MEMO_SIZE most recently used values
+
+    """
+    rem = tuple(remove) if remove else None
+    out = []
+    for v in values:
+        # 1, 1.0 and True are equal dictionary keys but clean to different strings
+        key = (rem, type(v), v)
+        try:
+            c = _clean_memo.get(key)
+        except TypeError:
+            # Unhashable values are cleaned without memoization
+            out.append(clean(v, remove = remove))
+            continue
+        if c is None:
+            c = clean(v, remove = remove)
+            _clean_memo[key] = c
+            if len(_clean_memo) > CLEAN_MEMO_SIZE:
+                _clean_memo.popitem(last = False)
+        else:
+            _clean_memo.move_to_end(key)
+        out.append(c)
+    return out
+
+
+def clear_clean_memo():
+    """
+
+    Returns
+    -------
+    None
+        Empties the memoized results of clean_unique()
+
+    """
+    _clean_memo.clear()
+    return
+
+
+def clean_factorized(data, remove = ['pc', 'rape', '\n', ' ']):
+    """
+
+    Parameters
+    ----------
+    data : pandas series
+        Column with values to be cleaned, e.g. offense codes
+    remove : list, optional
+        List of values to be removed from each string. Default is ['pc', 'rape', '\n', ' ']
+
+    Returns
+    -------
+    pandas series
+        Same result as data.apply(clean, remove = remove). The column is factorized, each distinct value is cleaned once (see clean_unique) and the results are mapped back to the rows
+
+    """
+    codes, uniques = pd.factorize(data, use_na_sentinel = True)
+    # Missing values have the code -1 and pick up the last entry
+    cleaned = np.array(clean_unique(uniques, remove = remove)+[clean(np.nan, remove = remove)], dtype = object)
+    return pd.Series(cleaned[codes], index = data.index, name = data.name, dtype = object)
+
+
+def clean_vec(data, remove = ['pc', 'rape', '\n', ' ']):
+    """
+
+    Parameters
+    ----------
+    data : pandas series
+        Column with values to be cleaned, e.g. offense codes
+    remove : list, optional
+        List of values to be removed from each string. Default is ['pc', 'rape', '\n', ' ']
+
+    Returns
+    -------
+    pandas series
+        Same result as data.apply(clean, remove = remove), computed with pandas .str methods instead of a Python function per row
+
+    """
+    data = data.astype(object).astype(str).str.lower().str.rstrip('.')
+    if remove:
+        for r in remove:
+            data = data.str.replace(r, '', regex = False)
+    return data
+
+
 def clean_blk(data, 
               inplace = False, 
               names = None, 
-              remove = ['pc', 'rape', '\n', ' ']):
+              remove = ['pc', 'rape', '\n', ' '], 
+              method = 'factorize'):
     """
 
     Parameters
@@ -161,6 +337,9 @@ def clean_blk(data,
     inplace : boolean, optional
         Only applicable when input data is a pandas dataframe. Specify whether to return a new and separate dataframe or modify the existing one
         Default is False
+    method : str, optional
+        Only applicable when input data is a pandas series or dataframe. Takes 'factorize' (clean each distinct value once, see clean_factorized), 'vectorized' (pandas .str methods, see clean_vec) or 'apply' (clean each row)
+        Default is 'factorize'
         
     Returns
     -------
@@ -181,6 +360,10 @@ def clean_blk(data,
     
     # If input is a column of a pandas dataframe
     elif isinstance(data, pd.Series):
+        if method == 'factorize':
+            return clean_factorized(data, remove = remove)
+        elif method == 'vectorized':
+            return clean_vec(data, remove = remove)
         return data.apply(clean, remove = remove)
     
     # If input is a pandas dataframe
@@ -194,14 +377,14 @@ def clean_blk(data,
         if inplace:
             # Apply the cleaning function onto each column specified
             for col in names.keys():
-                data[names[col]] = data[col].apply(clean, remove = remove)
+                data[names[col]] = clean_blk(data[col], remove = remove, method = method)
             return data
         # Create a separate dataframe with the modified columns and leave the existing one unchanged
         else:
             data_new = data[:]
             # Apply the cleaning function onto each column specified
             for col in names.keys():
-                data_new[names[col]] = data[col].apply(clean, remove = remove)
+                data_new[names[col]] = clean_blk(data[col], remove = remove, method = method)
             return data_new
         
 
@@ -254,11 +437,16 @@ def val_search(data,
         # Return offenses that are present in sel_offenses
         return set(data).intersection(set(sel))
     elif how == 'contains':
+        # Find the selected values in each data value with a single automaton, then list the matches by selected value as before
+        automaton = patterns.AhoCorasick(list(sel))
+        found = {}
+        for d in data:
+            for s in automaton.find(d):
+                found.setdefault(s, []).append(d)
         match = []
         for s in sel:
-            for d in data:
-                if s in d:
-                    match.append(d)
+            # Empty selected values are contained in every data value
+            match.extend(found.get(s, []) if s else list(data))
         return match
     
     
@@ -321,49 +509,25 @@ def df_diff(df_objs, comp_col, label_col, merge = True, direction = 'single', re
         Differences in comp_val between the dataframes passed in read_path
 
     """
-    # Initialize dataframe to capture differences
-    df_diff = pd.DataFrame()
-    
-    # Set up the dataframe with values to compare
-    # Compare all dfs against each other
+    # Set up the values to compare: from all dataframes or only the base dataframe
     if direction == 'multi':
-        comp_list = []
-        for df in df_objs: 
-            comp_list.extend(list(df[comp_col]))
-        df_diff[comp_col] = list(set(comp_list))
-    # Compare only one df against the others
+        values = compare.membership([df[comp_col] for df in df_objs], labels = label_col)[['id']]
     elif direction == 'single':
-        df_diff[comp_col] = df_objs[0][comp_col].unique() 
+        values = pd.DataFrame({'id': df_objs[0][comp_col].unique()})
     else:
         print("Direction for evaluation is not understood. Please pass either 'single' or 'multi'")
         return
     
-    # Prepare the dataframe to capture differences 
-    df_diff.drop_duplicates(inplace = True)
-    df_diff.reset_index(drop = True, inplace = True)
-    
-    # Find common values
+    # Find common values with one hashed lookup per dataframe
+    df_diff = pd.DataFrame({comp_col: values['id'].to_numpy()})
     for i in range(0, len(df_objs)):
-        comp_vec = df_objs[i][comp_col].unique()
-        check = []
-        for v in df_diff[comp_col]:
-            if v in comp_vec:
-                check.append(True)
-            elif v not in comp_vec:
-                check.append(False)
-            else:
-                check.append(np.nan)
-        df_diff[label_col[i]] = check
+        df_diff[label_col[i]] = compare.is_member(df_diff[comp_col], df_objs[i][comp_col])
     
     # Return entires with at least one disagreement (True and False) or everything 
     if result == 'all':
         pass
     elif result == 'disagree':
-        sel = []
-        for index, row in df_diff.iterrows(): 
-            if not all(row[label_col]):
-                sel.append(index)
-        df_diff = df_diff.iloc[sel]
+        df_diff = df_diff[~df_diff[label_col].all(axis = 1)]
     else: 
         print("Result type is not understood. Please pass either 'disagree' or 'all'")
     
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+import multiprocessing
+import os
+import traceback
+import numpy as np
+import shared
+
+# State of a worker process, set once when the worker starts
+_state = {}
+
+
+def get_context():
+    """
+
+    Returns
+    -------
+    multiprocessing context
+        'fork' where available so that workers inherit the loaded tables instead of receiving a pickled copy, otherwise the platform default
+
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def use_shared_memory(shared_memory = None):
+    """
+
+    Parameters
+    ----------
+    shared_memory : bool, optional
+        Requested use of shared memory. Default is None, i.e. decided by the start method of the workers
+
+    Returns
+    -------
+    bool
+        Whether the datasets are handed to the workers through shared memory. By default only when workers cannot be forked, since forked workers inherit the loaded tables without copying them
+
+    """
+    if shared_memory is None:
+        return get_context().get_start_method() != 'fork'
+    return shared_memory
+
+
+def n_workers_for(n_tasks, n_workers = None):
+    """
+
+    Parameters
+    ----------
+    n_tasks : int
+        Number of independent tasks
+    n_workers : int, optional
+        Requested number of worker processes. Default is None, i.e. the number of CPUs
+
+    Returns
+    -------
+    int
+        Number of worker processes to start, never more than the number of tasks
+
+    """
+    return max(1, min(n_workers or os.cpu_count() or 1, n_tasks))
+
+
+def init_worker(cohort):
+    _state['cohort'] = cohort
+
+
+def init_shared_worker(handle, cohort_class):
+    # Attach the datasets placed in shared memory by the parent process. The segments must stay referenced while the worker runs
+    _state['segments'] = []
+    _state['cohort'] = shared.attach_cohort(handle, cohort_class, _state['segments'])
+
+
+def start_pool(cohort, n_tasks, n_workers = None, shared_cohort = None):
+    """
+
+    Parameters
+    ----------
+    cohort : CohortGenerator
+        Cohort with the loaded datasets
+    n_tasks : int
+        Number of independent tasks
+    n_workers : int, optional
+        Number of worker processes. Default is None, i.e. the number of CPUs
+    shared_cohort : shared.SharedCohort, optional
+        Datasets of the cohort in shared memory. Default is None, i.e. workers receive the cohort itself (inherited when forked, pickled otherwise)
+
+    Returns
+    -------
+    ProcessPoolExecutor
+        Pool whose workers hold the cohort
+
+    """
+    if shared_cohort is not None:
+        initializer, initargs = init_shared_worker, (shared_cohort.handle, type(cohort))
+    else:
+        initializer, initargs = init_worker, (cohort, )
+    return ProcessPoolExecutor(max_workers = n_workers_for(n_tasks, n_workers),
+                               mp_context = get_context(),
+                               initializer = initializer,
+                               initargs = initargs)
+
+
+def run_rule(rule, prefix):
+    # Disqualified IDs of a single rule as packed bits, or the error raised while evaluating it
+    try:
+        return np.packbits(_state['cohort'].evaluate_rule(rule, prefix = prefix)), None
+    except Exception as e:
+        return None, f"An error occurred: {e}\nFull error description:\n\n{traceback.format_exc()}"
+
+
+def evaluate_rules(cohort, plan, prefix, n_workers = None, shared_memory = None):
+    """
+
+    Parameters
+    ----------
+    cohort : CohortGenerator
+        Cohort with the loaded datasets and offense categorizations
+    plan : tuple of rules.Rule
+        Compiled rules
+    prefix : str
+        Prefix removed from offense and enhancement values
+    n_workers : int, optional
+        Number of worker processes. Default is None, i.e. the number of CPUs
+    shared_memory : bool, optional
+        Whether the datasets are handed to the workers through shared memory (see shared.SharedCohort). Default is None, i.e. only when workers cannot be forked (see use_shared_memory)
+
+    Returns
+    -------
+    list
+        Boolean mask over the shared ID codes of the IDs disqualified by each rule, in the order of the plan. None for rules that raised an error, which is printed
+
+    """
+    n_ids = len(cohort.get_id_dictionary())
+    masks = []
+    with shared.SharedCohort(cohort) if use_shared_memory(shared_memory) else nullcontext() as shared_cohort, \
+         start_pool(cohort, len(plan), n_workers, shared_cohort) as pool:
+        futures = [pool.submit(run_rule, rule, prefix) for rule in plan]
+        for rule, future in zip(plan, futures):
+            bits, error = future.result()
+            if error is not None:
+                print(f"Processing failed for criteria {rule.name}")
+                print(error)
+                masks.append(None)
+            else:
+                masks.append(np.unpackbits(bits, count = n_ids).astype(bool))
+    return masks
+
+
+def run_shard(shard, n_shards, kwargs):
+    # Disqualified IDs of one shard as codes of the shared ID dictionary
+    cohort = _state['cohort'].get_shard(shard, n_shards)
+    cohort.apply_ruleset(**kwargs)
+    return cohort.shard_codes[cohort.disqual_mask]
+
+
+def evaluate_shards(cohort, n_shards, n_workers = None, shared_memory = None, **kwargs):
+    """
+
+    Parameters
+    ----------
+    cohort : CohortGenerator
+        Cohort with the loaded datasets, offense categorizations and ruleset
+    n_shards : int
+        Number of shards the IDs are split into by hash, see CohortGenerator.get_shard()
+    n_workers : int, optional
+        Number of worker processes. Default is None, i.e. the number of CPUs
+    shared_memory : bool, optional
+        Whether the datasets are handed to the workers through shared memory (see shared.SharedCohort). Default is None, i.e. only when workers cannot be forked (see use_shared_memory)
+    **kwargs
+        Arguments of CohortGenerator.apply_ruleset() used for every shard
+
+    Returns
+    -------
+    numpy array
+        Codes of the shared ID dictionary of the IDs disqualified in any shard
+
+    """
+    with shared.SharedCohort(cohort) if use_shared_memory(shared_memory) else nullcontext() as shared_cohort, \
+         start_pool(cohort, n_shards, n_workers, shared_cohort) as pool:
+        codes = list(pool.map(run_shard, range(n_shards), [n_shards]*n_shards, [kwargs]*n_shards))
+    return np.concatenate(codes) if codes else np.array([], dtype = np.int64)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Benchmark of the offense cleaning paths in utils.clean_blk on a synthetic offense column
+import time
+import numpy as np
+import pandas as pd
+import utils
+
+rows = 500000
+distinct = 3000
+
+# Offense-like codes with prefixes, suffixes, spaces, trailing periods and missing values
+rng = np.random.default_rng(0)
+codes = [f"PC{rng.integers(100, 30000)}{['', '(a)', '(a)(1)', '/att', ' (664)', '.'][rng.integers(6)]}" for _ in range(distinct)]+[np.nan, 459, 12.5]
+data = pd.Series(np.asarray(codes, dtype = object)[rng.integers(0, len(codes), rows)])
+
+res = {}
+for method in ['apply', 'vectorized', 'factorize']:
+    utils.clear_clean_memo()
+    start = time.perf_counter()
+    res[method] = utils.clean_blk(data = data, method = method)
+    print(f"{method}: {time.perf_counter() - start:.3f} s")
+
+# Memoized values are reused by later calls
+start = time.perf_counter()
+utils.clean_blk(data = data, method = 'factorize')
+print(f"factorize (memoized): {time.perf_counter() - start:.3f} s")
+
+for method in ['vectorized', 'factorize']:
+    print(f"{method} identical to apply: {res[method].equals(res['apply'])}")
@@ -1,9 +1,23 @@
 # -*- coding: utf-8 -*-
 # -*- coding: utf-8 -*-
 from cohort_processor import CohortGenerator
+from datastore import DataStore
 import config
+import idmap
+import impl
+import rules
+import utils
+import workers
+from patterns import AhoCorasick
+from offense_codes import ParsedCodes, StructuredSelection
+import hashlib
 import json
+from itertools import permutations
+import os
+import tempfile
+import numpy as np
 import pandas as pd
+import sqlite3
 
 ruleset = {'criteria': {'sentence_length': {'aggregate sentence in months': {'min': 0, 
                                                                              'max': 10000000, 
@@ -39,6 +53,264 @@ ruleset = {'criteria': {'sentence_length': {'aggregate sentence in months': {'mi
 
 
 
+# Checks on the small local fixture in tests/data. Each faster path is compared with the qualifying IDs of the original implementation in expected_qualifying.json
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+fixture_paths = {cat: os.path.join(FIXTURE_DIR, cat+'.csv') for cat in ['demographics', 'current_commitments', 'prior_commitments']}
+fixture_categories = os.path.join(FIXTURE_DIR, 'offense_categories.csv')
+off_enh_cols = ['off enh'+str(i) for i in range(1, 12)]
+fixture_implications = {'codes': {'all': ["/att", "(664)", "2nd"], '459': ["/att", "(664)"]}, 'perm': 2}
+
+def fixture_ruleset(mode_c, mode_p, mode_ctrl, mode_e, smin, smax, tmin, match = 'exact'):
+    return {'criteria': {'controlling_offense': {'Controlling Offense': {'types': ['Serious felonies', 'Super strike offenses'], 'mode': mode_ctrl, 'data_label': 'demographics', 'implications': fixture_implications, 'match': match}},
+                         'sentence_length': {'Aggregate Sentence in Months': {'min': smin, 'max': smax, 'data_label': 'demographics'}},
+                         'sentence_served': {'time served in years': {'min': tmin, 'max': 10000000, 'data_label': 'demographics'}},
+                         'prior_commitments': {'Offense': {'types': ['Super strike offenses', 'Registrable sex offenses'], 'mode': mode_p, 'data_label': 'prior_commitments', 'implications': fixture_implications, 'match': match}},
+                         'offense_enhancements': {'off_enh': {'types': ['Firearm enhancements'], 'mode': mode_e, 'data_label': 'current_commitments', 'implications': fixture_implications, 'match': match}},
+                         'current_commitments': {'Offense': {'types': ['Serious felonies', 'Robbery offenses', 'Drug offenses'], 'mode': mode_c, 'data_label': 'current_commitments', 'implications': fixture_implications, 'match': match}}}}
+
+fixture_args = {'exclude': ('Exclude', 'Exclude', 'Exclude', 'Exclude', 240, 10000000, 10), 
+                'include': ('Include', 'Include', 'Include', 'Include', 0, 300, 0), 
+                'mixed': ('Include', 'Exclude', 'Exclude', 'Include', 100, None, 5)}
+fixture_rulesets = {label: fixture_ruleset(*args) for label, args in fixture_args.items()}
+with open(os.path.join(FIXTURE_DIR, 'expected_qualifying.json'), 'r') as f:
+    expected_qualifying = json.load(f)
+
+def fixture_cohort(ruleset, store = None, paths = None, **kwargs):
+    # Cohort of the fixture, or of other paths with the same layout, with the ruleset set. kwargs are passed to get_raw_data
+    fixture = CohortGenerator(label = 'fixture', desc = "Test", store = store)
+    fixture.get_raw_data(input_data_path = paths or fixture_paths, id_var = "CDCNo", clean_col_names = True, **kwargs)
+    fixture.get_offense_categorizations(fixture_categories)
+    fixture.get_ruleset(ruleset = ruleset)
+    return fixture
+
+def fixture_qualifying(fixture, **kwargs):
+    # Qualifying IDs after applying the ruleset. kwargs are passed to apply_ruleset
+    fixture.apply_ruleset(prefix = "PC", clean_col_names = True, pop_ids = 'demographics_raw', use_t_cols = [], off_enh_cols = off_enh_cols, **kwargs)
+    return sorted(fixture.get_qualifying_ids('demographics_raw'))
+
+for label, fixture_rules in fixture_rulesets.items():
+    assert fixture_qualifying(fixture_cohort(fixture_rules)) == expected_qualifying[label], f"Qualifying IDs of ruleset {label} differ from the original implementation"
+
+# Disk cache: the second load is read from the cache
+with tempfile.TemporaryDirectory() as cache_dir:
+    for _ in range(2):
+        for label, fixture_rules in fixture_rulesets.items():
+            assert fixture_qualifying(fixture_cohort(fixture_rules, cache_dir = cache_dir)) == expected_qualifying[label]
+    assert any(f.endswith('.parquet') or f.endswith('.pkl') for f in os.listdir(cache_dir))
+
+
+# Shared store: generators read one resident copy of the encoded tables, and an in-place write into a view raises instead of reaching the other generators
+store = DataStore()
+shared_cohorts = {label: fixture_cohort(fixture_rules, store = store) for label, fixture_rules in fixture_rulesets.items()}
+first, second = shared_cohorts['exclude'].current_commitments_raw, shared_cohorts['include'].current_commitments_raw
+assert all(np.shares_memory(np.asarray(first[col]), np.asarray(second[col])) for col in first.columns if first[col].dtype.kind in 'biuf')
+try:
+    first.loc[first.index[0], 'offense'] = None
+    raise AssertionError("In-place write into a shared table did not raise")
+except ValueError:
+    pass
+for label, fixture_cohort_shared in shared_cohorts.items():
+    assert fixture_qualifying(fixture_cohort_shared) == expected_qualifying[label]
+
+
+# Encoded tables: same qualifying IDs as the plain tables, and the responsive data keeps the dtypes of the source
+for label, fixture_rules in fixture_rulesets.items():
+    assert fixture_qualifying(fixture_cohort(fixture_rules, encode_data = False)) == expected_qualifying[label]
+fixture = fixture_cohort(fixture_rulesets['mixed'])
+fixture_qualifying(fixture)
+fixture.get_responsive_data({'demographics': fixture_paths['demographics']})
+source = pd.read_csv(fixture_paths['demographics'])
+source.columns = [col.lower() for col in source.columns]
+for col in source.columns:
+    assert fixture.demographics[col].dtype == source[col].dtype
+
+
+# Rule order: the plan in ruleset order and the plan ordered by estimated cost disqualify the same IDs
+for label, fixture_rules in fixture_rulesets.items():
+    fixture = fixture_cohort(fixture_rules)
+    fixture_qualifying(fixture)
+    plan = fixture.compile_ruleset(clean_col_names = True, off_enh_cols = off_enh_cols)
+    fixture.disqual_mask = np.zeros(len(fixture.get_id_dictionary()), dtype = bool)
+    fixture.execute_plan(plan, prefix = "PC", pop_ids = 'demographics_raw', order = False)
+    assert sorted(fixture.get_qualifying_ids('demographics_raw')) == expected_qualifying[label]
+# An enhancement criterion without enhancement columns is left out instead of disqualifying every ID
+fixture = fixture_cohort(fixture_rulesets['include'])
+fixture.apply_ruleset(prefix = "PC", clean_col_names = True, pop_ids = 'demographics_raw', use_t_cols = [])
+assert not any(rule.kind == 'enhancement' for rule in fixture.plan)
+assert len(fixture.get_qualifying_ids('demographics_raw')) >= len(expected_qualifying['include'])
+
+
+# Implication engine: expansions equal the enumerated permutations of the implied values, and membership tests agree with the expansion
+fixture_offenses = ['459', '211', '245(a)(1)']
+enumerated = set(fixture_offenses)
+for rel, vals in fixture_implications['codes'].items():
+    bases = [off for off in fixture_offenses if off not in fixture_implications['codes']] if rel == 'all' else [rel]
+    enumerated |= {off+''.join(p) for off in bases for k in range(1, fixture_implications['perm']+1) for p in permutations(vals, k)}
+assert set(impl.gen_impl_off(fixture_offenses, fixture_implications['codes'], fixture_implications['perm'])) == enumerated
+engine = impl.get_engine(impl_rel = fixture_implications['codes'], perm = fixture_implications['perm'])
+candidates = sorted(enumerated)+[off+'/att/att' for off in fixture_offenses]+['4592nd', '459(664)2nd', '2112nd/att2nd', '245(a)']
+assert all(engine.is_implied(code, set(fixture_offenses)) == (code in enumerated) for code in candidates)
+
+
+# Structured matching: match() over parsed codes agrees with the membership test on random codes, including codes with several degrees
+rng = np.random.default_rng(0)
+parts = ['/att', '(664)', '1st', '2nd', '3rd', '(a)', '(1)', '(b)']
+random_codes = np.array([str(rng.choice(['187', '459', '211', '245', '12022.5']))+''.join(rng.choice(parts, size = rng.integers(0, 4))) for _ in range(2000)], dtype = object)
+for implications in [fixture_implications, {'codes': {'all': ["/att", "2nd", "(a)"]}, 'perm': 3}]:
+    selection = StructuredSelection(['187', '459', '245(a)', '211'], implications)
+    assert (selection.match(ParsedCodes(random_codes)) == np.array([code in selection for code in random_codes])).all()
+# Structured matching on the fixture gives the same qualifying IDs as the enumerated implied codes
+for label, args in fixture_args.items():
+    assert fixture_qualifying(fixture_cohort(fixture_ruleset(*args, match = 'structured'))) == expected_qualifying[label]
+
+
+# Pattern matching: the automaton agrees with comparing every text with every pattern, and contains and prefix rules disqualify the same IDs as the naive comparison on the fixture
+automaton = AhoCorasick(['459', '45', '12022', '2nd', '(a)'])
+random_texts = [''.join(rng.choice(list('0123459(a)nd'), size = rng.integers(0, 12))) for _ in range(2000)]
+assert all(automaton.contains(t) == any(p in t for p in automaton.patterns) for t in random_texts)
+assert all(automaton.startswith(t) == any(t.startswith(p) for p in automaton.patterns) for t in random_texts)
+fixture_offense_categories = pd.read_csv(fixture_categories)
+commitments = pd.read_csv(fixture_paths['current_commitments'])
+cleaned = [utils.clean(v.replace("PC", "") if isinstance(v, str) else v) for v in commitments['Offense']]
+for how in ['contains', 'prefix']:
+    types = ['Serious felonies', 'Robbery offenses']
+    offenses = list(rules.resolve_selection(fixture_offense_categories, types, match = how))
+    hit = [any(c.startswith(p) if how == 'prefix' else (p in c) for p in offenses) for c in cleaned]
+    excluded = set(commitments.loc[hit, 'CDCNo'])
+    pattern_rules = {'criteria': {'current_commitments': {'Offense': {'types': types, 'mode': 'Exclude', 'data_label': 'current_commitments', 'match': how}}}}
+    assert 0 < len(excluded) < len(commitments['CDCNo'].unique())
+    assert fixture_qualifying(fixture_cohort(pattern_rules)) == sorted(set(pd.read_csv(fixture_paths['demographics'])['CDCNo']) - excluded)
+
+
+# Parallel evaluation: criteria evaluated in worker processes give the same qualifying IDs
+for label, fixture_rules in fixture_rulesets.items():
+    assert fixture_qualifying(fixture_cohort(fixture_rules), parallel = True, n_workers = 2) == expected_qualifying[label]
+
+
+# Sharded execution: loaded and streamed datasets give the same qualifying IDs. Streamed datasets are only read by the workers, one shard at a time
+for label, fixture_rules in fixture_rulesets.items():
+    for stream in [None, ['current_commitments', 'prior_commitments']]:
+        fixture = fixture_cohort(fixture_rules, stream = stream, chunksize = 50)
+        fixture.apply_ruleset_sharded(prefix = "PC", clean_col_names = True, pop_ids = 'demographics_raw', use_t_cols = [], off_enh_cols = off_enh_cols, n_shards = 3, n_workers = 2)
+        assert sorted(fixture.get_qualifying_ids('demographics_raw')) == expected_qualifying[label]
+        assert (stream is None) or not hasattr(fixture, 'current_commitments_raw')
+
+
+# Worker hand-off: forked workers inherit the tables by default, and tables placed in shared memory, encoded or not, give the same qualifying IDs
+assert workers.use_shared_memory() == (workers.get_context().get_start_method() != 'fork')
+for label, fixture_rules in fixture_rulesets.items():
+    for encode_data in [True, False]:
+        for shared_memory in [None, True, False]:
+            assert fixture_qualifying(fixture_cohort(fixture_rules, encode_data = encode_data), parallel = True, n_workers = 2, shared_memory = shared_memory) == expected_qualifying[label]
+        fixture = fixture_cohort(fixture_rules, encode_data = encode_data)
+        fixture.apply_ruleset_sharded(prefix = "PC", clean_col_names = True, pop_ids = 'demographics_raw', use_t_cols = [], off_enh_cols = off_enh_cols, n_shards = 2, n_workers = 2, shared_memory = True)
+        assert sorted(fixture.get_qualifying_ids('demographics_raw')) == expected_qualifying[label]
+
+
+# Column projection: loading only the columns queried by the ruleset gives the same qualifying IDs
+for label, fixture_rules in fixture_rulesets.items():
+    fixture = CohortGenerator(label = 'fixture', desc = "Test")
+    fixture.get_ruleset(ruleset = fixture_rules)
+    usecols = fixture.get_required_columns(clean_col_names = True, off_enh_cols = off_enh_cols)
+    assert fixture_qualifying(fixture_cohort(fixture_rules, usecols = usecols)) == expected_qualifying[label]
+
+
+# SQL backend: the query gives the same qualifying IDs as the pandas engine, with and without indexes, and the database is left unchanged
+with tempfile.TemporaryDirectory() as tmp:
+    db_path = os.path.join(tmp, 'fixture.db')
+    with sqlite3.connect(db_path) as con:
+        for cat, path in fixture_paths.items():
+            pd.read_csv(path).to_sql(cat, con, index = False)
+    con.close()
+    with open(db_path, 'rb') as f:
+        db_hash = hashlib.sha256(f.read()).hexdigest()
+    for label, fixture_rules in fixture_rulesets.items():
+        for create_indexes in [False, True]:
+            fixture = fixture_cohort(fixture_rules)
+            sql_ids = fixture.apply_ruleset_sql(db_path = db_path, tables = {cat: cat for cat in fixture_paths}, id_var = "CDCNo", prefix = "PC", clean_col_names = True, pop_ids = 'demographics_raw', off_enh_cols = off_enh_cols, create_indexes = create_indexes)
+            assert sorted(sql_ids) == expected_qualifying[label]
+            assert fixture.cross_check_sql(db_path = db_path, tables = {cat: cat for cat in fixture_paths}, id_var = "CDCNo", prefix = "PC", clean_col_names = True, pop_ids = 'demographics_raw', off_enh_cols = off_enh_cols, create_indexes = create_indexes) == {'sql': [], 'pandas': []}
+    with open(db_path, 'rb') as f:
+        assert hashlib.sha256(f.read()).hexdigest() == db_hash
+
+
+# Incremental evaluation: after records are added, changed and removed, re-evaluating the changed IDs only gives the same qualifying IDs as a full run
+with tempfile.TemporaryDirectory() as tmp:
+    paths = {cat: os.path.join(tmp, cat+'.csv') for cat in fixture_paths}
+    state_dir = os.path.join(tmp, 'state')
+    for label, fixture_rules in fixture_rulesets.items():
+        for cat, path in fixture_paths.items():
+            pd.read_csv(path).to_csv(paths[cat], index = False)
+        fixture = fixture_cohort(fixture_rules, paths = paths)
+        fixture.apply_ruleset_incremental(state_dir = os.path.join(state_dir, label), prefix = "PC", clean_col_names = True, pop_ids = 'demographics_raw', use_t_cols = [], off_enh_cols = off_enh_cols)
+        assert sorted(fixture.get_qualifying_ids('demographics_raw')) == expected_qualifying[label]
+        commitments = pd.read_csv(paths['current_commitments'])
+        commitments.loc[commitments.index[:40:4], 'Offense'] = 'PC187'
+        commitments = pd.concat([commitments.iloc[10:], commitments.iloc[:3].assign(Offense = 'PC496(a)')], ignore_index = True)
+        commitments.to_csv(paths['current_commitments'], index = False)
+        # Qualifying IDs with a new super strike prior or a new offense outside of the included categories
+        new_records = pd.DataFrame({'CDCNo': expected_qualifying[label][:2], 'Offense': ['PC187', 'PC496(a)']})
+        pd.concat([pd.read_csv(paths['prior_commitments']), new_records.iloc[:1]], ignore_index = True).to_csv(paths['prior_commitments'], index = False)
+        pd.concat([pd.read_csv(paths['current_commitments']), new_records.iloc[1:]], ignore_index = True).to_csv(paths['current_commitments'], index = False)
+        fixture = fixture_cohort(fixture_rules, paths = paths)
+        report = fixture.apply_ruleset_incremental(state_dir = os.path.join(state_dir, label), prefix = "PC", clean_col_names = True, pop_ids = 'demographics_raw', use_t_cols = [], off_enh_cols = off_enh_cols)
+        assert sorted(fixture.get_qualifying_ids('demographics_raw')) == fixture_qualifying(fixture_cohort(fixture_rules, paths = paths))
+        assert np.count_nonzero(report['eligibility'] == 'left') > 0
+
+
+# Result cache: cached criteria give the same qualifying IDs as a full run, also after a criterion or an input file changes
+with tempfile.TemporaryDirectory() as tmp:
+    paths = {cat: os.path.join(tmp, cat+'.csv') for cat in fixture_paths}
+    for cat, path in fixture_paths.items():
+        pd.read_csv(path).to_csv(paths[cat], index = False)
+    result_cache_dir = os.path.join(tmp, 'results')
+    for label, args in fixture_args.items():
+        for _ in range(2):
+            assert fixture_qualifying(fixture_cohort(fixture_ruleset(*args), paths = paths), result_cache_dir = result_cache_dir) == expected_qualifying[label]
+        edited = fixture_ruleset(*args[:4], 150, 400, args[6])
+        assert fixture_qualifying(fixture_cohort(edited, paths = paths), result_cache_dir = result_cache_dir) == fixture_qualifying(fixture_cohort(edited, paths = paths))
+    demographics = pd.read_csv(paths['demographics'])
+    demographics['Aggregate Sentence in Months'] = demographics['Aggregate Sentence in Months'][::-1].to_numpy()
+    demographics.to_csv(paths['demographics'], index = False)
+    changed = {label: fixture_qualifying(fixture_cohort(fixture_rules, paths = paths)) for label, fixture_rules in fixture_rulesets.items()}
+    assert changed != expected_qualifying
+    for label, fixture_rules in fixture_rulesets.items():
+        assert fixture_qualifying(fixture_cohort(fixture_rules, paths = paths), result_cache_dir = result_cache_dir) == changed[label]
+
+
+# ID map: lookups in the saved and memory-mapped map agree with the JSON dictionary of raw to hashed IDs, for plain and encoded ID columns
+assert config.HASH_ID_MAP == os.environ.get("HASH_ID_MAP", os.path.join(os.path.dirname(config.HASH_OBJ_MAP), "id_map"))
+with tempfile.TemporaryDirectory() as tmp:
+    raw_ids = list(pd.read_csv(fixture_paths['demographics'])['CDCNo'])
+    hash_dict = dict(zip(raw_ids[:250], idmap.hash_ids(raw_ids[:250], key = b'fixture')))
+    with open(os.path.join(tmp, 'hash_dict_ids.json'), 'w') as f:
+        json.dump(hash_dict, f)
+    id_map = idmap.IDMap.load(idmap.IDMap.from_json(os.path.join(tmp, 'hash_dict_ids.json')).save(os.path.join(tmp, 'id_map')))
+    queries = raw_ids+['A999999', 'A00000']
+    assert list(id_map.map_ids(queries)) == [hash_dict.get(i) for i in queries]
+    assert list(id_map.reverse(list(hash_dict.values()))) == list(hash_dict.keys())
+    for encode_data in [True, False]:
+        fixture = fixture_cohort(fixture_rulesets['mixed'], encode_data = encode_data)
+        assert list(fixture.get_hashed_ids('current_commitments_raw', id_map)) == [hash_dict.get(i) for i in pd.read_csv(fixture_paths['current_commitments'])['CDCNo']]
+
+
+# Export: qualifying records written in chunks, from loaded or streamed datasets, read back as the qualifying rows of the source
+readers = {'csv': pd.read_csv, 'parquet': pd.read_parquet, 'xlsx': lambda path, cat: pd.read_excel(path, sheet_name = cat)}
+with tempfile.TemporaryDirectory() as tmp:
+    for file_format, read in readers.items():
+        for stream in [None, ['current_commitments']]:
+            fixture = fixture_cohort(fixture_rulesets['mixed'], stream = stream, chunksize = 40)
+            assert fixture_qualifying(fixture) == expected_qualifying['mixed']
+            output_data_path = {cat: os.path.join(tmp, (cat if file_format != 'xlsx' else 'responsive')+'.'+file_format) for cat in fixture_paths}
+            fixture.write_responsive_data(input_data_path = fixture_paths, output_data_path = output_data_path, file_format = file_format, chunksize = 37)
+            for cat, path in fixture_paths.items():
+                source = pd.read_csv(path)
+                source.columns = utils.clean_var_names(list(source.columns), rem = ["\n"])
+                source = source[source['cdcno'].isin(expected_qualifying['mixed'])].reset_index(drop = True)
+                written = read(output_data_path[cat], cat) if file_format == 'xlsx' else read(output_data_path[cat])
+                pd.testing.assert_frame_equal(written, source, check_dtype = False)
+
+
 # Initialize the cohort and generate a non-non-nons scenario
 cohort = CohortGenerator(label = 'non-non-nons', desc = "Trial")
 cohort.get_raw_data(input_data_path = {'demographics': config.DEFAULT_DATA_URL, 
@@ -71,3 +343,26 @@ cohort.get_responsive_data(input_data_path = {'demographics': config.DEFAULT_DAT
 cohort.demographics 
 cohort.current_commitments
 cohort.prior_commitments
+
+# Stream the commitment tables in chunks and check that the qualifying records match the in-memory run
+streamed = CohortGenerator(label = 'non-non-nons (streamed)', desc = "Trial")
+streamed.get_raw_data(input_data_path = {'demographics': config.DEFAULT_DATA_URL, 
+                                         'current_commitments': config.CURRENT_COMMITMENTS_URL, 
+                                         'prior_commitments': config.PRIOR_COMMITMENTS_URL}, 
+                      id_var = "cdcno", 
+                      clean_col_names = True, 
+                      stream = ['current_commitments', 'prior_commitments'], 
+                      chunksize = 10000)
+streamed.get_offense_categorizations(config.OFFENSE_CODES_URL)
+streamed.get_ruleset(ruleset = ruleset)
+streamed.apply_ruleset(prefix = "PC", 
+                       clean_col_names = True, 
+                       pop_ids = 'demographics_raw', 
+                       use_t_cols = ["aggregate sentence in months", "offense end date"], 
+                       off_enh_cols = ['off enh'+str(i) for i in range(1, 12)])
+assert sorted(streamed.get_qualifying_ids('demographics_raw')) == sorted(cohort.get_qualifying_ids('demographics_raw'))
+for cat in ['current_commitments', 'prior_commitments']:
+    in_memory = getattr(cohort, cat).astype(str).sort_values(list(getattr(cohort, cat).columns)).reset_index(drop = True)
+    chunks = pd.concat(list(streamed.iter_responsive_data(cat)), ignore_index = True)
+    chunks = chunks.astype(str).sort_values(list(chunks.columns)).reset_index(drop = True)
+    assert in_memory.equals(chunks), f"Streamed and in-memory qualifying records of {cat} differ"